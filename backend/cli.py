@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+命令行索引与批量搜索
+
+不启动 HTTP 服务，直接使用 ImageProcessor 和 DatabaseManager，适合定时任务处理大目录:
+  index   索引目录（多进程并行），进度保存为后台索引任务，中断后用 resume 继续
+  resume  继续被中断、取消或失败的索引任务
+  jobs    列出索引任务
+  search  批量搜索：一次扫描索引比较全部查询图片，结果输出为 CSV 或 JSON
+
+数据库和快照默认与服务使用同一位置，服务进程会在下一次查询时映射命令行导出的新快照。
+NumPy/OpenCV 等较重的库只在执行命令时导入，局部特征匹配以外的命令不会导入 OpenCV。
+
+用法: python cli.py [--db image_index.db] index DIR [DIR ...] [--workers 8] [--features]
+      python cli.py resume JOB_ID
+      python cli.py search QUERY [QUERY ...] [--directory DIR] [--format csv|json] [--output FILE]
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import config
+from scanner import SYMLINK_POLICIES
+
+# 退出码：任务被中断时与 Ctrl-C 终止的进程一致
+EXIT_FAILED = 1
+EXIT_INTERRUPTED = 130
+
+
+def log(message: str):
+    """进度和提示输出到 stderr，stdout 只输出搜索结果"""
+    print(message, file=sys.stderr, flush=True)
+
+
+def open_database(args):
+    from database import DatabaseManager
+
+    db_manager = DatabaseManager(
+        args.db,
+        index_backend=config.HASH_INDEX_BACKEND,
+        mih_band_count=config.MIH_BAND_COUNT,
+        snapshot_path=args.snapshot or None,
+        snapshot_check_interval=config.SNAPSHOT_CHECK_INTERVAL
+    )
+    db_manager.init_db()
+    return db_manager
+
+
+def make_image_processor():
+    from image_processor import ImageProcessor
+
+    return ImageProcessor(
+        scan_workers=config.SCAN_WORKERS,
+        scan_exclude=config.SCAN_EXCLUDE,
+        follow_symlinks=config.SCAN_FOLLOW_SYMLINKS,
+        max_depth=config.SCAN_MAX_DEPTH if config.SCAN_MAX_DEPTH >= 0 else None
+    )
+
+
+def make_visual_index(db_manager):
+    from visual_words import VisualWordIndex
+
+    return VisualWordIndex(
+        db_manager,
+        vocabulary_size=config.VISUAL_VOCABULARY_SIZE,
+        sample_size=config.VISUAL_VOCABULARY_SAMPLE,
+        iterations=config.VISUAL_VOCABULARY_ITERATIONS
+    )
+
+
+def format_progress(job: dict) -> str:
+    progress = job['progress']
+    return (f"[{job['status']}] 已扫描 {progress['scanned']}，已计算 {progress['hashed']}"
+            f"（新增 {progress['added']}，更新 {progress['updated']}，未变化 {progress['unchanged']}，"
+            f"移除 {progress['removed']}，失败 {progress['failed']}），{progress['throughput']:.1f} 张/秒")
+
+
+def make_job_manager(args):
+    from index_jobs import IndexJobManager
+
+    db_manager = open_database(args)
+    # 已训练视觉词汇表时，任务结束后为新缓存的描述符补充词袋
+    return IndexJobManager(make_image_processor(), db_manager, resume_interrupted=False,
+                           on_finished=make_visual_index(db_manager).update)
+
+
+def run_job(args, jobs, job_id: str) -> int:
+    """执行索引任务直到结束，按任务的最终状态返回退出码"""
+    job = jobs.load(job_id)
+    if job is None:
+        log(f"索引任务不存在: {job_id}")
+        return EXIT_FAILED
+    if jobs.running_elsewhere(job):
+        owner = job['owner']
+        log(f"索引任务 {job_id} 正在由 {owner['host']} 上的进程 {owner['pid']} 执行")
+        jobs.db_manager.close()
+        return EXIT_FAILED
+
+    last_report = 0.0
+
+    def on_progress(job: dict):
+        nonlocal last_report
+        if not args.quiet and time.monotonic() - last_report >= args.progress_interval:
+            last_report = time.monotonic()
+            log(format_progress(job))
+
+    log(f"索引任务 {job_id}，中断后可运行 python cli.py resume {job_id} 继续")
+    job = jobs.run(job_id, on_progress)
+    log(format_progress(job))
+    jobs.db_manager.close()
+
+    if job['status'] == 'completed':
+        return 0
+    if job['status'] == 'failed':
+        log(f"索引任务失败: {job['error']}")
+        return EXIT_FAILED
+    log(f"索引任务已停止，可运行 python cli.py resume {job_id} 继续")
+    return EXIT_INTERRUPTED
+
+
+def command_index(args) -> int:
+    directories = [os.path.abspath(directory) for directory in args.directories]
+    missing = [directory for directory in directories if not os.path.isdir(directory)]
+    if missing:
+        log(f"目录不存在: {', '.join(missing)}")
+        return EXIT_FAILED
+
+    scan_options = {
+        'exclude': args.exclude,
+        'symlinks': args.follow_symlinks,
+        'max_depth': args.max_depth
+    }
+    jobs = make_job_manager(args)
+    job = jobs.submit(
+        directories,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        extract_features=args.features,
+        signatures=config.COMPUTE_SIGNATURES if args.signatures is None else args.signatures,
+        scan_options=scan_options
+    )
+    return run_job(args, jobs, job['id'])
+
+
+def command_resume(args) -> int:
+    return run_job(args, make_job_manager(args), args.job_id)
+
+
+def command_jobs(args) -> int:
+    db_manager = open_database(args)
+    for job in db_manager.get_index_jobs():
+        created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['created_at']))
+        print(f"{job['id']}  {created}  {', '.join(job['directories'])}")
+        print(f"    {format_progress(job)}")
+    return 0
+
+
+def query_images(image_processor, queries: list) -> list:
+    """展开查询参数：文件直接作为查询图片，目录展开为其中的全部图片"""
+    image_paths = []
+    for query in queries:
+        if os.path.isdir(query):
+            image_paths.extend(sorted(image_processor.iter_image_files(query)))
+        else:
+            image_paths.append(query)
+    return image_paths
+
+
+def search_phash(args, db_manager, image_processor, image_paths: list) -> list:
+    """并行计算查询图片的哈希，再一次扫描索引比较全部查询"""
+    queries = []
+    hash_results = image_processor.calculate_hashes(image_paths, args.workers)
+    for image_path, (hash_value, error) in zip(image_paths, hash_results):
+        query = {"query": image_path}
+        if error is not None:
+            query["error"] = error
+        else:
+            query["query_hash"] = hash_value
+        queries.append(query)
+
+    searchable = [query for query in queries if "query_hash" in query]
+    matches = db_manager.find_similar_images_batch(
+        [query["query_hash"] for query in searchable],
+        args.directory,
+        args.threshold,
+        top_k=args.top_k
+    )
+    for query, similar_images in zip(searchable, matches):
+        query["results"] = [{"path": image_path, "similarity": similarity}
+                            for image_path, stored_hash, similarity in similar_images]
+    return queries
+
+
+def search_feature_match(args, db_manager, image_processor, image_paths: list) -> list:
+    """逐个查询做局部特征匹配；已建立视觉词袋索引时只验证得分最高的候选"""
+    from image_processor import opencv_available
+
+    if not opencv_available():
+        raise Exception("局部特征匹配需要安装 OpenCV。请运行: pip install opencv-python numpy")
+
+    targets = set(path for path, _ in db_manager.get_images_in_directory(args.directory))
+    if args.directory:
+        targets.update(image_processor.iter_image_files(args.directory))
+    targets = sorted(targets)
+    visual_index = make_visual_index(db_manager)
+    visual_index.load()
+    shortlist_size = config.FEATURE_SHORTLIST_SIZE
+
+    queries = []
+    for image_path in image_paths:
+        query = {"query": image_path}
+        queries.append(query)
+        try:
+            query_features = image_processor.compute_features(image_path)
+            if query_features[1] is None:
+                query["results"] = []
+                continue
+            candidates = targets
+            if visual_index.is_ready and 0 < shortlist_size < len(targets):
+                candidates = visual_index.shortlist(query_features[1], targets, shortlist_size)
+            query["results"] = image_processor.search_with_feature_match(
+                image_path,
+                candidates,
+                min_match_count=10,
+                threshold=args.threshold * 0.5,  # 与服务的特征匹配搜索相同
+                db_manager=db_manager,
+                workers=args.workers,
+                top_k=args.top_k,
+                query_features=query_features
+            )
+        except Exception as e:
+            query["error"] = str(e)
+    return queries
+
+
+def write_results(args, queries: list, method: str):
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')
+    try:
+        if args.format == 'json':
+            json.dump({
+                "method": method,
+                "threshold": args.threshold,
+                "directory": args.directory,
+                "queries": queries
+            }, output, ensure_ascii=False, indent=2)
+            output.write("\n")
+            return
+        writer = csv.writer(output)
+        writer.writerow(['query', 'rank', 'path', 'similarity', 'match_count', 'error'])
+        for query in queries:
+            if "error" in query:
+                writer.writerow([query["query"], '', '', '', '', query["error"]])
+                continue
+            for rank, result in enumerate(query["results"], 1):
+                writer.writerow([query["query"], rank, result["path"], f"{result['similarity']:.4f}",
+                                 result.get("match_count", ''), ''])
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def command_search(args) -> int:
+    if args.directory:
+        # 索引中保存的是绝对路径
+        args.directory = os.path.abspath(args.directory)
+    image_processor = make_image_processor()
+    image_paths = query_images(image_processor, args.queries)
+    if not image_paths:
+        log("没有可查询的图片")
+        return EXIT_FAILED
+
+    db_manager = open_database(args)
+    started = time.monotonic()
+    try:
+        if args.feature_match:
+            queries = search_feature_match(args, db_manager, image_processor, image_paths)
+        else:
+            queries = search_phash(args, db_manager, image_processor, image_paths)
+    except Exception as e:
+        log(f"搜索失败: {str(e)}")
+        return EXIT_FAILED
+    finally:
+        db_manager.close()
+
+    if not args.include_missing:
+        # 同一张图片可能出现在多个查询的结果中，只检查一次是否存在
+        exists = {}
+        for query in queries:
+            results = []
+            for result in query.get("results", []):
+                if result["path"] not in exists:
+                    exists[result["path"]] = os.path.exists(result["path"])
+                if exists[result["path"]]:
+                    results.append(result)
+            query["results"] = results
+    for query in queries:
+        query.setdefault("results", [])
+        query["total"] = len(query["results"])
+
+    write_results(args, queries, "feature_match" if args.feature_match else "phash")
+    failed = sum(1 for query in queries if "error" in query)
+    log(f"{len(queries)} 个查询，{sum(query['total'] for query in queries)} 个结果，"
+        f"{failed} 个失败，耗时 {time.monotonic() - started:.2f} 秒")
+    return EXIT_FAILED if failed == len(queries) else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="ImageTwin 命令行索引与批量搜索")
+    parser.add_argument('--db', default='image_index.db', help="数据库文件")
+    parser.add_argument('--snapshot', default=config.INDEX_SNAPSHOT_PATH,
+                        help="内存索引快照文件，为空时不使用（默认取配置 INDEX_SNAPSHOT_PATH）")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help="索引目录")
+    index_parser.add_argument('directories', nargs='+', help="要索引的目录")
+    index_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                              help="并行计算哈希的进程数")
+    index_parser.add_argument('--batch-size', type=int, default=500, help="每个事务写入的记录数")
+    index_parser.add_argument('--features', action='store_true',
+                              help="同时预先计算 ORB 描述符，加速局部特征匹配搜索（需要 OpenCV）")
+    index_parser.add_argument('--signatures', action='store_const', const=True, default=None,
+                              help="同时计算级联搜索的签名，默认取配置 COMPUTE_SIGNATURES")
+    index_parser.add_argument('--no-signatures', dest='signatures', action='store_const', const=False,
+                              help="不计算级联搜索的签名")
+    index_parser.add_argument('--exclude', action='append', default=None,
+                              help="跳过的文件/目录模式，可重复指定，默认取配置 SCAN_EXCLUDE")
+    index_parser.add_argument('--follow-symlinks', choices=SYMLINK_POLICIES, default=None,
+                              help="符号链接策略，默认取配置 SCAN_FOLLOW_SYMLINKS")
+    index_parser.add_argument('--max-depth', type=int, default=None, help="最多进入几层子目录")
+    index_parser.add_argument('--progress-interval', type=float, default=5.0, help="输出进度的间隔（秒）")
+    index_parser.add_argument('--quiet', action='store_true', help="不输出中间进度")
+    index_parser.set_defaults(func=command_index)
+
+    resume_parser = subparsers.add_parser('resume', help="继续被中断、取消或失败的索引任务")
+    resume_parser.add_argument('job_id', help="索引任务 ID")
+    resume_parser.add_argument('--progress-interval', type=float, default=5.0, help="输出进度的间隔（秒）")
+    resume_parser.add_argument('--quiet', action='store_true', help="不输出中间进度")
+    resume_parser.set_defaults(func=command_resume)
+
+    jobs_parser = subparsers.add_parser('jobs', help="列出索引任务")
+    jobs_parser.set_defaults(func=command_jobs)
+
+    search_parser = subparsers.add_parser('search', help="批量搜索相似图片")
+    search_parser.add_argument('queries', nargs='+', help="查询图片，传入目录时查询其中的全部图片")
+    search_parser.add_argument('--directory', default='', help="只在该目录中搜索，默认搜索整个索引")
+    search_parser.add_argument('--threshold', type=float, default=0.8, help="相似度阈值")
+    search_parser.add_argument('--top-k', type=int, default=None, help="每个查询最多返回的结果数")
+    search_parser.add_argument('--feature-match', action='store_true',
+                               help="使用局部特征匹配（适用于截图、部分匹配，需要 OpenCV）")
+    search_parser.add_argument('--workers', type=int, default=config.BATCH_HASH_WORKERS,
+                               help="计算查询哈希和特征匹配使用的线程数")
+    search_parser.add_argument('--include-missing', action='store_true', help="保留已不存在的文件")
+    search_parser.add_argument('--format', choices=('csv', 'json'), default='csv', help="输出格式")
+    search_parser.add_argument('--output', default='-', help="输出文件，- 表示标准输出")
+    search_parser.set_defaults(func=command_search)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import metrics
+
+
+class ServiceBusyError(Exception):
+    """有界执行器已满，请求被拒绝"""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"服务繁忙（{name}），请 {retry_after} 秒后重试")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    """
+    有界线程池执行器
+
+    把阻塞的 CPU / IO 工作移出事件循环。最多 max_concurrency 个任务同时执行，
+    另有 max_queue 个任务可以排队；超出后立即抛出 ServiceBusyError，
+    而不是无限排队拖慢所有请求。
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int = 0, retry_after: int = 1):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                            thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency + self.max_queue)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._rejected = 0
+        # 预先创建标签，没有拒绝过的执行器也导出 0
+        self._rejected_counter = metrics.EXECUTOR_REJECTED.labels(name)
+
+    async def run(self, func, *args, **kwargs):
+        """在线程池中执行 func，名额已满时抛出 ServiceBusyError"""
+        return await self.submit(func, *args, **kwargs)
+
+    def submit(self, func, *args, **kwargs) -> asyncio.Future:
+        """
+        提交任务并返回可等待的 asyncio future（需在事件循环中调用）；
+        名额已满时立即抛出 ServiceBusyError，便于在开始流式响应之前返回 503
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            self._rejected_counter.inc()
+            raise ServiceBusyError(self.name, self.retry_after)
+
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._executor.submit(partial(func, *args, **kwargs))
+        except Exception:
+            self._release()
+            raise
+        # 名额在任务真正结束时释放；即使客户端断开、协程被取消，仍在执行的任务也会占用名额
+        future.add_done_callback(lambda _: self._release())
+        return asyncio.wrap_future(future)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'in_flight': self._in_flight,
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'rejected': self._rejected
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
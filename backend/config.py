@@ -0,0 +1,106 @@
+"""
+运行配置
+
+所有配置项都可以通过同名的 IMAGETWIN_* 环境变量覆盖
+"""
+import os
+
+
+def _env_str(name: str, default: str) -> str:
+    return os.environ.get(f"IMAGETWIN_{name}", default)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(f"IMAGETWIN_{name}", default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(f"IMAGETWIN_{name}", default))
+    except ValueError:
+        return default
+
+
+# 内存索引的二进制快照文件（为空时不使用）：多个 worker 进程 mmap 共享同一份快照，
+# 启动时快照与数据库一致则不必从数据库重建索引；每次索引完成后原子地更新
+INDEX_SNAPSHOT_PATH = _env_str("INDEX_SNAPSHOT_PATH", "image_index.snapshot")
+# 检查快照是否被其他进程更新的最小间隔（秒）
+SNAPSHOT_CHECK_INTERVAL = _env_float("SNAPSHOT_CHECK_INTERVAL", 2.0)
+
+# 内存哈希索引类型: linear（向量化全量扫描）或 mih（多索引哈希，高阈值时只扫描少量候选）
+HASH_INDEX_BACKEND = _env_str("HASH_INDEX_BACKEND", "linear")
+# 多索引哈希的分段数（256 位哈希可取 8/16/32）
+MIH_BAND_COUNT = _env_int("MIH_BAND_COUNT", 16)
+
+# 局部特征匹配搜索的并行线程数
+FEATURE_MATCH_WORKERS = _env_int("FEATURE_MATCH_WORKERS", os.cpu_count() or 1)
+# 局部特征匹配搜索的默认时间预算（秒），0 表示不限制；超时返回部分结果
+FEATURE_MATCH_TIME_BUDGET = _env_float("FEATURE_MATCH_TIME_BUDGET", 0.0)
+# 视觉词袋索引就绪且候选多于此数量时，只对词袋得分最高的这些候选做特征匹配验证（0 表示不筛选）
+FEATURE_SHORTLIST_SIZE = _env_int("FEATURE_SHORTLIST_SIZE", 300)
+# 视觉词汇表的大小、训练时抽样的描述符数量和聚类迭代次数
+VISUAL_VOCABULARY_SIZE = _env_int("VISUAL_VOCABULARY_SIZE", 4096)
+VISUAL_VOCABULARY_SAMPLE = _env_int("VISUAL_VOCABULARY_SAMPLE", 200000)
+VISUAL_VOCABULARY_ITERATIONS = _env_int("VISUAL_VOCABULARY_ITERATIONS", 10)
+
+# 扫描目录时并行列出子目录的线程数（网络挂载盘上可以调大）
+SCAN_WORKERS = _env_int("SCAN_WORKERS", 4)
+# 扫描时跳过的文件/目录（fnmatch 模式，匹配名称或相对路径，多个模式用 os.pathsep 分隔）
+SCAN_EXCLUDE = [p for p in _env_str("SCAN_EXCLUDE", "").split(os.pathsep) if p]
+# 符号链接策略: skip（忽略）、files（只跟随文件链接）、follow（同时进入目录链接）
+SCAN_FOLLOW_SYMLINKS = _env_str("SCAN_FOLLOW_SYMLINKS", "files")
+# 最多进入几层子目录，负数表示不限制
+SCAN_MAX_DEPTH = _env_int("SCAN_MAX_DEPTH", -1)
+
+# 启动时是否自动继续上次进程退出时未完成的后台索引任务
+RESUME_INTERRUPTED_JOBS = _env_str("RESUME_INTERRUPTED_JOBS", "1") not in ("0", "false", "no")
+
+# 感知哈希搜索的并发上限和排队上限，超出时返回 503
+PHASH_SEARCH_CONCURRENCY = _env_int("PHASH_SEARCH_CONCURRENCY", os.cpu_count() or 1)
+PHASH_SEARCH_QUEUE = _env_int("PHASH_SEARCH_QUEUE", 16)
+# 局部特征匹配搜索的并发上限和排队上限（单个请求内部已经并行，默认只允许少量同时执行）
+FEATURE_SEARCH_CONCURRENCY = _env_int("FEATURE_SEARCH_CONCURRENCY", 2)
+FEATURE_SEARCH_QUEUE = _env_int("FEATURE_SEARCH_QUEUE", 2)
+# 批量搜索每个请求最多包含的查询数（图片和哈希值合计），以及计算上传图片哈希的线程数
+BATCH_SEARCH_MAX_QUERIES = _env_int("BATCH_SEARCH_MAX_QUERIES", 256)
+BATCH_HASH_WORKERS = _env_int("BATCH_HASH_WORKERS", os.cpu_count() or 1)
+# 搜索结果分页：未指定 limit 时每页返回的结果数，以及 limit 的上限
+SEARCH_PAGE_SIZE = _env_int("SEARCH_PAGE_SIZE", 100)
+SEARCH_MAX_PAGE_SIZE = _env_int("SEARCH_MAX_PAGE_SIZE", 1000)
+# 感知哈希搜索结果缓存的内存上限（MB，0 表示关闭）和有效期（秒，0 表示不过期）；
+# 索引变化后缓存的结果自动失效
+RESULT_CACHE_MAX_MB = _env_int("RESULT_CACHE_MAX_MB", 64)
+RESULT_CACHE_TTL = _env_float("RESULT_CACHE_TTL", 600.0)
+# 503 响应中建议客户端重试的等待秒数
+RETRY_AFTER_SECONDS = _env_int("RETRY_AFTER_SECONDS", 5)
+
+# 缩略图缓存目录、总大小上限（MB）和编码质量
+THUMBNAIL_CACHE_DIR = _env_str("THUMBNAIL_CACHE_DIR", "thumbnail_cache")
+THUMBNAIL_CACHE_MAX_MB = _env_int("THUMBNAIL_CACHE_MAX_MB", 512)
+THUMBNAIL_QUALITY = _env_int("THUMBNAIL_QUALITY", 85)
+# 允许请求的最大缩略图尺寸
+THUMBNAIL_MAX_SIZE = _env_int("THUMBNAIL_MAX_SIZE", 1024)
+
+# 启动时自动监控的目录（多个目录用 os.pathsep 分隔），文件变化会增量同步到索引
+WATCH_DIRECTORIES = [d for d in _env_str("WATCH_DIRECTORIES", "").split(os.pathsep) if d]
+# 同一文件在多少秒内没有新事件后才处理，合并连续写入产生的事件
+WATCH_DEBOUNCE_SECONDS = _env_float("WATCH_DEBOUNCE_SECONDS", 2.0)
+# 每批写入数据库的文件数
+WATCH_BATCH_SIZE = _env_int("WATCH_BATCH_SIZE", 200)
+# 未安装 watchdog（或强制轮询）时，轮询目录的间隔（秒）
+WATCH_POLL_INTERVAL = _env_float("WATCH_POLL_INTERVAL", 30.0)
+WATCH_FORCE_POLLING = _env_str("WATCH_FORCE_POLLING", "0") not in ("0", "false", "no")
+# 监控写入索引后，持续有变化时最多间隔多少秒导出一次索引快照（没有新变化时在 debounce 秒后导出）
+WATCH_SNAPSHOT_INTERVAL = _env_float("WATCH_SNAPSHOT_INTERVAL", 30.0)
+
+# 索引时是否同时计算 dHash/aHash/colorhash，用于级联搜索（/api/search 的 cascade 参数）
+COMPUTE_SIGNATURES = _env_str("COMPUTE_SIGNATURES", "0") not in ("0", "false", "no")
+# 级联搜索中廉价签名的相似度阈值比 pHash 阈值低多少，越大越不容易漏检，排除的候选越少
+CASCADE_SIGNATURE_MARGIN = _env_float("CASCADE_SIGNATURE_MARGIN", 0.15)
+
+# 是否记录 /metrics 导出的运行指标（各阶段耗时直方图、文件计数等）；
+# 关闭后请求中的 debug 耗时明细仍然可用
+METRICS_ENABLED = _env_str("METRICS_ENABLED", "1") not in ("0", "false", "no")
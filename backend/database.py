@@ -1,133 +1,881 @@
 import sqlite3
 import os
-from typing import List, Tuple
+import json
+import threading
+import time
+import heapq
+from contextlib import contextmanager
+from typing import List, Tuple, Dict, Optional, Iterator
 from pathlib import Path
 import imagehash
 
+import metrics
+from hash_index import HashIndex, NUMPY_AVAILABLE, max_distance_for, SIGNATURE_BITS, parse_signatures
+from index_snapshot import open_snapshot, write_snapshot
+from path_scope import parent_directory, directory_range
+
 class DatabaseManager:
-    def __init__(self, db_path: str = "image_index.db"):
+    # 每个连接建立时设置的 PRAGMA
+    # WAL 让读写互不阻塞；synchronous=NORMAL 在 WAL 下仍保证崩溃一致性，且不必每次提交都 fsync
+    CONNECTION_PRAGMAS = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA cache_size=-65536',      # 64MB 页缓存
+        'PRAGMA mmap_size=268435456',    # 256MB 内存映射读取
+        'PRAGMA busy_timeout=30000',
+    )
+    # 数据库结构版本（PRAGMA user_version），init_db 时按版本依次迁移
+    SCHEMA_VERSION = 3
+    # 感知哈希的计算方式版本，与每条记录一起保存（见 ImageProcessor._phash）。计算方式变化时递增：
+    # 版本不同的记录在增量索引时视为已变化并重新计算，避免新旧两种哈希混在同一个索引中
+    #   1  完整解码（未记录版本的旧记录）
+    #   2  JPEG 按 HASH_DRAFT_SIZE 缩小解码
+    #   3  计算签名时的灰度图与只计算哈希时相同（ImageProcessor._decode_gray）
+    HASH_VERSION = 3
+    
+    def __init__(self, db_path: str = "image_index.db", use_memory_index: bool = True,
+                 index_backend: str = "linear", mih_band_count: int = 16,
+                 snapshot_path: Optional[str] = None, snapshot_check_interval: float = 2.0):
+        """
+        snapshot_path: 内存索引的二进制快照文件（见 index_snapshot），为空时不使用快照。
+                       启动时快照与数据库一致则直接映射快照；其他进程替换快照后，
+                       最多 snapshot_check_interval 秒后在下一次查询时重新映射
+        """
         self.db_path = db_path
+        # 常驻内存的哈希索引（需要 NumPy），init_db 时从数据库加载
+        self.hash_index = None
+        if use_memory_index and NUMPY_AVAILABLE:
+            self.hash_index = HashIndex(backend=index_backend, mih_band_count=mih_band_count)
+        self._index_loaded = False
+        # 索引版本号：每次写入或删除记录后递增，搜索结果缓存据此判断是否过期
+        self._generation = 0
+        self._generation_lock = threading.Lock()
+        self.snapshot_path = snapshot_path or None
+        self.snapshot_check_interval = snapshot_check_interval
+        # 当前映射（或导出）的快照文件标识，文件被替换后标识变化
+        self._snapshot_identity = None
+        self._next_snapshot_check = 0.0
+        self._snapshot_lock = threading.Lock()
+        # 每个线程持有自己的持久连接，避免并发查询反复打开数据库文件；
+        # 线程 -> 连接，线程结束后连接由 close_stale_connections 关闭
+        self._local = threading.local()
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的持久连接，首次使用时创建"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False 仅用于关闭时由其他线程统一 close，连接本身不跨线程使用
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            for pragma in self.CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections[threading.current_thread()] = conn
+            # 请求内临时创建的线程池线程结束后不会再使用各自的连接，新建连接时顺便关闭
+            self.close_stale_connections()
+        return conn
+    
+    def close_stale_connections(self) -> int:
+        """关闭已经结束的线程留下的连接，返回关闭的数量"""
+        with self._connections_lock:
+            stale = [thread for thread in self._connections if not thread.is_alive()]
+            connections = [self._connections.pop(thread) for thread in stale]
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        return len(connections)
+    
+    @contextmanager
+    def _transaction(self):
+        """在当前线程的连接上开启事务，正常结束时提交，异常时回滚"""
+        conn = self._connect()
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    def close(self):
+        """关闭所有线程的数据库连接"""
+        with self._connections_lock:
+            connections, self._connections = list(self._connections.values()), {}
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
         
     def init_db(self):
         """初始化数据库表"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._transaction() as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS image_hashes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_path TEXT UNIQUE NOT NULL,
+                    hash_value TEXT NOT NULL,
+                    file_size INTEGER,
+                    modified_time REAL,
+                    width INTEGER,
+                    height INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    parent_dir TEXT,
+                    dhash TEXT,
+                    ahash TEXT,
+                    colorhash TEXT,
+                    hash_version INTEGER
+                )
+            ''')
+            
+            self._migrate(cursor)
+            
+            # 创建索引以提高查询性能
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_hash_value ON image_hashes(hash_value)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_path ON image_hashes(file_path)')
+            # 按目录范围查询（parent_dir 等值或区间查找）
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_parent_dir ON image_hashes(parent_dir)')
+            
+            # ORB 描述符缓存：按路径和修改时间保存，特征匹配时无需重新提取
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS image_features (
+                    file_path TEXT PRIMARY KEY,
+                    modified_time REAL,
+                    keypoint_count INTEGER,
+                    descriptors BLOB
+                )
+            ''')
+            
+            # 视觉词汇表（ORB 描述符聚类中心）和每张图片的视觉词袋，用于特征匹配前的候选筛选
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS visual_vocabulary (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    words BLOB NOT NULL,
+                    created_at REAL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS image_words (
+                    file_path TEXT PRIMARY KEY,
+                    modified_time REAL,
+                    word_ids BLOB,
+                    counts BLOB
+                )
+            ''')
+            
+            # 后台索引任务，进程重启后可据此恢复被中断的任务
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS index_jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    created_at REAL,
+                    updated_at REAL
+                )
+            ''')
+        
+        self.load_index()
+    
+    def _migrate(self, cursor: sqlite3.Cursor):
+        """把旧版本数据库升级到 SCHEMA_VERSION"""
+        cursor.execute('PRAGMA user_version')
+        version = cursor.fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        
+        if version < 1:
+            # 版本 1：新增规范化的父目录列，替代 file_path LIKE 'dir%' 的前缀查询
+            cursor.execute('PRAGMA table_info(image_hashes)')
+            columns = {row[1] for row in cursor.fetchall()}
+            if 'parent_dir' not in columns:
+                print("升级数据库: 添加 parent_dir 列")
+                cursor.execute('ALTER TABLE image_hashes ADD COLUMN parent_dir TEXT')
+            cursor.connection.create_function('parent_directory', 1, parent_directory, deterministic=True)
+            cursor.execute('''
+                UPDATE image_hashes SET parent_dir = parent_directory(file_path)
+                WHERE parent_dir IS NULL
+            ''')
         
+        if version < 2:
+            # 版本 2：新增级联搜索使用的廉价签名，旧记录为空，重新完整索引后补齐
+            cursor.execute('PRAGMA table_info(image_hashes)')
+            columns = {row[1] for row in cursor.fetchall()}
+            for column in ('dhash', 'ahash', 'colorhash'):
+                if column not in columns:
+                    print(f"升级数据库: 添加 {column} 列")
+                    cursor.execute(f'ALTER TABLE image_hashes ADD COLUMN {column} TEXT')
+        
+        if version < 3:
+            # 版本 3：记录哈希的计算方式版本；旧记录为空，下次增量索引时重新计算
+            cursor.execute('PRAGMA table_info(image_hashes)')
+            columns = {row[1] for row in cursor.fetchall()}
+            if 'hash_version' not in columns:
+                print("升级数据库: 添加 hash_version 列")
+                cursor.execute('ALTER TABLE image_hashes ADD COLUMN hash_version INTEGER')
+        
+        cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+    
+    @staticmethod
+    def _directory_filter(directory: str) -> Tuple[str, tuple]:
+        """
+        目录范围的 WHERE 条件，包含子目录，不匹配同名前缀的兄弟目录
+        返回: (SQL 条件, 参数)；directory 为空时不限制
+        """
+        scope = directory_range(directory)
+        if scope is None:
+            return '1', ()
+        return 'parent_dir = ? OR (parent_dir >= ? AND parent_dir < ?)', scope
+    
+    @property
+    def generation(self) -> int:
+        """
+        当前索引版本号
+
+        在数据库和内存索引都更新之后才递增：搜索前读取的版本号不会比实际用到的数据更新，
+        按此版本号缓存的结果不会在索引变化后被误用
+        """
+        return self._generation
+    
+    def _bump_generation(self):
+        with self._generation_lock:
+            self._generation += 1
+    
+    def load_index(self):
+        """
+        从数据库加载内存哈希索引（按 id 顺序，与逐行查询的结果顺序一致）
+        快照与数据库一致时直接映射快照；否则从数据库加载后重新导出快照
+        """
+        if self.hash_index is None:
+            return
+        
+        if self._load_snapshot():
+            self._index_loaded = True
+            return
+        
+        cursor = self._connect().cursor()
+        cursor.execute('''
+            SELECT file_path, hash_value, dhash, ahash, colorhash FROM image_hashes ORDER BY id
+        ''')
+        self.hash_index.load(
+            (file_path, hash_value, (dhash, ahash, colorhash))
+            for file_path, hash_value, dhash, ahash, colorhash in cursor
+        )
+        self._index_loaded = True
+        self.export_snapshot()
+    
+    @staticmethod
+    def _fingerprint(cursor: sqlite3.Cursor) -> Tuple[int, int]:
+        """
+        数据库内容的指纹: (记录数, 已分配的最大 id)
+        id 为 AUTOINCREMENT，不会复用：新增或替换记录使最大 id 增加，删除记录使记录数减少
+        """
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS image_hashes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                file_path TEXT UNIQUE NOT NULL,
-                hash_value TEXT NOT NULL,
-                file_size INTEGER,
-                modified_time REAL,
-                width INTEGER,
-                height INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            SELECT COUNT(*), (SELECT seq FROM sqlite_sequence WHERE name = 'image_hashes')
+            FROM image_hashes
         ''')
+        count, last_id = cursor.fetchone()
+        return count, last_id or 0
+    
+    def export_snapshot(self) -> bool:
+        """
+        把数据库中的哈希导出为快照文件（原子替换）；在一个读事务中完成，指纹与内容一致
+        未配置快照或没有 NumPy 时返回 False
+        """
+        if self.snapshot_path is None or self.hash_index is None:
+            return False
+        import numpy as np
         
-        # 创建索引以提高查询性能
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_hash_value ON image_hashes(hash_value)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_path ON image_hashes(file_path)')
+        hash_hex_length = self.hash_index.hash_hex_length
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        try:
+            fingerprint = self._fingerprint(cursor)
+            cursor.execute('''
+                SELECT file_path, hash_value, modified_time, dhash, ahash, colorhash, parent_dir
+                FROM image_hashes ORDER BY id
+            ''')
+            # 与内存索引一样跳过长度不同或无效的哈希
+            rows = [row for row in cursor.fetchall() if len(row[1]) == hash_hex_length]
+        finally:
+            conn.rollback()
+        
+        word_count = self.hash_index.word_count
+        padded_length = word_count * 16
+        try:
+            packed = bytes.fromhex(''.join(row[1].ljust(padded_length, '0') for row in rows))
+        except ValueError:
+            rows = [row for row in rows if self._is_hex(row[1])]
+            packed = bytes.fromhex(''.join(row[1].ljust(padded_length, '0') for row in rows))
+        words = np.frombuffer(packed, dtype='>u8').reshape(len(rows), word_count)
+        
+        signatures = np.zeros((len(rows), len(SIGNATURE_BITS)), dtype=np.uint64)
+        has_signatures = np.zeros(len(rows), dtype=bool)
+        mtimes = np.full(len(rows), np.nan)
+        dir_ids = np.zeros(len(rows), dtype=np.uint32)
+        directories = {}
+        for i, (file_path, _, modified_time, dhash, ahash, colorhash, parent_dir) in enumerate(rows):
+            values = parse_signatures((dhash, ahash, colorhash))
+            if values is not None:
+                signatures[i] = values
+                has_signatures[i] = True
+            if modified_time is not None:
+                mtimes[i] = modified_time
+            if parent_dir is None:
+                parent_dir = parent_directory(file_path)
+            dir_ids[i] = directories.setdefault(parent_dir, len(directories))
+        
+        try:
+            with metrics.stage('snapshot_write'):
+                write_snapshot(self.snapshot_path, hash_hex_length, fingerprint,
+                               [row[0] for row in rows], words, signatures, has_signatures,
+                               mtimes, dir_ids, list(directories))
+        except OSError as e:
+            # 例如 Windows 上快照仍被其他进程映射时无法替换；其他进程检测到快照过期后从数据库加载
+            print(f"导出索引快照失败 {self.snapshot_path}: {str(e)}")
+            return False
+        stat = os.stat(self.snapshot_path)
+        self._snapshot_identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return True
+    
+    @staticmethod
+    def _is_hex(value: str) -> bool:
+        try:
+            int(value, 16)
+            return True
+        except ValueError:
+            return False
+    
+    def _load_snapshot(self) -> bool:
+        """快照存在且与数据库一致时用它重建内存索引"""
+        snapshot = open_snapshot(self.snapshot_path)
+        if snapshot is None:
+            return False
+        
+        self._snapshot_identity = snapshot.identity
+        fingerprint = self._fingerprint(self._connect().cursor())
+        if snapshot.fingerprint != fingerprint or snapshot.hash_hex_length != self.hash_index.hash_hex_length:
+            print(f"索引快照已过期（快照 {snapshot.fingerprint}，数据库 {fingerprint}）")
+            return False
         
-        conn.commit()
-        conn.close()
+        self.hash_index.load_snapshot(snapshot)
+        print(f"从快照加载索引: {snapshot.row_count} 条记录")
+        return True
+    
+    def reload_snapshot_if_changed(self):
+        """
+        快照文件被其他进程替换、且与数据库一致时重新映射（按 snapshot_check_interval 节流）；
+        多个 worker 各自持有内存索引，由此看到其他 worker 索引的记录
+        """
+        if self.snapshot_path is None or not self._index_loaded:
+            return
+        now = time.monotonic()
+        if now < self._next_snapshot_check or not self._snapshot_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_snapshot_check = now + self.snapshot_check_interval
+            try:
+                stat = os.stat(self.snapshot_path)
+            except OSError:
+                return
+            if (stat.st_ino, stat.st_mtime_ns, stat.st_size) == self._snapshot_identity:
+                return
+            if self._load_snapshot():
+                self._bump_generation()
+        finally:
+            self._snapshot_lock.release()
     
     def add_image_hash(self, file_path: str, hash_value: str, file_size: int, 
                       modified_time: float, width: int, height: int):
         """添加或更新图片哈希"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO image_hashes 
+                (file_path, hash_value, file_size, modified_time, width, height, parent_dir, hash_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (file_path, hash_value, file_size, modified_time, width, height,
+                  parent_directory(file_path), self.HASH_VERSION))
+        
+        if self._index_loaded:
+            self.hash_index.add(file_path, hash_value)
+        self._bump_generation()
+    
+    def add_image_hashes(self, records: List[tuple]):
+        """
+        批量添加或更新图片哈希，使用 executemany 在单个事务中写入
+
+        records: (file_path, hash_value, file_size, modified_time, width, height) 列表，
+                 可再附加 (dhash, ahash, colorhash) 三个签名（未计算时为 None）
+        """
+        if not records:
+            return
+        
+        records = [tuple(record) + (None,) * (9 - len(record)) for record in records]
+        with metrics.stage('db_write'), self._transaction() as cursor:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO image_hashes 
+                (file_path, hash_value, file_size, modified_time, width, height,
+                 dhash, ahash, colorhash, parent_dir, hash_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (record + (parent_directory(record[0]), self.HASH_VERSION) for record in records))
+        
+        if self._index_loaded:
+            self.hash_index.add_many((record[0], record[1], record[6:9]) for record in records)
+        self._bump_generation()
+    
+    def add_image_features(self, records: List[tuple]):
+        """
+        批量保存 ORB 描述符
+
+        records: (file_path, modified_time, keypoint_count, descriptors) 列表，
+                 descriptors 为 uint8 的 N×32 数组或 None
+        """
+        if not records:
+            return
+        
+        rows = [(file_path, modified_time, keypoint_count,
+                 descriptors.tobytes() if descriptors is not None else None)
+                for file_path, modified_time, keypoint_count, descriptors in records]
+        
+        with metrics.stage('db_write'), self._transaction() as cursor:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO image_features 
+                (file_path, modified_time, keypoint_count, descriptors)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+    
+    def get_image_features(self, file_paths: List[str]) -> Dict[str, tuple]:
+        """
+        读取一批图片的 ORB 描述符缓存
+
+        返回: {file_path: (modified_time, keypoint_count, descriptors)}
+        """
+        import numpy as np
+        
+        features = {}
+        cursor = self._connect().cursor()
+        for i in range(0, len(file_paths), 500):
+            chunk = file_paths[i:i + 500]
+            with metrics.stage('db_query'):
+                cursor.execute(f'''
+                    SELECT file_path, modified_time, keypoint_count, descriptors FROM image_features 
+                    WHERE file_path IN ({",".join("?" * len(chunk))})
+                ''', chunk)
+                rows = cursor.fetchall()
+            for file_path, modified_time, keypoint_count, blob in rows:
+                descriptors = np.frombuffer(blob, dtype=np.uint8).reshape(-1, 32) if blob else None
+                features[file_path] = (modified_time, keypoint_count, descriptors)
+        return features
+    
+    def sample_feature_descriptors(self, max_descriptors: int, seed: int = 0) -> "np.ndarray":
+        """
+        从描述符缓存中均匀抽样（蓄水池抽样），用于训练视觉词汇表
+
+        返回: (M, 32) 的 uint8 数组，M 不超过 max_descriptors
+        """
+        import numpy as np
+        
+        rng = np.random.default_rng(seed)
+        sample = np.zeros((max_descriptors, 32), dtype=np.uint8)
+        seen = 0
+        cursor = self._connect().cursor()
+        cursor.execute('SELECT descriptors FROM image_features WHERE descriptors IS NOT NULL')
+        for (blob,) in cursor:
+            descriptors = np.frombuffer(blob, dtype=np.uint8).reshape(-1, 32)
+            count = len(descriptors)
+            fill = min(count, max_descriptors - seen) if seen < max_descriptors else 0
+            if fill:
+                sample[seen:seen + fill] = descriptors[:fill]
+            if fill < count:
+                # 蓄水池抽样：第 i 个描述符以 max_descriptors / (i + 1) 的概率替换已有样本
+                positions = np.arange(seen + fill, seen + count)
+                slots = (rng.random(len(positions)) * (positions + 1)).astype(np.int64)
+                keep = slots < max_descriptors
+                sample[slots[keep]] = descriptors[fill:][keep]
+            seen += count
+        return sample[:min(seen, max_descriptors)].copy()
+    
+    def save_vocabulary(self, words: "np.ndarray"):
+        """保存视觉词汇表，旧的词袋全部失效并被删除"""
+        with self._transaction() as cursor:
+            cursor.execute('INSERT OR REPLACE INTO visual_vocabulary (id, words, created_at) VALUES (1, ?, ?)',
+                           (words.tobytes(), time.time()))
+            cursor.execute('DELETE FROM image_words')
+    
+    def get_vocabulary(self) -> Optional["np.ndarray"]:
+        """读取视觉词汇表，(K, 32) 的 uint8 数组；尚未训练时返回 None"""
+        import numpy as np
         
+        cursor = self._connect().cursor()
+        cursor.execute('SELECT words FROM visual_vocabulary WHERE id = 1')
+        row = cursor.fetchone()
+        return np.frombuffer(row[0], dtype=np.uint8).reshape(-1, 32) if row else None
+    
+    def get_features_without_words(self) -> List[str]:
+        """已缓存描述符、但还没有（或只有过期的）视觉词袋的图片"""
+        cursor = self._connect().cursor()
         cursor.execute('''
-            INSERT OR REPLACE INTO image_hashes 
-            (file_path, hash_value, file_size, modified_time, width, height)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (file_path, hash_value, file_size, modified_time, width, height))
+            SELECT f.file_path FROM image_features f
+            LEFT JOIN image_words w ON w.file_path = f.file_path
+            WHERE f.descriptors IS NOT NULL
+              AND (w.file_path IS NULL OR w.modified_time != f.modified_time)
+        ''')
+        return [row[0] for row in cursor.fetchall()]
+    
+    def add_image_words(self, records: List[tuple]):
+        """
+        批量保存视觉词袋
+
+        records: (file_path, modified_time, word_ids, counts) 列表，word_ids 为 uint32 数组，counts 为 uint16 数组
+        """
+        if not records:
+            return
+        with metrics.stage('db_write'), self._transaction() as cursor:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO image_words (file_path, modified_time, word_ids, counts)
+                VALUES (?, ?, ?, ?)
+            ''', [(file_path, modified_time, word_ids.tobytes(), counts.tobytes())
+                  for file_path, modified_time, word_ids, counts in records])
+    
+    def iter_image_words(self) -> Iterator[tuple]:
+        """逐个产出 (file_path, word_ids, counts)"""
+        import numpy as np
         
-        conn.commit()
-        conn.close()
+        cursor = self._connect().cursor()
+        cursor.execute('SELECT file_path, word_ids, counts FROM image_words')
+        for file_path, word_ids, counts in cursor:
+            yield file_path, np.frombuffer(word_ids, dtype=np.uint32), np.frombuffer(counts, dtype=np.uint16)
     
     def find_similar_images(self, query_hash: str, directory: str, 
-                          threshold: float) -> List[Tuple[str, str, float]]:
-        """查找相似图片"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+                          threshold: float, top_k: Optional[int] = None,
+                          stats: Optional[dict] = None,
+                          signatures: Optional[tuple] = None,
+                          signature_threshold: Optional[float] = None) -> List[Tuple[str, str, float]]:
+        """
+        查找相似图片
+
+        top_k: 只返回相似度最高的 k 张（部分选择，不对全部结果排序）
+        stats: 传入字典时写入本次查询访问的候选数量（backend/candidates/total）
+               以及 top_k 截断之前的结果数量（matched）
+        signatures: 查询图片的 (dhash, ahash, colorhash)，提供时使用级联搜索（需要内存索引），
+                    signature_threshold 为各签名的相似度阈值，应低于 threshold
+        返回: 按相似度降序排列的 (file_path, hash_value, similarity) 列表
+        """
+        self.reload_snapshot_if_changed()
+        if self._index_loaded and len(query_hash) == self.hash_index.hash_hex_length:
+            if signatures is not None:
+                return self._find_similar_by_cascade(query_hash, signatures, directory, threshold,
+                                                     signature_threshold, top_k, stats)
+            return self._find_similar_in_index(query_hash, directory, threshold, top_k, stats)
         
-        # 获取指定目录下的所有图片
-        cursor.execute('''
-            SELECT file_path, hash_value FROM image_hashes 
-            WHERE file_path LIKE ?
-        ''', (f"{directory}%",))
+        return self._find_similar_in_db(query_hash, directory, threshold, stats, top_k)
+    
+    def find_similar_images_batch(self, query_hashes: List[str], directory: str, threshold: float,
+                                  top_k: Optional[int] = None,
+                                  stats: Optional[dict] = None) -> List[List[Tuple[str, str, float]]]:
+        """
+        批量查找相似图片，全部查询只扫描一次索引
+
+        stats: 传入字典时写入本次批量查询的 backend/queries/candidates/total
+        返回: 与 query_hashes 同序的结果列表，每项与 find_similar_images 的返回值相同
+        """
+        self.reload_snapshot_if_changed()
+        results = [None] * len(query_hashes)
+        if self._index_loaded:
+            batch = [i for i, query_hash in enumerate(query_hashes)
+                     if len(query_hash) == self.hash_index.hash_hex_length]
+            if batch:
+                hash_bits = self.hash_index.hash_bits
+                with metrics.stage('compare'):
+                    matches = self.hash_index.search_batch(
+                        [query_hashes[i] for i in batch], max_distance_for(threshold, hash_bits),
+                        directory, top_k, stats
+                    )
+                for i, query_matches in zip(batch, matches):
+                    results[i] = [(file_path, stored_hash, 1.0 - (distance / hash_bits))
+                                  for file_path, stored_hash, distance in query_matches]
         
-        results = []
-        query_hash_obj = imagehash.hex_to_hash(query_hash)
+        rest = [i for i, result in enumerate(results) if result is None]
+        if rest:
+            db_results = self._find_similar_in_db_batch([query_hashes[i] for i in rest], directory,
+                                                        threshold, stats if len(rest) == len(results) else None,
+                                                        top_k)
+            for i, query_results in zip(rest, db_results):
+                results[i] = query_results
+        return results
+    
+    def get_index_stats(self) -> dict:
+        """内存索引的累计查询统计"""
+        if not self._index_loaded:
+            return {'backend': 'sqlite'}
+        return self.hash_index.get_stats()
+    
+    def _find_similar_in_index(self, query_hash: str, directory: str, threshold: float,
+                               top_k: Optional[int], stats: Optional[dict]) -> List[Tuple[str, str, float]]:
+        """在内存索引中向量化查找"""
+        hash_bits = self.hash_index.hash_bits
+        max_distance = max_distance_for(threshold, hash_bits)
+        if max_distance < 0:
+            return []
         
-        for file_path, stored_hash in cursor.fetchall():
-            try:
-                stored_hash_obj = imagehash.hex_to_hash(stored_hash)
-                # 计算汉明距离，转换为相似度
-                hamming_distance = query_hash_obj - stored_hash_obj
-                max_distance = len(query_hash) * 4  # 每个hex字符代表4位
-                similarity = 1.0 - (hamming_distance / max_distance)
+        with metrics.stage('compare'):
+            matches = self.hash_index.search(query_hash, max_distance, directory, top_k, stats)
+        return [(file_path, stored_hash, 1.0 - (distance / hash_bits))
+                for file_path, stored_hash, distance in matches]
+    
+    def _find_similar_by_cascade(self, query_hash: str, signatures: tuple, directory: str,
+                                 threshold: float, signature_threshold: Optional[float],
+                                 top_k: Optional[int], stats: Optional[dict]) -> List[Tuple[str, str, float]]:
+        """先用廉价签名排除候选，再按 pHash 计算相似度"""
+        hash_bits = self.hash_index.hash_bits
+        max_distance = max_distance_for(threshold, hash_bits)
+        if max_distance < 0:
+            return []
+        if signature_threshold is None:
+            signature_threshold = threshold
+        signature_max_distances = tuple(max(0, max_distance_for(signature_threshold, bits))
+                                        for bits in SIGNATURE_BITS)
+        
+        with metrics.stage('compare'):
+            matches = self.hash_index.cascade_search(query_hash, signatures, max_distance,
+                                                     signature_max_distances, directory, top_k, stats)
+        return [(file_path, stored_hash, 1.0 - (distance / hash_bits))
+                for file_path, stored_hash, distance in matches]
+    
+    def _find_similar_in_db(self, query_hash: str, directory: str, threshold: float,
+                            stats: Optional[dict] = None,
+                            top_k: Optional[int] = None) -> List[Tuple[str, str, float]]:
+        """逐行解析数据库中的哈希并比较（未加载内存索引时使用）"""
+        matched_counts = []
+        results = self._find_similar_in_db_batch([query_hash], directory, threshold, stats, top_k,
+                                                 matched_counts)[0]
+        if stats is not None:
+            stats['matched'] = matched_counts[0]
+        return results
+    
+    def _find_similar_in_db_batch(self, query_hashes: List[str], directory: str, threshold: float,
+                                  stats: Optional[dict] = None, top_k: Optional[int] = None,
+                                  matched_counts: Optional[list] = None) -> List[List[Tuple[str, str, float]]]:
+        """
+        读取一次目录范围内的哈希，逐行与每个查询比较
+        top_k 用堆选出相似度最高的 k 条；matched_counts 传入列表时追加每个查询截断前的结果数量
+        """
+        cursor = self._connect().cursor()
+        
+        # 获取指定目录下的所有图片
+        condition, params = self._directory_filter(directory)
+        with metrics.stage('db_query'):
+            cursor.execute(f'''
+                SELECT file_path, hash_value FROM image_hashes 
+                WHERE {condition}
+            ''', params)
+            rows = cursor.fetchall()
+        
+        all_results = []
+        with metrics.stage('compare'):
+            stored_hashes = []
+            for file_path, stored_hash in rows:
+                try:
+                    stored_hashes.append((file_path, stored_hash, imagehash.hex_to_hash(stored_hash)))
+                except Exception:
+                    continue
+            
+            for query_hash in query_hashes:
+                results = []
+                try:
+                    query_hash_obj = imagehash.hex_to_hash(query_hash)
+                except Exception:
+                    if matched_counts is not None:
+                        matched_counts.append(0)
+                    all_results.append(results)
+                    continue
                 
-                if similarity >= threshold:
-                    results.append((file_path, stored_hash, similarity))
-            except Exception:
-                continue
+                for file_path, stored_hash, stored_hash_obj in stored_hashes:
+                    try:
+                        # 计算汉明距离，转换为相似度
+                        hamming_distance = query_hash_obj - stored_hash_obj
+                        max_distance = len(query_hash) * 4  # 每个hex字符代表4位
+                        similarity = 1.0 - (hamming_distance / max_distance)
+                        
+                        if similarity >= threshold:
+                            results.append((file_path, stored_hash, similarity))
+                    except Exception:
+                        continue
+                
+                if matched_counts is not None:
+                    matched_counts.append(len(results))
+                # 按相似度降序排序；与排序后截取前 k 条的结果相同
+                if top_k is not None:
+                    results = heapq.nlargest(top_k, results, key=lambda x: x[2])
+                else:
+                    results.sort(key=lambda x: x[2], reverse=True)
+                all_results.append(results)
         
-        # 按相似度降序排序
-        results.sort(key=lambda x: x[2], reverse=True)
-        conn.close()
+        if stats is not None:
+            stats.update({'backend': 'sqlite', 'candidates': len(rows), 'total': len(rows)})
         
-        return results
+        return all_results
+    
+    def get_hash_matrix(self, directory: str = "") -> Tuple[List[str], "np.ndarray"]:
+        """
+        获取目录范围内全部图片的路径和打包后的哈希矩阵（需要 NumPy），用于批量去重
+
+        返回: (路径列表, (N, word_count) 的 uint64 矩阵)，按 id 顺序
+        """
+        if not NUMPY_AVAILABLE:
+            raise Exception("批量去重需要安装 NumPy")
+        if self._index_loaded:
+            return self.hash_index.snapshot(directory)
+        
+        # 未启用内存索引时，临时建立一个只包含目录范围内记录的索引
+        index = HashIndex()
+        cursor = self._connect().cursor()
+        condition, params = self._directory_filter(directory)
+        cursor.execute(f'''
+            SELECT file_path, hash_value FROM image_hashes 
+            WHERE {condition} ORDER BY id
+        ''', params)
+        index.load(cursor)
+        return index.snapshot()
     
     def get_total_images(self) -> int:
         """获取索引中的图片总数"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        if self._index_loaded:
+            return len(self.hash_index)
+        cursor = self._connect().cursor()
         cursor.execute('SELECT COUNT(*) FROM image_hashes')
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        return cursor.fetchone()[0]
     
     def clear_all(self):
         """清空所有索引"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM image_hashes')
-        conn.commit()
-        conn.close()
+        with self._transaction() as cursor:
+            cursor.execute('DELETE FROM image_hashes')
+            cursor.execute('DELETE FROM image_features')
+            cursor.execute('DELETE FROM image_words')
+        
+        if self._index_loaded:
+            self.hash_index.clear()
+        self._bump_generation()
     
     def remove_missing_files(self):
         """删除不存在的文件记录"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        cursor = self._connect().cursor()
         cursor.execute('SELECT id, file_path FROM image_hashes')
         to_remove = []
+        removed_paths = []
         
         for image_id, file_path in cursor.fetchall():
             if not os.path.exists(file_path):
                 to_remove.append(image_id)
+                removed_paths.append(file_path)
         
         if to_remove:
-            cursor.execute(f'DELETE FROM image_hashes WHERE id IN ({",".join("?" * len(to_remove))})', to_remove)
-            conn.commit()
+            with self._transaction() as cursor:
+                # 分批删除，避免超过 SQLite 的参数数量限制
+                for i in range(0, len(to_remove), 500):
+                    chunk = to_remove[i:i + 500]
+                    cursor.execute(f'DELETE FROM image_hashes WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+                for i in range(0, len(removed_paths), 500):
+                    chunk = removed_paths[i:i + 500]
+                    cursor.execute(f'DELETE FROM image_features WHERE file_path IN ({",".join("?" * len(chunk))})', chunk)
+                    cursor.execute(f'DELETE FROM image_words WHERE file_path IN ({",".join("?" * len(chunk))})', chunk)
         
-        conn.close()
+        if self._index_loaded:
+            self.hash_index.remove(removed_paths)
+        if to_remove:
+            self._bump_generation()
         return len(to_remove)
     
     def get_images_in_directory(self, directory: str) -> List[Tuple[str, str]]:
         """获取指定目录中已索引的图片"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        cursor = self._connect().cursor()
+        condition, params = self._directory_filter(directory)
+        cursor.execute(f'''
             SELECT file_path, hash_value FROM image_hashes 
-            WHERE file_path LIKE ?
-        ''', (f"{directory}%",))
+            WHERE {condition}
+        ''', params)
+        return cursor.fetchall()
+    
+    def get_file_states(self, directory: str) -> Dict[str, Tuple[Optional[int], Optional[float]]]:
+        """
+        一次性获取目录下已索引文件的 (大小, 修改时间)，用于增量索引
+
+        哈希计算方式版本不是 HASH_VERSION 的记录返回 (None, None)，与任何文件都不一致，
+        增量索引时会重新计算
+        """
+        cursor = self._connect().cursor()
+        condition, params = self._directory_filter(directory)
+        cursor.execute(f'''
+            SELECT file_path, file_size, modified_time, hash_version FROM image_hashes 
+            WHERE {condition}
+        ''', params)
+        
+        return {file_path: (file_size, modified_time) if hash_version == self.HASH_VERSION else (None, None)
+                for file_path, file_size, modified_time, hash_version in cursor.fetchall()}
+    
+    def remove_images(self, file_paths: List[str]) -> int:
+        """删除指定路径的索引记录"""
+        if not file_paths:
+            return 0
+        
+        removed = 0
+        with self._transaction() as cursor:
+            # 分批删除，避免超过 SQLite 的参数数量限制
+            for i in range(0, len(file_paths), 500):
+                chunk = file_paths[i:i + 500]
+                cursor.execute(f'DELETE FROM image_hashes WHERE file_path IN ({",".join("?" * len(chunk))})', chunk)
+                removed += cursor.rowcount
+                cursor.execute(f'DELETE FROM image_features WHERE file_path IN ({",".join("?" * len(chunk))})', chunk)
+                cursor.execute(f'DELETE FROM image_words WHERE file_path IN ({",".join("?" * len(chunk))})', chunk)
         
-        results = cursor.fetchall()
-        conn.close()
-        return results
\ No newline at end of file
+        if self._index_loaded:
+            self.hash_index.remove(file_paths)
+        if removed:
+            self._bump_generation()
+        return removed
+    
+    def save_index_job(self, job: dict):
+        """保存（插入或更新）后台索引任务"""
+        with self._transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO index_jobs (id, status, data, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (job['id'], job['status'], json.dumps(job, ensure_ascii=False),
+                  job.get('created_at'), time.time()))
+    
+    def update_index_job(self, job: dict, expected_status: str) -> bool:
+        """
+        只有数据库中的任务状态仍为 expected_status 时才保存（原子地转换状态），
+        返回是否保存成功；多个进程同时接管同一任务时只有一个成功
+        """
+        with self._transaction() as cursor:
+            cursor.execute('''
+                UPDATE index_jobs SET status = ?, data = ?, updated_at = ?
+                WHERE id = ? AND status = ?
+            ''', (job['status'], json.dumps(job, ensure_ascii=False), time.time(),
+                  job['id'], expected_status))
+            return cursor.rowcount == 1
+    
+    def get_index_job(self, job_id: str) -> Optional[dict]:
+        """获取单个后台索引任务"""
+        cursor = self._connect().cursor()
+        cursor.execute('SELECT data FROM index_jobs WHERE id = ?', (job_id,))
+        row = cursor.fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def get_index_jobs(self, statuses: Optional[List[str]] = None) -> List[dict]:
+        """按创建时间获取后台索引任务，可按状态过滤"""
+        cursor = self._connect().cursor()
+        if statuses:
+            cursor.execute(f'''
+                SELECT data FROM index_jobs WHERE status IN ({",".join("?" * len(statuses))})
+                ORDER BY created_at
+            ''', statuses)
+        else:
+            cursor.execute('SELECT data FROM index_jobs ORDER BY created_at')
+        return [json.loads(data) for (data,) in cursor.fetchall()]
@@ -0,0 +1,420 @@
+import csv
+import io
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from hash_index import NUMPY_AVAILABLE, MultiIndexHash, max_distance_for, popcount
+
+if NUMPY_AVAILABLE:
+    import numpy as np
+
+
+class UnionFind:
+    """数组实现的并查集，根节点取集合中最小的下标，结果与合并顺序无关"""
+
+    def __init__(self, size: int):
+        self.parent = np.arange(size, dtype=np.int64)
+
+    def find(self, x: int) -> int:
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return int(x)
+
+    def roots(self, items):
+        """向量化地求一组元素的根（指针跳跃）"""
+        roots = self.parent[items]
+        while True:
+            next_roots = self.parent[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
+
+    def union_pairs(self, left, right) -> int:
+        """合并成对的元素，返回实际发生的合并次数"""
+        left_roots = self.roots(left)
+        right_roots = self.roots(right)
+        pending = left_roots != right_roots
+        merged = 0
+        for a, b in zip(left_roots[pending].tolist(), right_roots[pending].tolist()):
+            a = self.find(a)
+            b = self.find(b)
+            if a != b:
+                if a < b:
+                    self.parent[b] = a
+                else:
+                    self.parent[a] = b
+                merged += 1
+        return merged
+
+    def compress(self):
+        """压缩路径，使每个元素直接指向根"""
+        self.parent = self.roots(np.arange(len(self.parent)))
+
+
+class DuplicateFinder:
+    """
+    在全部哈希中查找重复图片组
+
+    1. 完全相同的哈希先合并为一行
+    2. 'bands' 方法：把 256 位哈希切分为 band_count 段，距离 <= r 的两个哈希至少有一段
+       的距离 <= r // band_count（抽屉原理），只比较这些段碰撞的候选对，结果与全量比较一致；
+       每段枚举量过大（阈值过宽）时自动改用 'exact'
+    3. 'exact' 方法：分块向量化计算全部两两距离，复杂度 O(N²)，用于校验或小规模数据
+    4. 距离不超过阈值的对用并查集合并为组
+
+    候选对和距离矩阵都分块处理，内存占用有上限
+    """
+
+    # 每次校验的候选对数量
+    PAIR_BLOCK = 1 << 20
+    # exact 方法的分块大小（行 × 列）
+    EXACT_ROW_BLOCK = 512
+    EXACT_COLUMN_BLOCK = 4096
+
+    def __init__(self, band_count: int = 16):
+        self.band_count = band_count
+
+    def find_groups(self, words, threshold: float, exact: bool = False,
+                    progress: Optional[Callable[[dict], None]] = None,
+                    cancel_event: Optional[threading.Event] = None,
+                    stats: Optional[dict] = None) -> List[List[int]]:
+        """
+        words: (N, word_count) 的 uint64 哈希矩阵
+        threshold: 相似度阈值，与 /api/search 含义相同
+        progress: 以 {'stage', 'done', 'total'} 调用
+        stats: 传入字典时写入使用的方法、候选对数量和校验通过的对数量
+        返回: 重复组列表（每组至少两个元素），组内为按升序排列的行号，
+              组按大小降序、首个行号升序排列
+        """
+        hash_bits = words.shape[1] * 64
+        max_distance = max_distance_for(threshold, hash_bits)
+        counters = {'method': 'exact' if exact else 'bands', 'unique_hashes': 0,
+                    'candidate_pairs': 0, 'matched_pairs': 0}
+        if len(words) < 2 or max_distance < 0:
+            if stats is not None:
+                stats.update(counters)
+            return []
+
+        # 完全相同的哈希合并为一行，避免大量重复图片产生平方级的候选对
+        unique_words, inverse = np.unique(words, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        counters['unique_hashes'] = len(unique_words)
+        union_find = UnionFind(len(unique_words))
+
+        mih = None
+        radius = None
+        if not exact:
+            mih = MultiIndexHash(words.shape[1], self.band_count)
+            radius = mih.probe_radius(max_distance)
+            if radius is None:
+                counters['method'] = 'exact'
+
+        if counters['method'] == 'bands':
+            self._match_bands(unique_words, mih, radius, max_distance, union_find,
+                              counters, progress, cancel_event)
+        else:
+            self._match_exact(unique_words, max_distance, union_find,
+                              counters, progress, cancel_event)
+
+        if stats is not None:
+            stats.update(counters)
+
+        union_find.compress()
+        roots = union_find.parent[inverse]
+        order = np.argsort(roots, kind='stable')
+        boundaries = np.flatnonzero(np.diff(roots[order])) + 1
+        group_starts = np.concatenate([[0], boundaries])
+        group_ends = np.concatenate([boundaries, [len(order)]])
+        groups = [order[start:end].tolist()
+                  for start, end in zip(group_starts.tolist(), group_ends.tolist())
+                  if end - start >= 2]
+        groups.sort(key=lambda group: (-len(group), group[0]))
+        return groups
+
+    def _verify(self, columns, left, right, max_distance: int,
+                union_find: UnionFind, counters: dict):
+        """
+        计算候选对的汉明距离，合并满足阈值的对
+        逐个字累加距离，超过阈值的对立即丢弃，大部分随机碰撞只需比较一个字
+        """
+        counters['candidate_pairs'] += len(left)
+        distances = np.zeros(len(left), dtype=np.int32)
+        for column in columns:
+            distances += popcount(column[left] ^ column[right])
+            matched = distances <= max_distance
+            if not matched.all():
+                left = left[matched]
+                right = right[matched]
+                distances = distances[matched]
+        counters['matched_pairs'] += len(left)
+        union_find.union_pairs(left, right)
+
+    def _match_bands(self, unique_words, mih: MultiIndexHash, radius: int, max_distance: int,
+                     union_find: UnionFind, counters: dict,
+                     progress: Optional[Callable[[dict], None]],
+                     cancel_event: Optional[threading.Event]):
+        band_values = mih.band_values(unique_words)
+        masks = mih.flip_masks(radius)
+        columns = [np.ascontiguousarray(unique_words[:, word]) for word in range(unique_words.shape[1])]
+        for band in range(mih.band_count):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            if progress is not None:
+                progress({'stage': 'bands', 'done': band, 'total': mih.band_count})
+
+            values = band_values[:, band]
+            order = np.argsort(values, kind='stable')
+            bucket_values, starts, counts = np.unique(values[order], return_index=True,
+                                                      return_counts=True)
+
+            for mask in masks.tolist():
+                if mask == 0:
+                    # 同一桶内的所有组合
+                    left_buckets = np.flatnonzero(counts >= 2)
+                    right_buckets = left_buckets
+                else:
+                    # 与取值相差 mask 的桶配对，每对桶只处理一次
+                    targets = bucket_values ^ np.uint64(mask)
+                    positions = np.searchsorted(bucket_values, targets)
+                    positions[positions >= len(bucket_values)] = 0
+                    found = (bucket_values[positions] == targets) & (targets > bucket_values)
+                    left_buckets = np.flatnonzero(found)
+                    right_buckets = positions[found]
+
+                for left, right in self._bucket_pairs(order, starts, counts,
+                                                      left_buckets, right_buckets, mask == 0):
+                    if cancel_event is not None and cancel_event.is_set():
+                        return
+                    self._verify(columns, left, right, max_distance, union_find, counters)
+
+            union_find.compress()
+
+        if progress is not None:
+            progress({'stage': 'bands', 'done': mih.band_count, 'total': mih.band_count})
+
+    def _bucket_pairs(self, order, starts, counts, left_buckets, right_buckets, same_bucket: bool):
+        """
+        分块产出两组桶之间的所有行对（笛卡尔积），每块约 PAIR_BLOCK 对
+        same_bucket=True 时左右为同一个桶，只产出 左 < 右 的组合
+        """
+        left_counts = counts[left_buckets].astype(np.int64)
+        right_counts = counts[right_buckets].astype(np.int64)
+        sizes = left_counts * right_counts
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+
+        start = 0
+        while start < len(sizes):
+            end = int(np.searchsorted(offsets, offsets[start] + self.PAIR_BLOCK, side='right')) - 1
+            if end <= start:
+                # 单个桶对超过一块：按左侧行分段
+                left_start = starts[left_buckets[start]]
+                right_start = starts[right_buckets[start]]
+                left_count = int(left_counts[start])
+                right_count = int(right_counts[start])
+                step = max(1, self.PAIR_BLOCK // right_count)
+                for first in range(0, left_count, step):
+                    rows = np.arange(first, min(first + step, left_count), dtype=np.int64)
+                    left = np.repeat(left_start + rows, right_count)
+                    right = np.tile(right_start + np.arange(right_count, dtype=np.int64), len(rows))
+                    yield from self._emit_pairs(order, left, right, same_bucket)
+                start += 1
+                continue
+
+            block_sizes = sizes[start:end]
+            pair = np.repeat(np.arange(start, end), block_sizes)
+            local = np.arange(int(offsets[end] - offsets[start]), dtype=np.int64) \
+                - np.repeat(offsets[start:end] - offsets[start], block_sizes)
+            left = starts[left_buckets[pair]] + local // right_counts[pair]
+            right = starts[right_buckets[pair]] + local % right_counts[pair]
+            yield from self._emit_pairs(order, left, right, same_bucket)
+            start = end
+
+    @staticmethod
+    def _emit_pairs(order, left, right, same_bucket: bool):
+        if same_bucket:
+            keep = left < right
+            left = left[keep]
+            right = right[keep]
+        if len(left):
+            yield order[left], order[right]
+
+    def _match_exact(self, unique_words, max_distance: int, union_find: UnionFind,
+                     counters: dict, progress: Optional[Callable[[dict], None]],
+                     cancel_event: Optional[threading.Event]):
+        size = len(unique_words)
+        for row_start in range(0, size, self.EXACT_ROW_BLOCK):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            if progress is not None:
+                progress({'stage': 'exact', 'done': row_start, 'total': size})
+
+            row_end = min(row_start + self.EXACT_ROW_BLOCK, size)
+            row_words = unique_words[row_start:row_end]
+            # 只比较右上三角（列号大于行号）
+            for column_start in range(row_start, size, self.EXACT_COLUMN_BLOCK):
+                column_end = min(column_start + self.EXACT_COLUMN_BLOCK, size)
+                distances = popcount(
+                    row_words[:, None, :] ^ unique_words[None, column_start:column_end, :]
+                ).sum(axis=2, dtype=np.int32)
+                left, right = np.nonzero(distances <= max_distance)
+                left += row_start
+                right += column_start
+                keep = left < right
+                left = left[keep]
+                right = right[keep]
+                counters['candidate_pairs'] += (row_end - row_start) * (column_end - column_start)
+                counters['matched_pairs'] += len(left)
+                union_find.union_pairs(left, right)
+
+        if progress is not None:
+            progress({'stage': 'exact', 'done': size, 'total': size})
+
+
+class DedupeJobManager:
+    """
+    后台去重任务
+
+    任务在单独的线程中依次执行，结果只保存在内存中（最近 MAX_JOBS 个）
+    """
+
+    MAX_JOBS = 10
+
+    def __init__(self, db_manager, band_count: int = 16):
+        self.db_manager = db_manager
+        self.finder = DuplicateFinder(band_count)
+        self._jobs = {}
+        self._results = {}
+        self._cancel_events = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dedupe")
+
+    def submit(self, directory: str, threshold: float, exact: bool = False) -> dict:
+        """提交去重任务"""
+        if not NUMPY_AVAILABLE:
+            raise Exception("批量去重需要安装 NumPy")
+
+        job = {
+            'id': uuid.uuid4().hex[:12],
+            'directory': directory,
+            'similarity_threshold': threshold,
+            'exact': exact,
+            'status': 'queued',
+            'progress': {'stage': 'queued', 'done': 0, 'total': 0},
+            'summary': None,
+            'error': None,
+            'created_at': time.time(),
+            'finished_at': None
+        }
+        with self._lock:
+            self._jobs[job['id']] = job
+            self._cancel_events[job['id']] = threading.Event()
+            self._prune()
+        self._executor.submit(self._run, job['id'])
+        return self.get(job['id'])
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = dict(job)
+            snapshot['progress'] = dict(job['progress'])
+            return snapshot
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            job_ids = sorted(self._jobs, key=lambda job_id: self._jobs[job_id]['created_at'])
+        return [self.get(job_id) for job_id in job_ids]
+
+    def cancel(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job['status'] in ('queued', 'running'):
+                self._cancel_events[job_id].set()
+                if job['status'] == 'queued':
+                    # 排队中的任务不会再由 _run 结束，这里记录结束时间，使 _prune 能清理它
+                    job['status'] = 'cancelled'
+                    job['finished_at'] = time.time()
+        return self.get(job_id)
+
+    def get_groups(self, job_id: str) -> Optional[List[List[str]]]:
+        """已完成任务的重复组（路径列表）"""
+        with self._lock:
+            return self._results.get(job_id)
+
+    def shutdown(self):
+        with self._lock:
+            for event in self._cancel_events.values():
+                event.set()
+        self._executor.shutdown(wait=True)
+
+    def _prune(self):
+        """只保留最近的 MAX_JOBS 个已结束任务（调用方需持有锁）"""
+        finished = sorted((job for job in self._jobs.values() if job['finished_at'] is not None),
+                          key=lambda job: job['created_at'])
+        for job in finished[:max(0, len(finished) - self.MAX_JOBS)]:
+            self._jobs.pop(job['id'], None)
+            self._results.pop(job['id'], None)
+            self._cancel_events.pop(job['id'], None)
+
+    def _run(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != 'queued':
+                return
+            job['status'] = 'running'
+            cancel_event = self._cancel_events[job_id]
+
+        def on_progress(progress: dict):
+            with self._lock:
+                job['progress'] = progress
+
+        started = time.monotonic()
+        try:
+            on_progress({'stage': 'loading', 'done': 0, 'total': 0})
+            paths, words = self.db_manager.get_hash_matrix(job['directory'])
+            stats = {}
+            groups = self.finder.find_groups(
+                words, job['similarity_threshold'], exact=job['exact'],
+                progress=on_progress, cancel_event=cancel_event, stats=stats
+            )
+            path_groups = [[paths[row] for row in group] for group in groups]
+            with self._lock:
+                if cancel_event.is_set():
+                    job['status'] = 'cancelled'
+                else:
+                    job['status'] = 'completed'
+                    self._results[job_id] = path_groups
+                    job['summary'] = {
+                        'images': len(paths),
+                        'groups': len(path_groups),
+                        'duplicates': sum(len(group) - 1 for group in path_groups),
+                        'elapsed': time.monotonic() - started,
+                        **stats
+                    }
+        except Exception as e:
+            print(f"去重任务失败 {job_id}: {str(e)}")
+            with self._lock:
+                job['status'] = 'failed'
+                job['error'] = str(e)
+        finally:
+            with self._lock:
+                job['finished_at'] = time.time()
+
+
+def export_groups_csv(groups: List[List[str]]) -> str:
+    """把重复组导出为 CSV（group_id, file_path），每个文件一行"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['group_id', 'file_path'])
+    for group_id, group in enumerate(groups, 1):
+        for file_path in group:
+            writer.writerow([group_id, file_path])
+    return output.getvalue()
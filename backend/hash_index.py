@@ -0,0 +1,792 @@
+import threading
+from bisect import bisect_left
+from itertools import combinations, chain
+from typing import List, Tuple, Optional, Iterable
+
+from path_scope import parent_directory, directory_range
+
+# NumPy 为可选依赖，未安装时 DatabaseManager 回退到逐行比较
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+def hex_to_words(hash_hex: str, word_count: int):
+    """把十六进制哈希字符串转换为 uint64 数组（每 16 个 hex 字符为一个字）"""
+    padded = hash_hex.ljust(word_count * 16, '0')
+    return np.array([int(padded[i * 16:(i + 1) * 16], 16) for i in range(word_count)],
+                    dtype=np.uint64)
+
+
+if NUMPY_AVAILABLE and hasattr(np, 'bitwise_count'):
+    def popcount(values):
+        """逐元素统计 uint64 中置位的比特数"""
+        return np.bitwise_count(values)
+elif NUMPY_AVAILABLE:
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(values):
+        """逐元素统计 uint64 中置位的比特数（旧版 NumPy 使用查表法）"""
+        values = np.ascontiguousarray(values, dtype=np.uint64)
+        counts = _POPCOUNT_TABLE[values.view(np.uint8)]
+        return counts.reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+# 级联搜索使用的廉价签名（与数据库中的列同序）及其有效位数
+SIGNATURE_TYPES = ('dhash', 'ahash', 'colorhash')
+SIGNATURE_BITS = (64, 64, 42)
+
+
+def parse_signatures(signatures) -> Optional[List[int]]:
+    """把 (dhash, ahash, colorhash) 十六进制字符串转换为整数，任一缺失或无效时返回 None"""
+    if not signatures or len(signatures) != len(SIGNATURE_TYPES):
+        return None
+    try:
+        values = [int(value, 16) for value in signatures]
+    except (TypeError, ValueError):
+        return None
+    if any(value >> 64 for value in values):
+        return None
+    return values
+
+
+def max_distance_for(threshold: float, hash_bits: int) -> int:
+    """
+    计算满足 1 - d / hash_bits >= threshold 的最大汉明距离 d
+    使用与逐行比较完全相同的浮点运算，保证两种路径结果一致
+    """
+    max_distance = -1
+    for distance in range(hash_bits + 1):
+        if 1.0 - (distance / hash_bits) >= threshold:
+            max_distance = distance
+        else:
+            break
+    return max_distance
+
+
+class MultiIndexHash:
+    """
+    多索引哈希 (Multi-Index Hashing)
+
+    把哈希切分为 band_count 段，每段建立一个排序后的倒排表。
+    若两个哈希的汉明距离 <= r，则至少有一段的距离 <= r // band_count（抽屉原理），
+    因此只需在每段中枚举该半径内的取值，即可得到不漏检的候选集合。
+    """
+
+    # 每段最多枚举的取值数，超过时说明阈值过宽，应退回线性扫描
+    # （16 位分段时允许半径 2，即 256 位哈希的距离 <= 47，相似度约 >= 0.82）
+    MAX_PROBES_PER_BAND = 256
+
+    def __init__(self, word_count: int, band_count: int = 16):
+        band_bits = word_count * 64 // band_count
+        if band_bits not in (8, 16, 32) or word_count * 64 % band_count:
+            raise ValueError(f"不支持的分段数: {band_count}")
+
+        self.word_count = word_count
+        self.band_count = band_count
+        self.band_bits = band_bits
+        self.bands_per_word = 64 // band_bits
+        self.size = 0
+        self._sorted_values = []
+        self._sorted_rows = []
+        self._mask_cache = {}
+
+    def band_values(self, words):
+        """提取每一段的取值，返回 (N, band_count) 数组"""
+        mask = np.uint64((1 << self.band_bits) - 1)
+        columns = []
+        for word in range(self.word_count):
+            for part in range(self.bands_per_word):
+                shift = np.uint64(64 - self.band_bits * (part + 1))
+                columns.append((words[:, word] >> shift) & mask)
+        return np.stack(columns, axis=1)
+
+    def build(self, words):
+        """根据哈希矩阵（前 N 行）重建各段的排序表"""
+        values = self.band_values(words)
+        self._sorted_values = []
+        self._sorted_rows = []
+        for band in range(self.band_count):
+            order = np.argsort(values[:, band], kind='stable')
+            self._sorted_values.append(values[order, band])
+            self._sorted_rows.append(order)
+        self.size = len(words)
+
+    def probe_radius(self, max_distance: int) -> Optional[int]:
+        """每段需要枚举的半径；枚举量超出上限时返回 None"""
+        radius = max_distance // self.band_count
+        probes = 0
+        for flipped in range(radius + 1):
+            probes += _comb(self.band_bits, flipped)
+        return radius if probes <= self.MAX_PROBES_PER_BAND else None
+
+    def flip_masks(self, radius: int):
+        """半径 radius 内所有翻转位组合对应的异或掩码（升序，缓存复用）"""
+        masks = self._mask_cache.get(radius)
+        if masks is None:
+            values = [0]
+            for flipped in range(1, radius + 1):
+                for bits in combinations(range(self.band_bits), flipped):
+                    values.append(sum(1 << bit for bit in bits))
+            masks = np.array(sorted(values), dtype=np.uint64)
+            self._mask_cache[radius] = masks
+        return masks
+
+    def candidates(self, query_words, max_distance: int):
+        """
+        返回可能满足距离条件的行号（已去重、升序）
+        半径过大无法高效枚举时返回 None
+        """
+        radius = self.probe_radius(max_distance)
+        if radius is None:
+            return None
+
+        query_values = self.band_values(query_words.reshape(1, -1))[0]
+        masks = self.flip_masks(radius)
+        found = []
+        for band in range(self.band_count):
+            sorted_values = self._sorted_values[band]
+            probes = np.sort(query_values[band] ^ masks)
+            starts = np.searchsorted(sorted_values, probes, side='left')
+            ends = np.searchsorted(sorted_values, probes, side='right')
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                if start < end:
+                    found.append(self._sorted_rows[band][start:end])
+
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+
+def _comb(n: int, k: int) -> int:
+    """组合数 C(n, k)"""
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+class _SnapshotColumn:
+    """
+    从快照加载的一列字符串（路径或十六进制哈希），按行号读取时才解码
+    删除（置为 None）和追加的行记录在进程私有的字典/列表中，快照本身保持只读
+    """
+
+    # take() 读取的行数超过总行数的该比例时整列解码，比逐行解码快
+    BULK_DECODE_RATIO = 0.1
+
+    def __init__(self, count: int, decode, decode_all):
+        self._count = count
+        self._decode = decode
+        self._decode_all = decode_all
+        self._changed = {}
+        self._appended = []
+
+    def __len__(self) -> int:
+        return self._count + len(self._appended)
+
+    def __getitem__(self, row):
+        row = int(row)
+        if row >= self._count:
+            return self._appended[row - self._count]
+        if row in self._changed:
+            return self._changed[row]
+        return self._decode(row)
+
+    def __setitem__(self, row, value):
+        row = int(row)
+        if row >= self._count:
+            self._appended[row - self._count] = value
+        else:
+            self._changed[row] = value
+
+    def append(self, value):
+        self._appended.append(value)
+
+    def take(self, rows: List[int]) -> list:
+        """按行号批量读取"""
+        if len(rows) <= self._count * self.BULK_DECODE_RATIO:
+            return [self[row] for row in rows]
+        values = self._decode_all()
+        for row, value in self._changed.items():
+            values[row] = value
+        values.extend(self._appended)
+        return [values[row] for row in rows]
+
+
+class HashIndex:
+    """
+    常驻内存的感知哈希索引
+
+    每个 256 位 pHash 按 4 个 uint64 打包存放在一个 NumPy 矩阵中，
+    查询时对整个矩阵做一次 XOR + popcount 即可得到全部汉明距离
+    """
+
+    # 初始容量，之后按倍数扩容
+    INITIAL_CAPACITY = 1024
+    # 多索引哈希建立后新增的行超过该比例时重建
+    MIH_REBUILD_RATIO = 0.1
+    # 目录范围内的行数超过总行数的该比例时，直接全量扫描再按目录过滤结果
+    SCOPE_SCAN_RATIO = 0.5
+    # 批量查询时每块距离矩阵的元素数上限（查询数 × 块行数）
+    BATCH_BLOCK_ELEMENTS = 1 << 20
+
+    def __init__(self, hash_hex_length: int = 64, backend: str = 'linear',
+                 mih_band_count: int = 16):
+        """
+        backend: 'linear' 对全部行做向量化扫描；
+                 'mih' 使用多索引哈希只扫描候选行，阈值过宽时自动退回线性扫描
+        """
+        if backend not in ('linear', 'mih'):
+            raise ValueError(f"未知的索引类型: {backend}")
+
+        self.hash_hex_length = hash_hex_length
+        self.hash_bits = hash_hex_length * 4
+        self.word_count = (hash_hex_length + 15) // 16
+        self.backend = backend
+        self._mih = MultiIndexHash(self.word_count, mih_band_count) if backend == 'mih' else None
+        self._lock = threading.RLock()
+        self._query_count = 0
+        self._candidates_visited = 0
+        self._rows_total = 0
+        self.clear()
+
+    def clear(self):
+        """清空索引"""
+        with self._lock:
+            self._words = np.zeros((self.INITIAL_CAPACITY, self.word_count), dtype=np.uint64)
+            self._alive = np.zeros(self.INITIAL_CAPACITY, dtype=bool)
+            # 级联搜索的签名（每种签名一列），没有签名的行在级联中不会被提前排除
+            self._signatures = np.zeros((self.INITIAL_CAPACITY, len(SIGNATURE_TYPES)), dtype=np.uint64)
+            self._has_signatures = np.zeros(self.INITIAL_CAPACITY, dtype=bool)
+            # 每行所在目录在 _dir_names 中的序号，目录范围较大时按序号向量化过滤
+            self._dir_ids = np.zeros(self.INITIAL_CAPACITY, dtype=np.uint32)
+            self._dir_names: List[str] = []
+            self._dir_index = {}
+            self._paths: List[Optional[str]] = []
+            self._hashes: List[Optional[str]] = []
+            # 从快照加载时 _rows 和 _dir_rows 为 None，需要时才由快照建立（见 _materialize）
+            self._snapshot = None
+            self._rows = {}
+            # 按父目录记录行号，目录范围查询只计算范围内的行
+            self._dir_rows = {}
+            self._sorted_dirs = None
+            self._size = 0
+            self._dead = 0
+            self._mih_dirty = True
+
+    def __len__(self) -> int:
+        return self._size - self._dead
+
+    def load(self, rows: Iterable[tuple]):
+        """从 (file_path, hash_value[, signatures]) 序列重建索引"""
+        with self._lock:
+            self.clear()
+            for row in rows:
+                self._append(*row)
+
+    def load_snapshot(self, snapshot):
+        """
+        从 IndexSnapshot 重建索引
+
+        哈希和签名矩阵直接使用快照映射的只读内存（多个进程共享页缓存），
+        之后追加记录时 _grow 把它们复制到进程私有的数组中。
+        路径和十六进制哈希只在返回结果时按行解码；路径到行号、目录到行号的映射
+        在第一次修改（或第一次按目录查询）时才建立，只读的 worker 不必解码整张路径表
+        """
+        from index_snapshot import words_to_hex
+
+        if snapshot.hash_hex_length != self.hash_hex_length:
+            raise ValueError(f"快照的哈希长度 {snapshot.hash_hex_length} 与索引不一致")
+        count = snapshot.row_count
+        words = snapshot.words
+        hash_hex_length = self.hash_hex_length
+        directories = snapshot.directories()
+
+        with self._lock:
+            self.clear()
+            if not count:
+                return
+            self._words = words
+            self._signatures = snapshot.signatures
+            self._has_signatures = snapshot.has_signatures
+            self._dir_ids = snapshot.dir_ids
+            self._dir_names = directories
+            self._dir_index = {directory: i for i, directory in enumerate(directories)}
+            self._alive = np.ones(count, dtype=bool)
+            self._paths = _SnapshotColumn(count, snapshot.path_at, snapshot.paths)
+            self._hashes = _SnapshotColumn(
+                count, lambda row: words_to_hex(words[row:row + 1], hash_hex_length)[0],
+                lambda: words_to_hex(words, hash_hex_length)
+            )
+            self._snapshot = snapshot
+            self._rows = None
+            self._dir_rows = None
+            self._size = count
+
+    def _materialize(self):
+        """从快照加载后第一次修改前建立路径 → 行号的映射（调用方需持有锁）"""
+        if self._rows is None:
+            snapshot = self._snapshot
+            self._rows = dict(zip(snapshot.paths(), range(snapshot.row_count)))
+            self._build_dir_rows()
+
+    def _build_dir_rows(self):
+        """由快照的目录序号建立目录 → 行号的映射（调用方需持有锁）"""
+        if self._dir_rows is not None:
+            return
+        snapshot = self._snapshot
+        # 按目录序号稳定排序后切分，每个目录的行号保持升序
+        order = np.argsort(snapshot.dir_ids, kind='stable')
+        bounds = np.cumsum(np.bincount(snapshot.dir_ids, minlength=snapshot.dir_count))[:-1]
+        self._dir_rows = {directory: rows for directory, rows
+                          in zip(self._dir_names, np.split(order, bounds)) if len(rows)}
+
+    def add(self, file_path: str, hash_value: str, signatures: Optional[tuple] = None):
+        """添加或更新一条记录，signatures 为 (dhash, ahash, colorhash)"""
+        with self._lock:
+            self._append(file_path, hash_value, signatures)
+
+    def add_many(self, rows: Iterable[tuple]):
+        """批量添加或更新 (file_path, hash_value[, signatures]) 记录"""
+        with self._lock:
+            for row in rows:
+                self._append(*row)
+
+    def remove(self, file_paths: Iterable[str]):
+        """删除指定路径的记录"""
+        with self._lock:
+            for file_path in file_paths:
+                self._discard(file_path)
+            self._maybe_compact()
+
+    def snapshot(self, directory: Optional[str] = None) -> Tuple[List[str], "np.ndarray"]:
+        """
+        复制当前有效记录（按插入顺序），用于批量处理
+
+        directory: 只包含该目录（含子目录）下的文件
+        返回: (路径列表, (N, word_count) 的 uint64 哈希矩阵)
+        """
+        with self._lock:
+            rows = self._alive_rows(directory)
+            if isinstance(self._paths, _SnapshotColumn):
+                paths = self._paths.take(rows.tolist())
+            else:
+                paths = [self._paths[row] for row in rows.tolist()]
+            return paths, self._words[rows].copy()
+
+    def _append(self, file_path: str, hash_value: str, signatures: Optional[tuple] = None):
+        # 与 INSERT OR REPLACE 一致：旧记录删除，新记录追加到末尾
+        self._discard(file_path)
+
+        if len(hash_value) != self.hash_hex_length:
+            # 长度不同的哈希无法与标准 pHash 比较，不放入索引
+            return
+
+        try:
+            words = hex_to_words(hash_value, self.word_count)
+        except ValueError:
+            return
+
+        if self._size >= len(self._alive):
+            self._grow()
+
+        row = self._size
+        self._words[row] = words
+        self._alive[row] = True
+        signature_values = parse_signatures(signatures)
+        self._has_signatures[row] = signature_values is not None
+        if signature_values is not None:
+            self._signatures[row] = signature_values
+        self._paths.append(file_path)
+        self._hashes.append(hash_value)
+        self._rows[file_path] = row
+        directory = parent_directory(file_path)
+        self._dir_ids[row] = self._dir_id(directory)
+        self._add_dir_row(directory, row)
+        self._size += 1
+
+    def _dir_id(self, directory: str) -> int:
+        dir_id = self._dir_index.get(directory)
+        if dir_id is None:
+            dir_id = self._dir_index[directory] = len(self._dir_names)
+            self._dir_names.append(directory)
+        return dir_id
+
+    def _add_dir_row(self, directory: str, row: int):
+        rows = self._dir_rows.get(directory)
+        if rows is None:
+            rows = self._dir_rows[directory] = []
+            self._sorted_dirs = None
+        elif not isinstance(rows, list):
+            # 从快照加载的行号是数组，第一次追加时转换为列表
+            rows = self._dir_rows[directory] = rows.tolist()
+        rows.append(row)
+
+    def _discard(self, file_path: str):
+        self._materialize()
+        row = self._rows.pop(file_path, None)
+        if row is not None:
+            self._alive[row] = False
+            self._paths[row] = None
+            self._hashes[row] = None
+            self._dead += 1
+
+    def _grow(self):
+        capacity = len(self._alive) * 2
+        words = np.zeros((capacity, self.word_count), dtype=np.uint64)
+        words[:self._size] = self._words[:self._size]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self._size] = self._alive[:self._size]
+        signatures = np.zeros((capacity, len(SIGNATURE_TYPES)), dtype=np.uint64)
+        signatures[:self._size] = self._signatures[:self._size]
+        has_signatures = np.zeros(capacity, dtype=bool)
+        has_signatures[:self._size] = self._has_signatures[:self._size]
+        dir_ids = np.zeros(capacity, dtype=np.uint32)
+        dir_ids[:self._size] = self._dir_ids[:self._size]
+        self._words = words
+        self._alive = alive
+        self._signatures = signatures
+        self._has_signatures = has_signatures
+        self._dir_ids = dir_ids
+
+    def _maybe_compact(self):
+        """删除的记录过多时压缩矩阵，保持原有顺序"""
+        if self._dead < self.INITIAL_CAPACITY or self._dead * 2 < self._size:
+            return
+
+        keep = np.flatnonzero(self._alive[:self._size])
+        capacity = max(self.INITIAL_CAPACITY, len(keep) * 2)
+        words = np.zeros((capacity, self.word_count), dtype=np.uint64)
+        words[:len(keep)] = self._words[keep]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:len(keep)] = True
+        signatures = np.zeros((capacity, len(SIGNATURE_TYPES)), dtype=np.uint64)
+        signatures[:len(keep)] = self._signatures[keep]
+        has_signatures = np.zeros(capacity, dtype=bool)
+        has_signatures[:len(keep)] = self._has_signatures[keep]
+        dir_ids = np.zeros(capacity, dtype=np.uint32)
+        dir_ids[:len(keep)] = self._dir_ids[keep]
+
+        self._paths = [self._paths[row] for row in keep]
+        self._hashes = [self._hashes[row] for row in keep]
+        self._rows = {path: row for row, path in enumerate(self._paths)}
+        self._dir_rows = {}
+        self._sorted_dirs = None
+        for row, dir_id in enumerate(dir_ids[:len(keep)].tolist()):
+            self._add_dir_row(self._dir_names[dir_id], row)
+        self._words = words
+        self._alive = alive
+        self._signatures = signatures
+        self._has_signatures = has_signatures
+        self._dir_ids = dir_ids
+        self._size = len(keep)
+        self._dead = 0
+        # 行号发生变化，多索引哈希需要重建
+        self._mih_dirty = True
+
+    def _mih_snapshot(self):
+        """
+        返回可用的多索引哈希及其覆盖的行数（调用方需持有锁）
+        之后追加的行由调用方线性扫描，新增过多或行号变化时重建
+        """
+        mih = self._mih
+        pending = self._size - mih.size
+        if self._mih_dirty or pending > max(self.INITIAL_CAPACITY, mih.size * self.MIH_REBUILD_RATIO):
+            mih.build(self._words[:self._size])
+            self._mih_dirty = False
+        return mih, mih.size
+
+    def get_stats(self) -> dict:
+        """累计的查询统计，用于与线性扫描对比"""
+        with self._lock:
+            return {
+                'backend': self.backend,
+                'size': self._size - self._dead,
+                'queries': self._query_count,
+                'candidates_visited': self._candidates_visited,
+                'rows_total': self._rows_total,
+                'visited_ratio': (self._candidates_visited / self._rows_total
+                                  if self._rows_total else 0.0)
+            }
+
+    def _record_query(self, visited: int, total: int, backend: str, stats: Optional[dict]):
+        with self._lock:
+            self._query_count += 1
+            self._candidates_visited += visited
+            self._rows_total += total
+        if stats is not None:
+            stats.update({'backend': backend, 'candidates': visited, 'total': total})
+
+    def _scope_dirs(self, scope: Tuple[str, str, str]) -> List[str]:
+        """directory_range 范围内有记录的目录（调用方需持有锁），对有序的目录列表二分查找"""
+        directory, prefix, upper = scope
+        self._build_dir_rows()
+        if self._sorted_dirs is None:
+            self._sorted_dirs = sorted(self._dir_rows)
+        dirs = self._sorted_dirs
+        selected = dirs[bisect_left(dirs, prefix):bisect_left(dirs, upper)]
+        if directory in self._dir_rows and not prefix <= directory < upper:
+            selected.append(directory)
+        return selected
+
+    def _scope_mask(self, directory: str, rows):
+        """
+        rows 中每行是否位于目录范围内（调用方需持有锁）
+        按目录序号查表，不逐行比较路径；directory 为空时返回 None
+        """
+        scope = directory_range(directory)
+        if scope is None:
+            return None
+        in_scope = np.zeros(len(self._dir_names), dtype=bool)
+        in_scope[[self._dir_index[d] for d in self._scope_dirs(scope)]] = True
+        return in_scope[self._dir_ids[rows]]
+
+    def _alive_rows(self, directory: Optional[str]):
+        """目录范围内有效的行号（升序，调用方需持有锁）"""
+        rows = self._scope_rows(directory)
+        if rows is not None:
+            return rows[self._alive[rows]]
+        rows = np.flatnonzero(self._alive[:self._size])
+        mask = self._scope_mask(directory, rows)
+        return rows if mask is None else rows[mask]
+
+    def _scope_rows(self, directory: str):
+        """
+        目录范围内的行号（升序，调用方需持有锁）
+        代价与范围内的行数成正比；directory 为空或范围覆盖大部分行时返回 None
+        """
+        scope = directory_range(directory)
+        if scope is None:
+            return None
+
+        selected = self._scope_dirs(scope)
+        count = sum(len(self._dir_rows[d]) for d in selected)
+        if count > self._size * self.SCOPE_SCAN_RATIO:
+            return None
+        rows = np.fromiter(chain.from_iterable(self._dir_rows[d] for d in selected), dtype=np.int64)
+        rows.sort()
+        return rows
+
+    def _candidate_distances(self, query_hash: str, max_distance: int,
+                             directory: Optional[str], stats: Optional[dict]):
+        """
+        计算候选行的汉明距离
+        线性模式下候选为全部行；多索引哈希模式下只计算候选行和尚未建入索引的新行；
+        指定目录时只计算目录范围内的行
+
+        返回: (候选行号(升序), 对应距离, 对应行是否有效且位于目录范围内, 路径列表, 哈希列表)
+        """
+        query_words = hex_to_words(query_hash, self.word_count)
+        rows = None
+        backend = 'linear'
+
+        with self._lock:
+            size = self._size
+            words = self._words[:size]
+            paths = self._paths
+            hashes = self._hashes
+            if self._mih is not None:
+                mih, indexed_size = self._mih_snapshot()
+                rows = mih.candidates(query_words, max_distance)
+                if rows is not None:
+                    rows = np.concatenate([rows, np.arange(indexed_size, size)])
+                    backend = 'mih'
+            scope = self._scope_rows(directory)
+            if scope is not None:
+                rows = scope if rows is None else np.intersect1d(rows, scope, assume_unique=True)
+            if rows is None:
+                # 线性模式，或阈值过宽导致枚举代价超过线性扫描
+                valid = self._alive[:size].copy()
+                if scope is None:
+                    # 范围覆盖大部分行（或不限目录）：全量扫描，按目录序号过滤
+                    in_scope = self._scope_mask(directory, slice(0, size))
+                    if in_scope is not None:
+                        valid &= in_scope
+            else:
+                valid = self._alive[rows]
+                if scope is None:
+                    in_scope = self._scope_mask(directory, rows)
+                    if in_scope is not None:
+                        valid &= in_scope
+
+        if rows is None:
+            distances = popcount(words ^ query_words).sum(axis=1, dtype=np.int32)
+            self._record_query(size, size, 'linear', stats)
+            return np.arange(size), distances, valid, paths, hashes
+
+        distances = popcount(words[rows] ^ query_words).sum(axis=1, dtype=np.int32)
+        self._record_query(len(rows), size, backend, stats)
+        return rows, distances, valid, paths, hashes
+
+    def search(self, query_hash: str, max_distance: int, directory: Optional[str] = None,
+               top_k: Optional[int] = None, stats: Optional[dict] = None) -> List[Tuple[str, str, int]]:
+        """
+        查找汉明距离不超过 max_distance 的记录
+
+        directory: 只返回该目录（含子目录）下的文件
+        top_k: 只返回距离最小的 k 条（部分选择，不对全部命中排序）
+        stats: 传入字典时写入本次查询的 backend/candidates/total/matched 统计
+        返回: 按距离升序排列的 (file_path, hash_value, distance) 列表，
+              距离相同时保持插入顺序
+        """
+        if len(query_hash) != self.hash_hex_length:
+            return []
+
+        rows, distances, valid, paths, hashes = self._candidate_distances(
+            query_hash, max_distance, directory, stats
+        )
+        matched = np.flatnonzero(valid & (distances <= max_distance))
+        return self._collect(rows, distances, matched, paths, hashes, top_k, stats)
+
+    def search_batch(self, query_hashes: List[str], max_distance: int, directory: Optional[str] = None,
+                     top_k: Optional[int] = None, stats: Optional[dict] = None) -> List[List[Tuple[str, str, int]]]:
+        """
+        批量查找：一次扫描索引，按块计算 Q×N 的汉明距离矩阵
+
+        每块行只从内存读取一次，与全部查询比较；块的大小按查询数调整，
+        使中间矩阵保持在 BATCH_BLOCK_ELEMENTS 个元素以内。
+        长度与索引不一致的查询返回空列表。
+        返回: 与 query_hashes 同序的结果列表，每项与 search 的返回值相同
+        """
+        results = [[] for _ in query_hashes]
+        valid = [i for i, query_hash in enumerate(query_hashes) if len(query_hash) == self.hash_hex_length]
+        if not valid or max_distance < 0:
+            return results
+
+        queries = np.stack([hex_to_words(query_hashes[i], self.word_count) for i in valid])
+        with self._lock:
+            size = self._size
+            words = self._words
+            paths = self._paths
+            hashes = self._hashes
+            rows = self._alive_rows(directory)
+
+        block_rows = max(1, self.BATCH_BLOCK_ELEMENTS // len(valid))
+        xor_buffer = np.empty((len(valid), min(block_rows, len(rows))), dtype=np.uint64)
+        hit_queries, hit_positions, hit_distances = [], [], []
+        for start in range(0, len(rows), block_rows):
+            # 转置后每个字的一列连续存放；逐字累加，中间结果只有 (Q, 块行数) 大小并留在缓存中
+            block = np.ascontiguousarray(words[rows[start:start + block_rows]].T)
+            xor = xor_buffer[:, :block.shape[1]]
+            distances = np.zeros(xor.shape, dtype=np.uint16)
+            for word in range(self.word_count):
+                np.bitwise_xor(queries[:, word, None], block[word], out=xor)
+                distances += popcount(xor)
+            query_index, position = np.nonzero(distances <= max_distance)
+            hit_queries.append(query_index)
+            hit_positions.append(position + start)
+            hit_distances.append(distances[query_index, position])
+
+        with self._lock:
+            self._query_count += len(valid)
+            self._candidates_visited += len(rows) * len(valid)
+            self._rows_total += size * len(valid)
+        if stats is not None:
+            stats.update({'backend': 'batch', 'queries': len(valid), 'candidates': len(rows), 'total': size})
+        if not hit_queries:
+            return results
+
+        # 按查询分组；稳定排序保持每个查询内的行顺序（即插入顺序）
+        hit_queries = np.concatenate(hit_queries)
+        order = np.argsort(hit_queries, kind='stable')
+        hit_queries = hit_queries[order]
+        hit_positions = np.concatenate(hit_positions)[order]
+        hit_distances = np.concatenate(hit_distances)[order].astype(np.int32)
+        bounds = np.searchsorted(hit_queries, np.arange(len(valid) + 1))
+        for query_index, original_index in enumerate(valid):
+            begin, end = bounds[query_index], bounds[query_index + 1]
+            if begin == end:
+                continue
+            results[original_index] = self._collect(
+                rows[hit_positions[begin:end]], hit_distances[begin:end], np.arange(end - begin),
+                paths, hashes, top_k
+            )
+        return results
+
+    def cascade_search(self, query_hash: str, query_signatures: tuple, max_distance: int,
+                       signature_max_distances: Tuple[int, ...], directory: Optional[str] = None,
+                       top_k: Optional[int] = None, stats: Optional[dict] = None) -> List[Tuple[str, str, int]]:
+        """
+        级联查找：依次用 dhash、ahash、colorhash（各一个字）排除候选，
+        只对剩余的行计算完整的 pHash 距离，结果仍以 pHash 距离为准
+
+        query_signatures: 查询图片的 (dhash, ahash, colorhash)
+        signature_max_distances: 各签名允许的最大距离，应比 pHash 阈值宽松，避免漏检
+        stats: 传入字典时写入 stages 列表，记录每一级排除和剩余的候选数量
+        返回: 与 search 相同
+        """
+        if len(query_hash) != self.hash_hex_length:
+            return []
+        query_values = parse_signatures(query_signatures)
+        if query_values is None:
+            return self.search(query_hash, max_distance, directory, top_k, stats)
+
+        query_words = hex_to_words(query_hash, self.word_count)
+        with self._lock:
+            size = self._size
+            paths = self._paths
+            hashes = self._hashes
+            rows = self._alive_rows(directory)
+            words = self._words[:size]
+            signatures = self._signatures[:size]
+            has_signatures = self._has_signatures[:size]
+
+        stages = [{'stage': 'scope', 'pruned': size - len(rows), 'remaining': len(rows)}]
+        for column, name in enumerate(SIGNATURE_TYPES):
+            distances = popcount(signatures[rows, column] ^ np.uint64(query_values[column]))
+            # 没有签名的行（旧记录）不能提前排除
+            keep = (distances <= signature_max_distances[column]) | ~has_signatures[rows]
+            stages.append({'stage': name, 'pruned': int(len(rows) - keep.sum()),
+                           'remaining': int(keep.sum())})
+            rows = rows[keep]
+
+        distances = popcount(words[rows] ^ query_words).sum(axis=1, dtype=np.int32)
+        matched = np.flatnonzero(distances <= max_distance)
+        stages.append({'stage': 'phash', 'pruned': int(len(rows) - len(matched)),
+                       'remaining': int(len(matched))})
+
+        self._record_query(len(rows), size, 'cascade', stats)
+        if stats is not None:
+            stats['stages'] = stages
+        return self._collect(rows, distances, matched, paths, hashes, top_k, stats)
+
+    def _collect(self, rows, distances, matched, paths, hashes,
+                 top_k: Optional[int], stats: Optional[dict] = None) -> List[Tuple[str, str, int]]:
+        """
+        把命中的候选（已按有效行和目录范围过滤）转换为 (file_path, hash_value, distance) 列表（按距离升序）
+        stats: 传入字典时写入 top_k 截断之前的命中数量（matched）
+        """
+        if stats is not None:
+            stats['matched'] = len(matched)
+        if top_k is not None:
+            matched = self._select_top_k(matched, distances, top_k)
+
+        order = matched[np.argsort(distances[matched], kind='stable')]
+        # 取出候选之后的并发删除会把路径置空，只需检查返回的结果
+        results = []
+        for i in order.tolist():
+            row = rows[i]
+            file_path = paths[row]
+            if file_path is not None:
+                results.append((file_path, hashes[row], int(distances[i])))
+        return results
+
+    @staticmethod
+    def _select_top_k(candidates, distances, top_k: int):
+        """
+        用 partition 选出距离最小的 k 个候选，不对全部候选排序
+        第 k 名有并列时按插入顺序取舍，保证结果确定
+        """
+        if top_k <= 0:
+            return candidates[:0]
+        if len(candidates) <= top_k:
+            return candidates
+
+        candidate_distances = distances[candidates]
+        kth = np.partition(candidate_distances, top_k - 1)[top_k - 1]
+        below = candidates[candidate_distances < kth]
+        ties = candidates[candidate_distances == kth][:top_k - len(below)]
+        return np.sort(np.concatenate([below, ties]))
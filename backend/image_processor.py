@@ -1,27 +1,99 @@
 import os
+import heapq
+import signal
+import contextvars
+import threading
+import time
 import imagehash
 from PIL import Image
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Iterable, Iterator, Callable
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
 import mimetypes
 
-# 尝试导入 OpenCV，用于局部特征匹配
-try:
-    import cv2
-    import numpy as np
-    CV2_AVAILABLE = True
-except ImportError:
-    CV2_AVAILABLE = False
-    print("[WARNING] OpenCV 未安装，局部特征匹配功能不可用")
-    print("[INFO] 安装命令: pip install opencv-python numpy")
+import metrics
+from scanner import DirectoryScanner
+
+# OpenCV 只用于局部特征匹配，导入较慢且占用较多内存：只计算感知哈希的进程（命令行索引、
+# 不使用特征匹配的服务）不导入，第一次用到时由 opencv_available() 导入
+cv2 = None
+np = None
+_opencv_state = None
+_opencv_lock = threading.Lock()
+
+
+def opencv_available() -> bool:
+    """按需导入 OpenCV 和 NumPy，返回是否可用；只在第一次调用时尝试导入"""
+    global cv2, np, _opencv_state
+    if _opencv_state is None:
+        with _opencv_lock:
+            if _opencv_state is None:
+                try:
+                    import cv2 as cv2_module
+                    import numpy as numpy_module
+                    cv2, np = cv2_module, numpy_module
+                    _opencv_state = True
+                except ImportError:
+                    _opencv_state = False
+                    print("[WARNING] OpenCV 未安装，局部特征匹配功能不可用")
+                    print("[INFO] 安装命令: pip install opencv-python numpy")
+    return _opencv_state
+
+
+def __getattr__(name: str):
+    # 兼容 from image_processor import CV2_AVAILABLE，读取时才导入 OpenCV
+    if name == 'CV2_AVAILABLE':
+        return opencv_available()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 class ImageProcessor:
     # 支持的图片格式
     SUPPORTED_FORMATS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp'}
+    # 并行索引时每个进程任务包含的文件数
+    WORKER_CHUNK_SIZE = 16
+    # 索引时每扫描多少个文件回调一次进度
+    PROGRESS_INTERVAL = 1000
+    # ORB 特征点数量上限
+    ORB_FEATURES = 1000
+    # 特征匹配搜索时每次从缓存读取的描述符数量
+    FEATURE_BATCH_SIZE = 256
+    # 计算哈希时 JPEG 的最小解码尺寸：pHash 只使用 64x64 的灰度图，
+    # 解码阶段按 1/2~1/8 缩小到不小于该尺寸即可，结果差异在 JPEG 重新编码的误差范围内
+    HASH_DRAFT_SIZE = 256
+    # 16x16 位 pHash 的十六进制长度
+    HASH_HEX_LENGTH = 64
     
-    def __init__(self):
-        """初始化图片处理器"""
-        pass
+    def __init__(self, scan_workers: int = 1, scan_exclude: Iterable[str] = (),
+                 follow_symlinks: str = 'files', max_depth: Optional[int] = None):
+        """
+        初始化图片处理器
+
+        scan_*、follow_symlinks、max_depth 为扫描目录的默认选项（见 DirectoryScanner），
+        单次索引可以通过 scan_options 覆盖 exclude/symlinks/max_depth
+        """
+        self.scan_workers = scan_workers
+        self.scan_options = {
+            'exclude': list(scan_exclude),
+            'symlinks': follow_symlinks,
+            'max_depth': max_depth
+        }
+    
+    def make_scanner(self, scan_options: Optional[dict] = None,
+                     prefetch_stat: bool = False) -> DirectoryScanner:
+        """按默认扫描选项创建扫描器，scan_options 中不为 None 的项覆盖默认值"""
+        options = dict(self.scan_options)
+        options.update({key: value for key, value in (scan_options or {}).items() if value is not None})
+        return DirectoryScanner(
+            self.SUPPORTED_FORMATS,
+            exclude=options['exclude'],
+            symlinks=options['symlinks'],
+            max_depth=options['max_depth'],
+            workers=self.scan_workers,
+            prefetch_stat=prefetch_stat
+        )
     
     def is_image_file(self, file_path: str) -> bool:
         """判断文件是否为支持的图片格式"""
@@ -32,25 +104,117 @@ class ImageProcessor:
         """计算图片的感知哈希值"""
         try:
             with Image.open(image_path) as img:
-                # 如果需要忽略分辨率，先调整为标准尺寸
-                if ignore_resolution:
-                    # 保持宽高比，调整到256x256以内
-                    img.thumbnail((256, 256), Image.Resampling.LANCZOS)
+                if ignore_resolution or ignore_metadata:
+                    # 如果需要忽略分辨率，先调整为标准尺寸
+                    if ignore_resolution:
+                        # 保持宽高比，调整到256x256以内
+                        img.thumbnail((256, 256), Image.Resampling.LANCZOS)
+                    
+                    # 如果需要忽略元数据，移除EXIF信息
+                    if ignore_metadata:
+                        # 创建新图片，不包含元数据
+                        if img.mode in ('RGBA', 'LA'):
+                            background = Image.new('RGB', img.size, (255, 255, 255))
+                            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+                            img = background
+                        elif img.mode != 'RGB':
+                            img = img.convert('RGB')
+                    
+                    # 计算感知哈希
+                    return str(imagehash.phash(img, hash_size=16))
                 
-                # 如果需要忽略元数据，移除EXIF信息
-                if ignore_metadata:
-                    # 创建新图片，不包含元数据
-                    if img.mode in ('RGBA', 'LA'):
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                        img = background
-                    elif img.mode != 'RGB':
-                        img = img.convert('RGB')
+                return self._phash(img)
                 
-                # 计算感知哈希
-                phash = imagehash.phash(img, hash_size=16)
-                return str(phash)
+        except Exception as e:
+            raise Exception(f"计算图片哈希失败 {image_path}: {str(e)}")
+    
+    def calculate_hashes(self, image_paths: List[str], workers: int = 1) -> List[Tuple[Optional[str], Optional[str]]]:
+        """
+        并行计算一组图片的感知哈希（线程池；Pillow 解码和 DCT 计算期间会释放 GIL）
+
+        返回: 与 image_paths 同序的 (哈希值, 错误信息) 列表
+        """
+        def hash_one(image_path: str) -> Tuple[Optional[str], Optional[str]]:
+            try:
+                return self.calculate_hash(image_path), None
+            except Exception as e:
+                return None, str(e)
+        
+        if workers <= 1 or len(image_paths) <= 1:
+            return [hash_one(image_path) for image_path in image_paths]
+        with ThreadPoolExecutor(max_workers=min(workers, len(image_paths))) as pool:
+            # 复制上下文，工作线程中的阶段耗时也记入当前请求的明细
+            futures = [pool.submit(contextvars.copy_context().run, hash_one, image_path)
+                       for image_path in image_paths]
+            return [future.result() for future in futures]
+    
+    def _decode_gray(self, img: Image.Image, color: bool = False) -> Tuple[Image.Image, Optional[Image.Image]]:
+        """
+        计算哈希的共同解码路径，calculate_hash 和 analyze_image 得到的灰度图完全相同
+
+        JPEG 按 HASH_DRAFT_SIZE 缩小解码：只需要灰度时直接解码亮度 (L)，还需要彩色时解码为
+        YCbCr 并取出 Y 通道，两者都是 JPEG 中原样的亮度分量；其他格式统一用 convert('L')
+        返回: (灰度图, color=True 时的 RGB 图，否则为 None)
+        """
+        # draft() 只对 JPEG 生效，其他格式照常完整解码
+        img.draft('YCbCr' if color else 'L', (self.HASH_DRAFT_SIZE, self.HASH_DRAFT_SIZE))
+        with metrics.stage('decode'):
+            img.load()
+        if img.mode == 'L':
+            gray = img
+        elif img.mode == 'YCbCr':
+            gray = img.getchannel('Y')
+        else:
+            gray = img.convert('L')
+        if not color:
+            return gray, None
+        return gray, img if img.mode == 'RGB' else img.convert('RGB')
+    
+    def _phash(self, img: Image.Image) -> str:
+        """计算尚未解码的图片的感知哈希，JPEG 使用缩小解码"""
+        gray, _ = self._decode_gray(img)
+        with metrics.stage('hash'):
+            return str(imagehash.phash(gray, hash_size=16))
+    
+    def _phash_with_signatures(self, img: Image.Image) -> Tuple[str, dict]:
+        """
+        在同一次（缩小）解码中计算感知哈希和用于级联搜索的廉价签名：
+        dHash、aHash（各 64 位）和颜色哈希（42 位）；感知哈希与 _phash 相同
+        """
+        gray, rgb = self._decode_gray(img, color=True)
+        with metrics.stage('hash'):
+            signatures = {
+                'dhash': str(imagehash.dhash(gray)),
+                'ahash': str(imagehash.average_hash(gray)),
+                # 颜色哈希只统计颜色占比，缩小后计算结果基本不变
+                'colorhash': str(imagehash.colorhash(rgb.resize((64, 64), Image.Resampling.BILINEAR)))
+            }
+            return str(imagehash.phash(gray, hash_size=16)), signatures
+    
+    def analyze_image(self, image_path: str, signatures: bool = False) -> Tuple[dict, str]:
+        """
+        只打开一次文件，同时得到图片基本信息和感知哈希
+
+        与 calculate_hash 使用相同的解码方式，索引和查询得到的哈希一致
+        signatures=True 时同一次解码中还计算 dhash/ahash/colorhash，写入图片信息
+        返回: (图片信息, 哈希值)
+        """
+        try:
+            stat = os.stat(image_path)
+            with Image.open(image_path) as img:
+                # 尺寸和格式来自文件头，必须在 draft() 改变 img.size 之前读取
+                info = {
+                    'width': img.width,
+                    'height': img.height,
+                    'size': stat.st_size,
+                    'modified_time': stat.st_mtime,
+                    'format': img.format
+                }
+                if not signatures:
+                    return info, self._phash(img)
                 
+                hash_value, info['signatures'] = self._phash_with_signatures(img)
+                return info, hash_value
         except Exception as e:
             raise Exception(f"计算图片哈希失败 {image_path}: {str(e)}")
     
@@ -75,51 +239,174 @@ class ImageProcessor:
                 'format': 'unknown'
             }
     
+    def iter_image_files(self, directory: str, scan_options: Optional[dict] = None) -> Iterator[str]:
+        """逐个产出目录中的图片文件路径（生成器，便于边扫描边处理）"""
+        return self.make_scanner(scan_options).iter_files(directory)
+    
+    def iter_image_entries(self, directory: str, scan_options: Optional[dict] = None,
+                           cancel_event: Optional[threading.Event] = None) -> Iterator[os.DirEntry]:
+        """逐个产出目录中图片文件的 DirEntry，stat 已在扫描线程中预先取得"""
+        return self.make_scanner(scan_options, prefetch_stat=True).iter_entries(directory, cancel_event)
+    
     def scan_directory(self, directory: str) -> List[str]:
         """扫描目录中的所有图片文件"""
-        image_files = []
-        directory_path = Path(directory)
-        
-        if not directory_path.exists():
-            return image_files
-        
-        # 递归搜索所有图片文件
-        for file_path in directory_path.rglob('*'):
-            if file_path.is_file() and self.is_image_file(str(file_path)):
-                image_files.append(str(file_path))
-        
-        return image_files
+        return list(self.iter_image_files(directory))
     
-    def index_directory(self, directory: str, db_manager) -> int:
-        """索引指定目录中的所有图片"""
-        image_files = self.scan_directory(directory)
-        indexed_count = 0
-        
-        for image_path in image_files:
-            try:
-                # 获取图片信息
-                info = self.get_image_info(image_path)
-                
-                # 计算哈希值
-                hash_value = self.calculate_hash(image_path)
-                
-                # 保存到数据库
-                db_manager.add_image_hash(
-                    file_path=image_path,
-                    hash_value=hash_value,
-                    file_size=info['size'],
-                    modified_time=info['modified_time'],
-                    width=info['width'],
-                    height=info['height']
-                )
-                
-                indexed_count += 1
-                
-            except Exception as e:
-                print(f"索引图片失败 {image_path}: {str(e)}")
+    def index_directory(self, directory: str, db_manager, incremental: bool = False,
+                        workers: int = 1, batch_size: int = 500,
+                        extract_features: bool = False,
+                        signatures: bool = False,
+                        progress: Optional[Callable[[dict], None]] = None,
+                        cancel_event: Optional[threading.Event] = None,
+                        scan_options: Optional[dict] = None) -> dict:
+        """
+        索引指定目录中的所有图片
+
+        incremental=True 时只处理新增或大小/修改时间发生变化的文件，
+        并删除已不存在文件的索引记录
+        workers > 1 时使用多进程并行解码和计算哈希，结果仍由当前进程按扫描顺序
+        分批写入数据库，与串行模式的写入结果完全一致
+        extract_features=True 时同时计算 ORB 描述符并存入特征缓存（需要 OpenCV）
+        signatures=True 时同时计算用于级联搜索的 dhash/ahash/colorhash
+        progress: 每提交一批或每扫描 PROGRESS_INTERVAL 个文件时以当前统计调用
+        cancel_event: 被设置后停止扫描，已计算的结果仍会写入数据库
+        scan_options: 覆盖默认扫描选项的 exclude/symlinks/max_depth
+
+        返回: 包含 scanned/indexed/added/updated/unchanged/removed/failed 计数
+              以及 cancelled 标记的字典
+        """
+        # 统一按绝对路径存储，与目录监控一致，相对路径不会产生重复记录
+        directory = os.path.abspath(directory)
+        stats = {
+            'scanned': 0,
+            'indexed': 0,
+            'added': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'removed': 0,
+            'failed': 0,
+            'cancelled': False
+        }
+        batch_size = max(1, batch_size)
+
+        # 一次查询取出该目录下已索引文件的状态
+        known_files = db_manager.get_file_states(directory) if incremental else {}
+        scanned = set()
+
+        def pending_files():
+            """从扫描器中筛选出需要（重新）计算哈希的文件"""
+            for entry in self.iter_image_entries(directory, scan_options, cancel_event):
+                if cancel_event is not None and cancel_event.is_set():
+                    stats['cancelled'] = True
+                    return
+
+                image_path = entry.path
+                scanned.add(image_path)
+                stats['scanned'] += 1
+                if progress is not None and stats['scanned'] % self.PROGRESS_INTERVAL == 0:
+                    progress(stats)
+
+                if incremental and image_path in known_files:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        stats['failed'] += 1
+                        metrics.count_files('failed')
+                        continue
+
+                    file_size, modified_time = known_files[image_path]
+                    if stat.st_size == file_size and stat.st_mtime == modified_time:
+                        stats['unchanged'] += 1
+                        metrics.count_files('skipped')
+                        continue
+
+                yield image_path
+
+        batch = []
+        feature_batch = []
+
+        def flush():
+            """将缓冲的结果一次性写入数据库"""
+            if not batch:
+                return
+            db_manager.add_image_hashes(batch)
+            if feature_batch:
+                db_manager.add_image_features(feature_batch)
+            for record in batch:
+                stats['indexed'] += 1
+                stats['updated' if record[0] in known_files else 'added'] += 1
+            metrics.count_files('indexed', len(batch))
+            batch.clear()
+            feature_batch.clear()
+            if progress is not None:
+                progress(stats)
+
+        results = self._hash_files(pending_files(), workers, extract_features, signatures)
+        for image_path, info, hash_value, features, error in results:
+            if error is not None:
+                print(f"索引图片失败 {image_path}: {error}")
+                stats['failed'] += 1
+                metrics.count_files('failed')
                 continue
-        
-        return indexed_count
+
+            if features is not None:
+                feature_batch.append((image_path, info['modified_time'], features[0], features[1]))
+
+            batch.append(image_record(image_path, info, hash_value))
+            if len(batch) >= batch_size:
+                flush()
+
+        flush()
+
+        # 取消时扫描不完整，不能据此判断哪些文件已被删除
+        if incremental and not stats['cancelled']:
+            # 清理已被删除的文件（未被扫描到的记录再确认文件确实不存在）
+            missing = [path for path in known_files
+                       if path not in scanned and not os.path.exists(path)]
+            stats['removed'] = db_manager.remove_images(missing)
+
+        if progress is not None:
+            progress(stats)
+        return stats
+    
+    def _hash_files(self, image_paths: Iterable[str], workers: int = 1,
+                    extract_features: bool = False, signatures: bool = False) -> Iterator[tuple]:
+        """
+        计算一组文件的图片信息和哈希值，按输入顺序产出
+        (路径, 信息, 哈希值, 特征, 错误信息) 元组
+
+        workers > 1 时把路径分块流式提交到进程池，同时在途的任务数量有上限，
+        不需要预先收集全部路径
+        """
+        if workers <= 1:
+            for image_path in image_paths:
+                yield _hash_file(image_path, extract_features, signatures)
+            return
+
+        # 工作进程中的阶段耗时随结果带回，在当前进程中记录
+        worker = partial(_hash_files_chunk, extract_features=extract_features, signatures=signatures,
+                         timings=metrics.is_active())
+
+        pending = deque()
+        max_in_flight = workers * 4
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_ignore_sigint) as pool:
+            chunk = []
+            for image_path in image_paths:
+                chunk.append(image_path)
+                if len(chunk) >= self.WORKER_CHUNK_SIZE:
+                    pending.append(pool.submit(worker, chunk))
+                    chunk = []
+
+                    # 控制在途任务数量，按提交顺序取回结果
+                    while len(pending) >= max_in_flight:
+                        yield from _chunk_results(pending.popleft())
+
+            if chunk:
+                pending.append(pool.submit(worker, chunk))
+
+            while pending:
+                yield from _chunk_results(pending.popleft())
     
     def compare_images(self, image1_path: str, image2_path: str, 
                       ignore_resolution: bool = False, 
@@ -143,6 +430,70 @@ class ImageProcessor:
         except Exception as e:
             raise Exception(f"比较图片失败: {str(e)}")
     
+    def compute_features(self, image_path: str) -> Tuple[int, Optional["np.ndarray"]]:
+        """
+        计算图片的 ORB 关键点和描述符
+
+        返回: (关键点数量, 描述符数组)，图片无法读取或没有特征时描述符为 None
+        """
+        if not opencv_available():
+            raise Exception("OpenCV 未安装，无法使用局部特征匹配")
+        
+        with metrics.stage('decode'):
+            img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            return 0, None
+        
+        # 使用 ORB 特征检测器 (比SIFT快，且无专利限制)
+        with metrics.stage('orb_extract'):
+            orb = cv2.ORB_create(nfeatures=self.ORB_FEATURES)
+            keypoints, descriptors = orb.detectAndCompute(img, None)
+        return len(keypoints), descriptors
+    
+    def match_features(self, query_keypoints: int, query_descriptors, 
+                       target_keypoints: int, target_descriptors,
+                       min_match_count: int = 10) -> Tuple[float, int]:
+        """
+        比较两组已计算好的 ORB 描述符
+
+        返回: (匹配得分, 匹配点数量)
+        """
+        des1, des2 = query_descriptors, target_descriptors
+        if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
+            return 0.0, 0
+        
+        # 使用 BFMatcher 进行匹配
+        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+        
+        try:
+            with metrics.stage('orb_match'):
+                matches = bf.knnMatch(des1, des2, k=2)
+        except cv2.error:
+            return 0.0, 0
+        
+        # 应用比率测试 (Lowe's ratio test)
+        good_matches = []
+        for match in matches:
+            if len(match) == 2:
+                m, n = match
+                if m.distance < 0.75 * n.distance:
+                    good_matches.append(m)
+        
+        match_count = len(good_matches)
+        
+        # 计算匹配得分
+        if match_count >= min_match_count:
+            # 基于匹配点数量计算得分
+            max_possible = min(query_keypoints, target_keypoints)
+            if max_possible > 0:
+                score = min(1.0, match_count / (max_possible * 0.3))
+            else:
+                score = 0.0
+        else:
+            score = match_count / min_match_count * 0.5  # 低于阈值给较低分数
+        
+        return score, match_count
+    
     def feature_match(self, query_image_path: str, target_image_path: str, 
                       min_match_count: int = 10) -> Tuple[float, int]:
         """
@@ -151,88 +502,269 @@ class ImageProcessor:
         
         返回: (匹配得分, 匹配点数量)
         """
-        if not CV2_AVAILABLE:
+        if not opencv_available():
             raise Exception("OpenCV 未安装，无法使用局部特征匹配")
         
         try:
-            # 读取图片
-            query_img = cv2.imread(query_image_path, cv2.IMREAD_GRAYSCALE)
-            target_img = cv2.imread(target_image_path, cv2.IMREAD_GRAYSCALE)
-            
-            if query_img is None or target_img is None:
-                return 0.0, 0
-            
-            # 使用 ORB 特征检测器 (比SIFT快，且无专利限制)
-            orb = cv2.ORB_create(nfeatures=1000)
-            
-            # 检测关键点和描述符
-            kp1, des1 = orb.detectAndCompute(query_img, None)
-            kp2, des2 = orb.detectAndCompute(target_img, None)
-            
-            if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
-                return 0.0, 0
-            
-            # 使用 BFMatcher 进行匹配
-            bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+            kp1, des1 = self.compute_features(query_image_path)
+            kp2, des2 = self.compute_features(target_image_path)
+            return self.match_features(kp1, des1, kp2, des2, min_match_count)
             
+        except Exception as e:
+            print(f"特征匹配失败: {str(e)}")
+            return 0.0, 0
+    
+    def _load_target_features(self, image_paths: List[str], db_manager,
+                              should_stop: Optional[Callable[[], bool]] = None) -> dict:
+        """
+        获取一批目标图片的描述符：优先使用数据库中修改时间一致的缓存，
+        缺失或过期的现场计算并写回缓存；should_stop 返回 True 时不再现场计算
+
+        返回: {路径: (关键点数量, 描述符)}
+        """
+        cached = db_manager.get_image_features(image_paths) if db_manager is not None else {}
+        features = {}
+        to_store = []
+        
+        for image_path in image_paths:
             try:
-                matches = bf.knnMatch(des1, des2, k=2)
-            except cv2.error:
-                return 0.0, 0
+                modified_time = os.path.getmtime(image_path)
+            except OSError:
+                continue
             
-            # 应用比率测试 (Lowe's ratio test)
-            good_matches = []
-            for match in matches:
-                if len(match) == 2:
-                    m, n = match
-                    if m.distance < 0.75 * n.distance:
-                        good_matches.append(m)
+            entry = cached.get(image_path)
+            if entry is not None and entry[0] == modified_time:
+                features[image_path] = (entry[1], entry[2])
+                continue
             
-            match_count = len(good_matches)
+            if should_stop is not None and should_stop():
+                continue
             
-            # 计算匹配得分
-            if match_count >= min_match_count:
-                # 基于匹配点数量计算得分
-                max_possible = min(len(kp1), len(kp2))
-                if max_possible > 0:
-                    score = min(1.0, match_count / (max_possible * 0.3))
-                else:
-                    score = 0.0
-            else:
-                score = match_count / min_match_count * 0.5  # 低于阈值给较低分数
+            try:
+                keypoint_count, descriptors = self.compute_features(image_path)
+            except Exception as e:
+                print(f"特征提取失败 {image_path}: {str(e)}")
+                continue
+            features[image_path] = (keypoint_count, descriptors)
+            to_store.append((image_path, modified_time, keypoint_count, descriptors))
+        
+        if db_manager is not None and to_store:
+            db_manager.add_image_features(to_store)
+        
+        return features
+    
+    def iter_feature_matches(self, query_image_path: str,
+                             image_paths: List[str],
+                             min_match_count: int = 10,
+                             threshold: float = 0.3,
+                             db_manager=None,
+                             workers: int = 1,
+                             deadline: Optional[float] = None,
+                             cancel_event: Optional[threading.Event] = None,
+                             query_features: Optional[tuple] = None) -> Iterator[tuple]:
+        """
+        分块执行局部特征匹配，每完成一块产出 (块序号, 已处理数量, 该块中达到阈值的结果)
+
+        workers > 1 时各块在线程池中并行处理（OpenCV 的 ORB 和 BFMatcher 会释放 GIL）；
+        到达 deadline（time.monotonic() 时间）或 cancel_event 被设置后不再处理新的图片；
+        query_features 为已经计算好的查询图片 (关键点数量, 描述符)，传入时不再重新计算
+        """
+        if not opencv_available():
+            raise Exception("OpenCV 未安装，无法使用局部特征匹配。请运行: pip install opencv-python numpy")
+        
+        if query_features is None:
+            query_features = self.compute_features(query_image_path)
+        query_keypoints, query_descriptors = query_features
+        if query_descriptors is None:
+            return
+        
+        def should_stop() -> bool:
+            if cancel_event is not None and cancel_event.is_set():
+                return True
+            return deadline is not None and time.monotonic() >= deadline
+        
+        def match_chunk(index: int, chunk: List[str]) -> tuple:
+            target_features = self._load_target_features(chunk, db_manager, should_stop)
+            results = []
+            processed = 0
             
-            return score, match_count
+            for target_path in chunk:
+                if should_stop():
+                    break
+                processed += 1
+                if target_path not in target_features:
+                    continue
+                try:
+                    target_keypoints, target_descriptors = target_features[target_path]
+                    score, match_count = self.match_features(
+                        query_keypoints, query_descriptors,
+                        target_keypoints, target_descriptors,
+                        min_match_count
+                    )
+                    
+                    if score >= threshold:
+                        results.append({
+                            'path': target_path,
+                            'similarity': score,
+                            'match_count': match_count
+                        })
+                except Exception as e:
+                    continue
             
-        except Exception as e:
-            print(f"特征匹配失败: {str(e)}")
-            return 0.0, 0
+            return index, processed, results
+        
+        # 分块读取缓存，避免一次性把整个目录的描述符载入内存
+        chunks = [image_paths[i:i + self.FEATURE_BATCH_SIZE]
+                  for i in range(0, len(image_paths), self.FEATURE_BATCH_SIZE)]
+        
+        if workers <= 1:
+            for index, chunk in enumerate(chunks):
+                if should_stop():
+                    return
+                yield match_chunk(index, chunk)
+            return
+        
+        pool = ThreadPoolExecutor(max_workers=workers)
+        pending = set()
+        next_chunk = 0
+        try:
+            while True:
+                # 控制在途任务数量，超时或取消后不再提交新任务
+                while next_chunk < len(chunks) and len(pending) < workers * 2 and not should_stop():
+                    # 复制上下文，工作线程中的阶段耗时也记入当前请求的明细
+                    pending.add(pool.submit(contextvars.copy_context().run,
+                                            match_chunk, next_chunk, chunks[next_chunk]))
+                    next_chunk += 1
+                if not pending:
+                    break
+                
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            if db_manager is not None:
+                # 线程池的线程已经结束，释放它们读取描述符缓存时打开的连接
+                db_manager.close_stale_connections()
     
     def search_with_feature_match(self, query_image_path: str, 
                                    image_paths: List[str],
                                    min_match_count: int = 10,
-                                   threshold: float = 0.3) -> List[dict]:
+                                   threshold: float = 0.3,
+                                   db_manager=None,
+                                   workers: int = 1,
+                                   time_budget: Optional[float] = None,
+                                   top_k: Optional[int] = None,
+                                   stats: Optional[dict] = None,
+                                   query_features: Optional[tuple] = None) -> List[dict]:
         """
         使用局部特征匹配搜索相似图片
+
+        查询图片的描述符只计算一次；传入 db_manager 时目标图片使用预先计算的
+        描述符缓存，未命中的计算后写回缓存
+
+        workers: 并行匹配的线程数
+        time_budget: 时间预算（秒），用完后返回已得到的部分结果
+        top_k: 只返回得分最高的 k 个结果
+        stats: 传入字典时写入 processed/total/partial/elapsed 统计，以及 top_k 截断前的结果数量 matched
+        query_features: 已经计算好的查询图片特征，见 iter_feature_matches
         """
-        if not CV2_AVAILABLE:
-            raise Exception("OpenCV 未安装，无法使用局部特征匹配。请运行: pip install opencv-python numpy")
+        started = time.monotonic()
+        deadline = started + time_budget if time_budget else None
         
-        results = []
+        chunk_results = {}
+        processed = 0
+        for index, count, results in self.iter_feature_matches(
+            query_image_path, image_paths, min_match_count, threshold,
+            db_manager, workers, deadline, query_features=query_features
+        ):
+            chunk_results[index] = results
+            processed += count
         
-        for target_path in image_paths:
-            try:
-                score, match_count = self.feature_match(query_image_path, target_path, min_match_count)
-                
-                if score >= threshold:
-                    results.append({
-                        'path': target_path,
-                        'similarity': score,
-                        'match_count': match_count
-                    })
-            except Exception as e:
-                continue
+        # 按输入顺序合并后再排序，保证并行与串行的结果顺序一致
+        results = [result for index in sorted(chunk_results) for result in chunk_results[index]]
+        matched = len(results)
         
         # 按相似度排序
-        results.sort(key=lambda x: x['similarity'], reverse=True)
+        if top_k is not None:
+            results = heapq.nlargest(top_k, results, key=lambda x: x['similarity'])
+        else:
+            results.sort(key=lambda x: x['similarity'], reverse=True)
+        
+        if stats is not None:
+            stats.update({
+                'processed': processed,
+                'total': len(image_paths),
+                'matched': matched,
+                'partial': deadline is not None and processed < len(image_paths)
+                           and time.monotonic() >= deadline,
+                'elapsed': time.monotonic() - started
+            })
         
-        return results
\ No newline at end of file
+        return results
+
+
+def image_record(image_path: str, info: dict, hash_value: str) -> tuple:
+    """把 analyze_image 的结果转换为 DatabaseManager.add_image_hashes 的记录"""
+    signatures = info.get('signatures') or {}
+    return (
+        image_path,
+        hash_value,
+        info['size'],
+        info['modified_time'],
+        info['width'],
+        info['height'],
+        signatures.get('dhash'),
+        signatures.get('ahash'),
+        signatures.get('colorhash')
+    )
+
+
+def _ignore_sigint():
+    """
+    进程池工作进程忽略 SIGINT：终端 Ctrl-C 会发送给整个进程组，
+    由主进程负责取消任务并关闭进程池，避免工作进程先退出导致进程池损坏
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _hash_file(image_path: str, extract_features: bool = False, signatures: bool = False) -> tuple:
+    """
+    计算单个文件的图片信息、哈希值和（可选的）ORB 描述符
+    （进程池工作函数，需位于模块顶层以便序列化）
+    """
+    processor = ImageProcessor()
+    try:
+        info, hash_value = processor.analyze_image(image_path, signatures)
+        features = None
+        if extract_features and opencv_available():
+            try:
+                features = processor.compute_features(image_path)
+            except Exception as e:
+                print(f"特征提取失败 {image_path}: {str(e)}")
+        return image_path, info, hash_value, features, None
+    except Exception as e:
+        return image_path, None, None, None, str(e)
+
+
+def _hash_files_chunk(image_paths: List[str], extract_features: bool = False,
+                      signatures: bool = False, timings: bool = False) -> tuple:
+    """
+    在工作进程中处理一批文件
+
+    返回: (结果列表, 阶段耗时样本)，timings=False 时样本为空
+    """
+    if not timings:
+        return [_hash_file(image_path, extract_features, signatures) for image_path in image_paths], []
+    with metrics.collect_timings() as collector:
+        results = [_hash_file(image_path, extract_features, signatures) for image_path in image_paths]
+    return results, collector.samples
+
+
+def _chunk_results(future) -> List[tuple]:
+    """取回工作进程的结果，并记录其中的阶段耗时"""
+    results, samples = future.result()
+    metrics.record_samples(samples)
+    return results
@@ -0,0 +1,458 @@
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional
+
+# 当前进程的实例标识：重启后即使得到相同的 pid（容器中的 PID 1 或 pid 复用），也能与之前的进程区分
+_INSTANCE_ID = uuid.uuid4().hex
+
+
+class IndexJobManager:
+    """
+    后台索引任务管理
+
+    任务按提交顺序在单独的工作线程中依次执行，进度写入数据库。
+    任务总是以增量模式运行：已提交的批次不会重复计算，因此被取消或因进程退出而
+    中断的任务重新执行时，会从上次停止的位置继续。
+
+    排队和执行中的任务记录所属进程（owner）并定期写入心跳（heartbeat_at）；多个进程共用
+    数据库时，只接管所属进程已经退出或心跳超时的任务，不会与仍在执行的进程重复执行。
+    任务状态的转换（接管、开始执行）只在数据库中的状态仍为预期状态时生效，同时启动的
+    多个进程不会重复执行同一任务。
+    """
+
+    # 正在执行的任务每隔多少秒把进度写入数据库
+    PERSIST_INTERVAL = 2.0
+    # 排队和执行中的任务每隔多少秒写入一次心跳
+    HEARTBEAT_INTERVAL = 10.0
+    # 心跳超过多少秒未更新，视为所属进程已经退出
+    HEARTBEAT_TIMEOUT = 60.0
+
+    def __init__(self, image_processor, db_manager, resume_interrupted: bool = True,
+                 on_finished: Optional[Callable[[], None]] = None):
+        """on_finished: 每个任务结束（包括失败和取消）后在工作线程中调用，用于更新派生的索引"""
+        self.image_processor = image_processor
+        self.db_manager = db_manager
+        self.resume_interrupted = resume_interrupted
+        self.on_finished = on_finished
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._cancel_event = threading.Event()
+        self._current_job_id = None
+        self._shutting_down = False
+        self._owner = {'pid': os.getpid(), 'host': socket.gethostname(), 'instance': _INSTANCE_ID}
+        # 保存任务时持有：心跳线程与状态更新交错时，数据库中保留的总是最后一次的状态
+        self._save_lock = threading.Lock()
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+
+    def start(self):
+        """
+        加载历史任务并启动工作线程；所属进程已经退出的未完成任务标记为 interrupted，
+        其他进程仍在执行的任务保持原状态
+        """
+        for job in self.db_manager.get_index_jobs():
+            self._jobs[job['id']] = job
+            if job['status'] in ('queued', 'running') and not self.owner_alive(job):
+                self._transition(job, job['status'], claim=False, status='interrupted')
+
+        self._shutting_down = False
+        self._thread = threading.Thread(target=self._worker, name="index-jobs", daemon=True)
+        self._thread.start()
+        self._start_heartbeat()
+
+        if self.resume_interrupted:
+            for job in list(self._jobs.values()):
+                if job['status'] == 'interrupted':
+                    self.resume(job['id'])
+
+    def stop(self):
+        """停止工作线程；正在执行的任务标记为 interrupted，下次启动时可继续"""
+        self._shutting_down = True
+        self._cancel_event.set()
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stop_heartbeat()
+
+    def submit(self, directories: List[str], workers: int = 1, batch_size: int = 500,
+               extract_features: bool = False, signatures: bool = False,
+               scan_options: Optional[dict] = None) -> dict:
+        """提交新的索引任务"""
+        now = time.time()
+        job = {
+            'id': uuid.uuid4().hex[:12],
+            # 恢复执行的进程工作目录可能不同
+            'directories': [os.path.abspath(directory) for directory in directories],
+            'options': {
+                'workers': workers,
+                'batch_size': batch_size,
+                'extract_features': extract_features,
+                'signatures': signatures,
+                'scan_options': scan_options
+            },
+            'status': 'queued',
+            'progress': self._empty_progress(),
+            'completed_directories': [],
+            'current_directory': None,
+            'progress_before_directory': None,
+            'error': None,
+            'created_at': now,
+            'started_at': None,
+            'finished_at': None
+        }
+        with self._lock:
+            self._claim(job)
+            self._jobs[job['id']] = job
+        self._save(job)
+        self._queue.put(job['id'])
+        return self.get(job['id'])
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """获取任务状态（返回副本）"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = dict(job)
+            snapshot['progress'] = dict(job['progress'])
+            return snapshot
+
+    def list(self) -> List[dict]:
+        """按创建时间列出所有任务；不是由当前进程排队或执行的任务从数据库读取最新状态"""
+        for job in self.db_manager.get_index_jobs():
+            with self._lock:
+                current = self._jobs.get(job['id'])
+                if current is None or not self._is_active_here(current):
+                    self._jobs[job['id']] = job
+        with self._lock:
+            job_ids = sorted(self._jobs, key=lambda job_id: self._jobs[job_id]['created_at'])
+        return [self.get(job_id) for job_id in job_ids]
+
+    def cancel(self, job_id: str) -> Optional[dict]:
+        """取消排队中或正在执行的任务"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job['status'] == 'queued':
+                job['status'] = 'cancelled'
+                job['finished_at'] = time.time()
+            elif job['status'] == 'running' and self._current_job_id == job_id:
+                job['status'] = 'cancelling'
+                self._cancel_event.set()
+        self._save(job)
+        return self.get(job_id)
+
+    def resume(self, job_id: str) -> Optional[dict]:
+        """重新排队被取消、中断或失败的任务，从上次停止的位置继续"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            expected = job['status']
+        if expected in ('cancelled', 'interrupted', 'failed') and \
+                self._transition(job, expected, status='queued', error=None, finished_at=None):
+            self._queue.put(job_id)
+        return self.get(job_id)
+
+    def load(self, job_id: str) -> Optional[dict]:
+        """从数据库读取任务（其他进程创建的任务也可以），不改变任务状态"""
+        with self._lock:
+            loaded = job_id in self._jobs
+        if loaded:
+            return self.get(job_id)
+        for job in self.db_manager.get_index_jobs():
+            if job['id'] == job_id:
+                with self._lock:
+                    self._jobs.setdefault(job_id, job)
+                return self.get(job_id)
+        return None
+
+    def run(self, job_id: str, on_progress: Optional[Callable[[dict], None]] = None,
+            interval: float = 1.0) -> Optional[dict]:
+        """
+        执行一个任务直到结束并返回最终状态（命令行使用，不需要 start()）
+
+        任务在单独的工作线程中执行，调用线程每隔 interval 秒以任务状态调用 on_progress。
+        被取消、中断或失败的任务从上次停止的位置继续；状态仍为 queued/running 的任务只在
+        所属进程已经退出（见 owner_alive）时继续，否则不执行，直接返回当前状态。
+        调用线程收到 KeyboardInterrupt 时停止任务并标记为 interrupted，之后可以再次 run 继续
+        """
+        job = self.load(job_id)
+        if job is None:
+            return None
+        if self.running_elsewhere(job):
+            return job
+        with self._lock:
+            job = self._jobs[job_id]
+            expected = job['status']
+        if expected in ('cancelled', 'interrupted', 'failed', 'queued', 'running'):
+            if not self._transition(job, expected, status='queued', error=None, finished_at=None):
+                # 其他进程抢先接管了任务
+                return self.get(job_id)
+
+        self._shutting_down = False
+        self._cancel_event.clear()
+        # 上一次 stop() 留下的结束标记不能影响本次执行
+        self._queue = queue.Queue()
+        self._queue.put(job_id)
+        self._queue.put(None)
+        self._thread = threading.Thread(target=self._worker, name="index-jobs", daemon=True)
+        self._thread.start()
+        self._start_heartbeat()
+        try:
+            # 不用 join(timeout) 等待：join 被 KeyboardInterrupt 打断后，线程会被误认为已经结束，
+            # stop() 就不会再等待它
+            last_report = time.monotonic()
+            while self._thread.is_alive():
+                time.sleep(0.1)
+                if on_progress is not None and time.monotonic() - last_report >= interval:
+                    last_report = time.monotonic()
+                    on_progress(self.get(job_id))
+        except KeyboardInterrupt:
+            self.stop()
+        self._thread = None
+        self._stop_heartbeat()
+        return self.get(job_id)
+
+    def owner_alive(self, job: dict) -> bool:
+        """
+        任务的所属进程是否仍在运行：心跳未超时，且（同一主机上）进程仍然存在。
+        没有记录所属进程的旧任务视为已经退出
+        """
+        owner = job.get('owner')
+        if not owner or time.time() - (job.get('heartbeat_at') or 0) > self.HEARTBEAT_TIMEOUT:
+            return False
+        if owner == self._owner:
+            return True
+        if owner.get('host') != self._owner['host']:
+            return True
+        if owner.get('pid') == self._owner['pid']:
+            # pid 与当前进程相同而实例不同：使用这个 pid 的上一个进程已经退出
+            return False
+        return _pid_alive(owner.get('pid'))
+
+    def running_elsewhere(self, job: dict) -> bool:
+        """任务是否排队或正在由其他仍在运行的进程执行"""
+        return (job['status'] in ('queued', 'running') and job.get('owner') != self._owner
+                and self.owner_alive(job))
+
+    def _is_active_here(self, job: dict) -> bool:
+        """任务是否由当前进程排队或执行（调用者持有 self._lock）"""
+        return job['status'] in ('queued', 'running', 'cancelling') and job.get('owner') == self._owner
+
+    def _claim(self, job: dict):
+        """由当前进程接管任务（调用者持有 self._lock）"""
+        job['owner'] = dict(self._owner)
+        job['heartbeat_at'] = time.time()
+
+    def _transition(self, job: dict, expected_status: str, claim: bool = True, **changes) -> bool:
+        """
+        原子地修改任务：只有数据库中的状态仍为 expected_status 时才写入 changes
+        （claim=True 时同时由当前进程接管）；否则任务已被其他进程修改，
+        从数据库重新读取后返回 False
+        """
+        with self._save_lock:
+            with self._lock:
+                updated = dict(job, **changes)
+                if claim:
+                    self._claim(updated)
+            if self.db_manager.update_index_job(updated, expected_status):
+                with self._lock:
+                    job.update(updated)
+                return True
+
+        latest = self.db_manager.get_index_job(job['id'])
+        with self._lock:
+            if latest is not None:
+                self._jobs[job['id']] = latest
+        return False
+
+    def _save(self, job: dict):
+        with self._save_lock:
+            self.db_manager.save_index_job(job)
+
+    def _start_heartbeat(self):
+        self._heartbeat_stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name="index-jobs-heartbeat",
+                                                  daemon=True)
+        self._heartbeat_thread.start()
+
+    def _stop_heartbeat(self):
+        self._heartbeat_stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    def _heartbeat(self):
+        """定期为当前进程排队和执行中的任务写入心跳"""
+        while not self._heartbeat_stop.wait(self.HEARTBEAT_INTERVAL):
+            with self._lock:
+                active = [job for job in self._jobs.values() if self._is_active_here(job)]
+            for job in active:
+                try:
+                    with self._save_lock:
+                        with self._lock:
+                            # 保存之前再次确认：任务可能刚刚结束或被其他进程接管
+                            if self._jobs.get(job['id']) is not job or not self._is_active_here(job):
+                                continue
+                            job['heartbeat_at'] = time.time()
+                        self.db_manager.save_index_job(job)
+                except Exception as e:
+                    print(f"写入索引任务心跳失败 {job['id']}: {str(e)}")
+
+    @staticmethod
+    def _empty_progress() -> dict:
+        return {
+            'scanned': 0,
+            'hashed': 0,
+            'added': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'removed': 0,
+            'failed': 0,
+            'throughput': 0.0,
+            'elapsed': 0.0
+        }
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            if job_id is None or self._shutting_down:
+                return
+
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job['status'] != 'queued':
+                    continue
+                started_at = job['started_at'] or time.time()
+            # 任务可能已被取消，或被同时启动的其他进程抢先执行
+            if not self._transition(job, 'queued', status='running', started_at=started_at):
+                continue
+            with self._lock:
+                self._current_job_id = job_id
+                self._cancel_event.clear()
+
+            stopped = False
+            try:
+                self._run(job)
+            except Exception as e:
+                print(f"索引任务失败 {job_id}: {str(e)}")
+                with self._lock:
+                    job['status'] = 'failed'
+                    job['error'] = str(e)
+            except BaseException as e:
+                # KeyboardInterrupt / SystemExit 等：进程正在退出，任务记为 interrupted 以便下次继续
+                print(f"索引任务中断 {job_id}: {type(e).__name__}")
+                stopped = True
+                with self._lock:
+                    job['status'] = 'interrupted'
+            finally:
+                # 无论任务是否完成，已写入的记录都导出到快照，供其他进程映射
+                try:
+                    self.db_manager.export_snapshot()
+                except Exception as e:
+                    print(f"导出索引快照失败: {str(e)}")
+                if self.on_finished is not None:
+                    try:
+                        self.on_finished()
+                    except Exception as e:
+                        print(f"索引任务结束后的更新失败: {str(e)}")
+                with self._lock:
+                    self._current_job_id = None
+                    job['finished_at'] = time.time()
+                self._save(job)
+            if stopped:
+                return
+
+    def _run(self, job: dict):
+        options = job['options']
+        run_started = time.monotonic()
+        with self._lock:
+            if job.get('progress_before_directory'):
+                # 恢复执行：中断时所在的目录会重新扫描（已提交的文件计为 unchanged），
+                # 先回退到进入该目录前的进度，避免重复计数
+                elapsed = job['progress']['elapsed']
+                job['progress'] = dict(job['progress_before_directory'])
+                job['progress']['elapsed'] = elapsed
+            # 恢复执行时沿用之前累计的进度
+            base = dict(job['progress'])
+        directory_base = base
+        last_persist = 0.0
+
+        def on_progress(stats: dict):
+            nonlocal last_persist
+            elapsed = base['elapsed'] + time.monotonic() - run_started
+            with self._lock:
+                progress = job['progress']
+                progress['scanned'] = directory_base['scanned'] + stats['scanned']
+                progress['hashed'] = directory_base['hashed'] + stats['indexed']
+                for key in ('added', 'updated', 'unchanged', 'removed', 'failed'):
+                    progress[key] = directory_base[key] + stats[key]
+                progress['elapsed'] = elapsed
+                run_hashed = progress['hashed'] - base['hashed']
+                run_elapsed = time.monotonic() - run_started
+                progress['throughput'] = run_hashed / run_elapsed if run_elapsed > 0 else 0.0
+
+            if time.monotonic() - last_persist >= self.PERSIST_INTERVAL:
+                last_persist = time.monotonic()
+                self._save(job)
+
+        for directory in job['directories']:
+            if directory in job['completed_directories']:
+                continue
+            if not os.path.exists(directory):
+                job['completed_directories'].append(directory)
+                continue
+
+            with self._lock:
+                job['current_directory'] = directory
+                job['progress_before_directory'] = dict(job['progress'])
+                directory_base = dict(job['progress'])
+
+            stats = self.image_processor.index_directory(
+                directory, self.db_manager,
+                incremental=True,
+                workers=options['workers'],
+                batch_size=options['batch_size'],
+                extract_features=options['extract_features'],
+                signatures=options.get('signatures', False),
+                progress=on_progress,
+                cancel_event=self._cancel_event,
+                scan_options=options.get('scan_options')
+            )
+
+            if stats['cancelled']:
+                with self._lock:
+                    job['status'] = 'interrupted' if self._shutting_down else 'cancelled'
+                return
+
+            # 目录完成后，重新执行时不再重复扫描
+            with self._lock:
+                job['completed_directories'].append(directory)
+                job['progress_before_directory'] = None
+
+        with self._lock:
+            job['status'] = 'completed'
+            job['current_directory'] = None
+            job['progress_before_directory'] = None
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    """同一主机上的进程是否存在；Windows 上 os.kill 会结束进程，无法检查，视为存在（只依据心跳）"""
+    if not pid or os.name == 'nt':
+        return bool(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,183 @@
+"""
+索引快照
+
+把内存哈希索引需要的数据导出为一个紧凑的二进制文件。其他进程用 mmap 只读映射后直接作为
+NumPy 数组使用：多个 worker 共享同一份页缓存，启动时也不必从 SQLite 逐行解析十六进制哈希。
+
+文件布局（小端，各段按 8 字节对齐）:
+  头部            magic、格式版本、哈希长度、行数、目录数、指纹（记录数、最大行号）
+  words           N × word_count 个 uint64，打包的 pHash
+  signatures      N × 3 个 uint64，级联搜索的签名；has_signatures N 字节
+  mtimes          N 个 float64，文件修改时间（未知时为 NaN）
+  dir_ids         N 个 uint32，所在目录在目录表中的序号
+  paths           N + 1 个 uint64 偏移 + 以 NUL 分隔的 UTF-8 路径
+  dirs            D + 1 个 uint64 偏移 + 以 NUL 分隔的 UTF-8 目录
+行按数据库 id 顺序排列，与从 SQLite 加载的索引完全一致。
+快照通过临时文件 + os.replace 原子替换，读取方要么看到旧文件，要么看到完整的新文件；
+已经映射旧文件的进程不受影响。
+"""
+import mmap
+import os
+import struct
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+from hash_index import NUMPY_AVAILABLE, SIGNATURE_TYPES
+
+if NUMPY_AVAILABLE:
+    import numpy as np
+
+SNAPSHOT_MAGIC = b'ITWINIDX'
+# 文件格式变化时递增，旧版本的快照被忽略并重新导出
+SNAPSHOT_VERSION = 1
+# magic, 版本, 哈希长度, 行数, 目录数, 指纹: 记录数, 最大行号
+_HEADER = struct.Struct('<8sIIQQQQ')
+_HEADER_SIZE = 64
+
+
+def _aligned(size: int) -> int:
+    return (size + 7) & ~7
+
+
+def _encode_strings(strings: Sequence[str]) -> Tuple["np.ndarray", bytes]:
+    """字符串表: (N + 1 个字节偏移, 以 NUL 分隔的 UTF-8 数据)"""
+    encoded = [s.encode('utf-8', 'surrogateescape') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype='<u8')
+    if encoded:
+        # 每个字符串后的分隔符计入偏移，第 i 个字符串位于 [offsets[i], offsets[i+1] - 1)
+        np.cumsum([len(item) + 1 for item in encoded], out=offsets[1:])
+    return offsets, b''.join(item + b'\0' for item in encoded)
+
+
+def words_to_hex(words: "np.ndarray", hash_hex_length: int) -> List[str]:
+    """把打包的 uint64 哈希矩阵转换回十六进制字符串（hex_to_words 的逆运算）"""
+    if len(words) == 0:
+        return []
+    text = words.astype('>u8').tobytes().hex()
+    step = words.shape[1] * 16
+    return [text[i:i + hash_hex_length] for i in range(0, len(text), step)]
+
+
+def write_snapshot(path: str, hash_hex_length: int, fingerprint: Tuple[int, int],
+                   paths: Sequence[str], words: "np.ndarray", signatures: "np.ndarray",
+                   has_signatures: "np.ndarray", mtimes: "np.ndarray",
+                   dir_ids: "np.ndarray", directories: Sequence[str]):
+    """写入临时文件后原子地替换 path"""
+    row_count = len(paths)
+    path_offsets, path_blob = _encode_strings(paths)
+    dir_offsets, dir_blob = _encode_strings(directories)
+    sections = [
+        np.ascontiguousarray(words, dtype='<u8').tobytes(),
+        np.ascontiguousarray(signatures, dtype='<u8').tobytes(),
+        np.ascontiguousarray(has_signatures, dtype=np.uint8).tobytes(),
+        np.ascontiguousarray(mtimes, dtype='<f8').tobytes(),
+        np.ascontiguousarray(dir_ids, dtype='<u4').tobytes(),
+        path_offsets.tobytes(),
+        path_blob,
+        dir_offsets.tobytes(),
+        dir_blob
+    ]
+    header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, hash_hex_length, row_count,
+                          len(directories), fingerprint[0], fingerprint[1])
+
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(header.ljust(_HEADER_SIZE, b'\0'))
+            for data in sections:
+                f.write(data)
+                f.write(b'\0' * (_aligned(len(data)) - len(data)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+class IndexSnapshot:
+    """
+    只读映射的索引快照
+
+    words/signatures/has_signatures/mtimes/dir_ids 是直接指向映射内存的只读 NumPy 数组，
+    路径和目录表在 paths()/directories() 时一次性解码
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            # 用于判断快照文件是否已被替换
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if stat.st_size < _HEADER_SIZE:
+                raise Exception(f"快照文件不完整: {path}")
+            # 映射在文件关闭后仍然有效，由引用它的数组保持存活
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.hash_hex_length, self.row_count, self.dir_count,
+         fingerprint_rows, fingerprint_last_id) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception(f"不是索引快照文件: {path}")
+        if version != SNAPSHOT_VERSION:
+            raise Exception(f"快照格式版本 {version} 与当前版本 {SNAPSHOT_VERSION} 不一致")
+        self.fingerprint = (fingerprint_rows, fingerprint_last_id)
+        self.word_count = (self.hash_hex_length + 15) // 16
+
+        n = self.row_count
+        self._offset = _HEADER_SIZE
+        self.words = self._array('<u8', n * self.word_count).reshape(n, self.word_count)
+        self.signatures = self._array('<u8', n * len(SIGNATURE_TYPES)).reshape(n, len(SIGNATURE_TYPES))
+        self.has_signatures = self._array(np.bool_, n)
+        self.mtimes = self._array('<f8', n)
+        self.dir_ids = self._array('<u4', n)
+        self._path_offsets = self._array('<u8', n + 1)
+        self._path_blob = self._blob(int(self._path_offsets[-1]))
+        self._dir_offsets = self._array('<u8', self.dir_count + 1)
+        self._dir_blob = self._blob(int(self._dir_offsets[-1]))
+
+    def _array(self, dtype, count: int) -> "np.ndarray":
+        dtype = np.dtype(dtype)
+        size = dtype.itemsize * count
+        if self._offset + size > len(self._mmap):
+            raise Exception(f"快照文件不完整: {self.path}")
+        array = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=self._offset)
+        self._offset += _aligned(size)
+        return array
+
+    def _blob(self, size: int) -> Tuple[int, int]:
+        if self._offset + size > len(self._mmap):
+            raise Exception(f"快照文件不完整: {self.path}")
+        start = self._offset
+        self._offset += _aligned(size)
+        return start, start + size
+
+    def _decode(self, blob: Tuple[int, int], count: int) -> List[str]:
+        if count == 0:
+            return []
+        start, end = blob
+        # 去掉最后一个分隔符后整体解码再切分，比按偏移逐个解码快得多
+        return self._mmap[start:end - 1].decode('utf-8', 'surrogateescape').split('\0')
+
+    def paths(self) -> List[str]:
+        return self._decode(self._path_blob, self.row_count)
+
+    def directories(self) -> List[str]:
+        return self._decode(self._dir_blob, self.dir_count)
+
+    def path_at(self, row: int) -> str:
+        """按偏移读取单个路径，不解码整张表"""
+        start = self._path_blob[0] + int(self._path_offsets[row])
+        end = self._path_blob[0] + int(self._path_offsets[row + 1]) - 1
+        return self._mmap[start:end].decode('utf-8', 'surrogateescape')
+
+
+def open_snapshot(path: Optional[str]) -> Optional[IndexSnapshot]:
+    """打开快照，文件不存在或无效时返回 None"""
+    if not path or not NUMPY_AVAILABLE or not os.path.exists(path):
+        return None
+    try:
+        return IndexSnapshot(path)
+    except Exception as e:
+        print(f"读取索引快照失败 {path}: {str(e)}")
+        return None
@@ -1,30 +1,143 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import List, Optional
 from contextlib import asynccontextmanager
 import os
+import re
 import json
+import asyncio
+import threading
 import sqlite3
 from pathlib import Path
 import tempfile
 import shutil
+import time
+import copy
+from email.utils import formatdate, parsedate_to_datetime
 
+import config
+import metrics
+from concurrency import BoundedExecutor, ServiceBusyError
 from image_processor import ImageProcessor
 from database import DatabaseManager
+from index_jobs import IndexJobManager
+from thumbnails import ThumbnailCache
+from result_cache import ResultCache, file_digest
+from watcher import DirectoryWatcher
+from scanner import SYMLINK_POLICIES
+from visual_words import VisualWordIndex
+from dedupe import DedupeJobManager, export_groups_csv
 
 # 初始化组件
-image_processor = ImageProcessor()
-db_manager = DatabaseManager()
+metrics.set_enabled(config.METRICS_ENABLED)
+image_processor = ImageProcessor(
+    scan_workers=config.SCAN_WORKERS,
+    scan_exclude=config.SCAN_EXCLUDE,
+    follow_symlinks=config.SCAN_FOLLOW_SYMLINKS,
+    max_depth=config.SCAN_MAX_DEPTH if config.SCAN_MAX_DEPTH >= 0 else None
+)
+db_manager = DatabaseManager(
+    index_backend=config.HASH_INDEX_BACKEND,
+    mih_band_count=config.MIH_BAND_COUNT,
+    snapshot_path=config.INDEX_SNAPSHOT_PATH,
+    snapshot_check_interval=config.SNAPSHOT_CHECK_INTERVAL
+)
+
+visual_index = VisualWordIndex(
+    db_manager,
+    vocabulary_size=config.VISUAL_VOCABULARY_SIZE,
+    sample_size=config.VISUAL_VOCABULARY_SAMPLE,
+    iterations=config.VISUAL_VOCABULARY_ITERATIONS
+)
+
+index_jobs = IndexJobManager(
+    image_processor,
+    db_manager,
+    resume_interrupted=config.RESUME_INTERRUPTED_JOBS,
+    # 已训练词汇表时，为新缓存的描述符补充视觉词袋
+    on_finished=visual_index.update
+)
+
+dedupe_jobs = DedupeJobManager(db_manager, band_count=config.MIH_BAND_COUNT)
+
+watcher = DirectoryWatcher(
+    image_processor,
+    db_manager,
+    debounce=config.WATCH_DEBOUNCE_SECONDS,
+    batch_size=config.WATCH_BATCH_SIZE,
+    poll_interval=config.WATCH_POLL_INTERVAL,
+    force_polling=config.WATCH_FORCE_POLLING,
+    snapshot_interval=config.WATCH_SNAPSHOT_INTERVAL,
+    signatures=config.COMPUTE_SIGNATURES
+)
+
+result_cache = ResultCache(
+    max_bytes=config.RESULT_CACHE_MAX_MB * 1024 * 1024,
+    ttl=config.RESULT_CACHE_TTL
+)
+thumbnail_cache = ThumbnailCache(
+    config.THUMBNAIL_CACHE_DIR,
+    max_bytes=config.THUMBNAIL_CACHE_MAX_MB * 1024 * 1024,
+    quality=config.THUMBNAIL_QUALITY
+)
+
+# 有界执行器：阻塞的 CPU / IO 工作不在事件循环中执行，超出并发上限时返回 503
+phash_search_executor = BoundedExecutor(
+    "phash-search",
+    config.PHASH_SEARCH_CONCURRENCY,
+    config.PHASH_SEARCH_QUEUE,
+    config.RETRY_AFTER_SECONDS
+)
+feature_search_executor = BoundedExecutor(
+    "feature-search",
+    config.FEATURE_SEARCH_CONCURRENCY,
+    config.FEATURE_SEARCH_QUEUE,
+    config.RETRY_AFTER_SECONDS
+)
+maintenance_executor = BoundedExecutor(
+    "maintenance",
+    1,
+    0,
+    config.RETRY_AFTER_SECONDS
+)
+executors = (phash_search_executor, feature_search_executor, maintenance_executor)
+
+# 导出时读取的仪表
+metrics.INDEX_SIZE.set_function(db_manager.get_total_images)
+metrics.EXECUTOR_IN_FLIGHT.set_function(
+    lambda: {(executor.name,): executor.get_stats()['in_flight'] for executor in executors}
+)
+
+def save_last_directory(directory: str):
+    """保存最后索引的目录"""
+    try:
+        settings = {"last_directory": directory}
+        with open("settings.json", "w", encoding="utf-8") as f:
+            json.dump(settings, f, ensure_ascii=False, indent=2)
+    except:
+        pass
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
-    # 启动时初始化数据库
+    # 启动时初始化数据库，并启动后台索引任务（继续上次中断的任务）
     db_manager.init_db()
+    visual_index.load()
+    index_jobs.start()
+    for directory in config.WATCH_DIRECTORIES:
+        watcher.watch(directory)
+    watcher.start()
     yield
-    # 关闭时的清理工作（如果需要）
+    # 关闭时中断正在执行的索引任务（下次启动时继续），并释放数据库连接
+    watcher.stop()
+    dedupe_jobs.shutdown()
+    index_jobs.stop()
+    for executor in executors:
+        executor.shutdown()
+    db_manager.close()
 
 app = FastAPI(title="ImageTwin - 图片相似度搜索工具", version="1.0.0", lifespan=lifespan)
 
@@ -37,6 +150,36 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    """记录正在处理的请求数和每个路由的请求耗时"""
+    if not metrics.is_enabled():
+        return await call_next(request)
+    
+    metrics.HTTP_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.HTTP_IN_FLIGHT.dec()
+        # 使用路由模板而不是实际路径，避免 /api/image/{path} 等产生大量标签
+        route = request.scope.get("route")
+        metrics.HTTP_REQUEST_SECONDS.labels(
+            request.method, route.path if route is not None else "unmatched", status
+        ).observe(time.perf_counter() - started)
+
+@app.exception_handler(ServiceBusyError)
+async def service_busy_handler(request: Request, exc: ServiceBusyError):
+    """并发已满时返回 503，并通过 Retry-After 告知客户端稍后重试"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 class SearchRequest(BaseModel):
     directory: str
     similarity_threshold: float = 0.8
@@ -45,30 +188,305 @@ class SearchRequest(BaseModel):
 
 class IndexRequest(BaseModel):
     directories: List[str]
+    incremental: bool = False
+    workers: int = 1          # 并行计算哈希的进程数，1 表示串行
+    batch_size: int = 500     # 每次提交到数据库的记录数
+    extract_features: bool = False  # 同时预先计算 ORB 描述符，加速局部特征匹配搜索
+    signatures: Optional[bool] = None  # 同时计算级联搜索使用的签名，默认取配置 COMPUTE_SIGNATURES
+    debug: bool = False       # 在结果中附加各处理阶段的耗时明细
+    exclude: Optional[List[str]] = None   # 跳过的文件/目录模式，默认取配置 SCAN_EXCLUDE
+    follow_symlinks: Optional[str] = None # 符号链接策略 skip/files/follow，默认取配置 SCAN_FOLLOW_SYMLINKS
+    max_depth: Optional[int] = None       # 最多进入几层子目录，默认取配置 SCAN_MAX_DEPTH
+
+class WatchRequest(BaseModel):
+    directory: str
+    # 与索引时相同的扫描选项，扫描时会跳过的文件的变化不会同步到索引
+    exclude: Optional[List[str]] = None
+    follow_symlinks: Optional[str] = None
+    max_depth: Optional[int] = None
+
+class DedupeRequest(BaseModel):
+    directory: str = ""               # 为空时对整个索引去重
+    similarity_threshold: float = 0.9
+    exact: bool = False               # 分块比较全部两两组合，不使用分段候选
+
+class VisualIndexRequest(BaseModel):
+    vocabulary_size: Optional[int] = None  # 视觉词数量，默认取配置 VISUAL_VOCABULARY_SIZE
+    sample_size: Optional[int] = None      # 训练时抽样的描述符数量，默认取配置 VISUAL_VOCABULARY_SAMPLE
+    debug: bool = False
 
 @app.get("/")
 async def root():
     return {"message": "ImageTwin API - 图片相似度搜索工具"}
 
+def save_upload(file: UploadFile) -> str:
+    """保存上传的图片到临时文件，返回临时文件路径"""
+    with metrics.stage('upload'), \
+            tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp_file:
+        shutil.copyfileobj(file.file, tmp_file)
+        return tmp_file.name
+
+def feature_match_targets(directory: str) -> List[str]:
+    """局部特征匹配的目标图片：目录中的所有图片，以及已索引的图片"""
+    image_paths = image_processor.scan_directory(directory)
+    indexed_images = db_manager.get_images_in_directory(directory)
+    return list(set(image_paths + [img[0] for img in indexed_images]))
+
+def resolve_page(limit: Optional[int], offset: int) -> int:
+    """检查分页参数，返回实际使用的每页结果数"""
+    if limit is None:
+        limit = config.SEARCH_PAGE_SIZE
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit 必须大于 0")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="offset 不能小于 0")
+    return min(limit, config.SEARCH_MAX_PAGE_SIZE)
+
+def page_window(top_k: Optional[int], limit: Optional[int], offset: int) -> Optional[int]:
+    """
+    需要选出的结果数：只对前 offset + limit 个结果做部分选择，不对全部命中排序；
+    limit 为 None 时不分页
+    """
+    if limit is None:
+        return top_k
+    window = offset + limit
+    return window if top_k is None else min(top_k, window)
+
+def page_info(matched: int, top_k: Optional[int], limit: Optional[int], offset: int) -> dict:
+    """分页信息：matched 为排名中的结果总数（不超过 top_k），next_offset 为下一页的起始位置"""
+    if top_k is not None:
+        matched = min(matched, top_k)
+    next_offset = None
+    if limit is not None and offset + limit < matched:
+        next_offset = offset + limit
+    return {"matched": matched, "offset": offset, "limit": limit, "next_offset": next_offset}
+
+def shortlist_feature_targets(temp_path: str, all_paths: List[str]) -> tuple:
+    """
+    视觉词袋索引就绪且候选较多时，只保留词袋得分最高的 FEATURE_SHORTLIST_SIZE 个候选
+    （以及还没有词袋的图片）交给特征匹配验证
+
+    返回: (候选路径, 查询图片特征或 None, 筛选统计或 None)；查询图片的特征只计算一次
+    """
+    if not visual_index.is_ready or not 0 < config.FEATURE_SHORTLIST_SIZE < len(all_paths):
+        return all_paths, None, None
+    query_features = image_processor.compute_features(temp_path)
+    if query_features[1] is None:
+        return all_paths, query_features, None
+    shortlist_stats = {}
+    with metrics.stage('shortlist'):
+        paths = visual_index.shortlist(query_features[1], all_paths,
+                                       config.FEATURE_SHORTLIST_SIZE, shortlist_stats)
+    return paths, query_features, shortlist_stats
+
+def run_feature_match_search(temp_path: str, directory: str, similarity_threshold: float,
+                             top_k: Optional[int], time_budget: Optional[float],
+                             limit: Optional[int] = None, offset: int = 0) -> dict:
+    """使用局部特征匹配搜索（适用于截图、部分匹配），在线程池中执行"""
+    all_paths = feature_match_targets(directory)
+    target_paths, query_features, shortlist_stats = shortlist_feature_targets(temp_path, all_paths)
+    
+    # 使用特征匹配搜索
+    match_stats = {}
+    results = image_processor.search_with_feature_match(
+        temp_path,
+        target_paths,
+        min_match_count=10,
+        threshold=similarity_threshold * 0.5,  # 特征匹配阈值更宽松
+        db_manager=db_manager,
+        workers=config.FEATURE_MATCH_WORKERS,
+        time_budget=time_budget if time_budget is not None else config.FEATURE_MATCH_TIME_BUDGET,
+        top_k=page_window(top_k, limit, offset),
+        stats=match_stats,
+        query_features=query_features
+    )
+    results = results[offset:]
+    
+    return {
+        "results": results,
+        "total": len(results),
+        **page_info(match_stats['matched'], top_k, limit, offset),
+        "method": "feature_match",
+        "partial": match_stats['partial'],
+        "processed": match_stats['processed'],
+        "candidates": len(all_paths),
+        "shortlist": shortlist_stats
+    }
+
+def upload_query_hash(temp_path: str, signatures: bool = False) -> tuple:
+    """
+    计算上传图片的 pHash（signatures 为 True 时同时计算级联搜索的签名），返回 (哈希, 签名)
+
+    按文件内容的摘要缓存，重复上传同一张图片时不再解码；哈希只取决于图片内容，不随索引变化
+    """
+    digest = file_digest(temp_path) if result_cache.enabled else None
+    cache_key = ("query_hash", digest, signatures)
+    if digest is not None:
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    
+    if signatures:
+        info, upload_hash = image_processor.analyze_image(temp_path, signatures=True)
+        value = (upload_hash, info['signatures'])
+    else:
+        value = (image_processor.calculate_hash(temp_path), None)
+    if digest is not None:
+        result_cache.put(cache_key, value)
+    return value
+
+def run_phash_search(temp_path: str, directory: str, similarity_threshold: float,
+                     cascade: bool = False, confirm_top: Optional[int] = None,
+                     top_k: Optional[int] = None, limit: Optional[int] = None,
+                     offset: int = 0) -> dict:
+    """
+    使用传统的感知哈希匹配，在线程池中执行
+
+    cascade: 先用 dhash/ahash/colorhash 排除候选，再用 pHash 排序
+    confirm_top: 对本页排名前 N 的结果做局部特征匹配确认，未通过的结果被移除；
+                 响应中的 confirmed 为通过确认的数量，matched/next_offset 仍是确认之前的排名
+    top_k: 只对相似度最高的 k 个结果排名
+    limit/offset: 只返回排名中 [offset, offset + limit) 的结果，只检查这些文件是否存在；
+                  已删除的文件从本页移除（计入 missing），不影响后续页的位置
+    排名结果按 (方法, 哈希, 目录, 阈值, 选择数量) 和索引版本号缓存，文件是否存在每次重新检查
+    """
+    # 先映射其他进程更新的快照（会递增版本号），否则命中缓存时直接返回，看不到新索引的记录；
+    # 再在搜索之前读取索引版本号，搜索期间索引发生变化时缓存的结果会被视为过期
+    db_manager.reload_snapshot_if_changed()
+    generation = db_manager.generation
+    window = page_window(top_k, limit, offset)
+    upload_hash, signatures = upload_query_hash(temp_path, cascade)
+    
+    method = "cascade" if cascade else "phash"
+    cache_key = (method, upload_hash, directory, similarity_threshold, window)
+    cached = result_cache.get(cache_key, generation)
+    if cached is not None:
+        similar_images, search_stats = cached[0], copy.deepcopy(cached[1])
+        search_stats['cached'] = True
+    else:
+        search_stats = {}
+        if cascade:
+            similar_images = db_manager.find_similar_images(
+                upload_hash,
+                directory,
+                similarity_threshold,
+                top_k=window,
+                stats=search_stats,
+                signatures=(signatures['dhash'], signatures['ahash'], signatures['colorhash']),
+                signature_threshold=similarity_threshold - config.CASCADE_SIGNATURE_MARGIN
+            )
+        else:
+            # 搜索相似图片
+            similar_images = db_manager.find_similar_images(
+                upload_hash, 
+                directory, 
+                similarity_threshold,
+                top_k=window,
+                stats=search_stats
+            )
+        result_cache.put(cache_key, (similar_images, copy.deepcopy(search_stats)), generation)
+    
+    results = []
+    missing = 0
+    for image_path, stored_hash, similarity in similar_images[offset:]:
+        if os.path.exists(image_path):
+            results.append({
+                "path": image_path,
+                "similarity": similarity,
+                "exists": True
+            })
+        else:
+            missing += 1
+    
+    confirmed = {}
+    if confirm_top is not None:
+        results = confirm_with_feature_match(temp_path, results[:confirm_top],
+                                             similarity_threshold, search_stats)
+        confirmed = {"confirmed": len(results)}
+    
+    return {
+        "results": results,
+        "total": len(results),
+        **page_info(search_stats.get('matched', len(similar_images)), top_k, limit, offset),
+        **confirmed,
+        "missing": missing,
+        "query_hash": str(upload_hash),
+        "method": method,
+        "search_stats": search_stats
+    }
+
+def confirm_with_feature_match(temp_path: str, results: List[dict], similarity_threshold: float,
+                               search_stats: dict) -> List[dict]:
+    """用局部特征匹配确认感知哈希的结果，只保留匹配得分达到阈值的图片"""
+    matches = image_processor.search_with_feature_match(
+        temp_path,
+        [result["path"] for result in results],
+        min_match_count=10,
+        threshold=similarity_threshold * 0.5,  # 与特征匹配搜索相同的阈值
+        db_manager=db_manager,
+        workers=config.FEATURE_MATCH_WORKERS
+    )
+    scores = {match["path"]: match["similarity"] for match in matches}
+    confirmed = []
+    for result in results:
+        if result["path"] in scores:
+            result["feature_score"] = scores[result["path"]]
+            confirmed.append(result)
+    
+    search_stats.setdefault('stages', []).append({
+        'stage': 'feature',
+        'pruned': len(results) - len(confirmed),
+        'remaining': len(confirmed)
+    })
+    return confirmed
+
+def run_timed(debug: bool, func, *args) -> dict:
+    """执行 func；debug 为 True 时在返回的结果中附加各处理阶段的耗时明细（timings）"""
+    if not debug:
+        return func(*args)
+    with metrics.collect_timings() as collector:
+        result = func(*args)
+    result["timings"] = collector.summary()
+    return result
+
+def run_search(file: UploadFile, search, *args) -> dict:
+    """保存上传文件并执行搜索，结束后清理临时文件"""
+    temp_path = save_upload(file)
+    try:
+        return search(temp_path, *args)
+    finally:
+        # 清理临时文件
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
 @app.post("/api/search")
 async def search_similar_images(
     file: UploadFile = File(...),
     directory: str = Form(...),
     similarity_threshold: float = Form(0.8),
-    use_feature_match: bool = Form(False)
+    use_feature_match: bool = Form(False),
+    top_k: Optional[int] = Form(None, ge=1),
+    time_budget: Optional[float] = Form(None),
+    cascade: bool = Form(False),
+    confirm_top: Optional[int] = Form(None, ge=1),
+    limit: Optional[int] = Form(None),
+    offset: int = Form(0),
+    debug: bool = Form(False)
 ):
-    """搜索相似图片"""
+    """
+    搜索相似图片
+
+    结果分页返回：limit（默认 SEARCH_PAGE_SIZE）和 offset 选择排名中的一页，
+    响应中的 matched 为排名中的结果总数，next_offset 为下一页的 offset（没有下一页时为 null）。
+    指定 confirm_top 时只确认本页的结果：total 和 confirmed 为本页通过确认的数量，
+    matched 和 next_offset 仍按确认之前的感知哈希排名计算
+    """
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="文件必须是图片格式")
-    
-    # 保存上传的图片到临时文件
-    with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp_file:
-        shutil.copyfileobj(file.file, tmp_file)
-        temp_path = tmp_file.name
+    limit = resolve_page(limit, offset)
     
     try:
-        if use_feature_match:
-            # 使用局部特征匹配（适用于截图、部分匹配）
+        if use_feature_match or confirm_top is not None:
             from image_processor import CV2_AVAILABLE
             if not CV2_AVAILABLE:
                 raise HTTPException(
@@ -76,91 +494,508 @@ async def search_similar_images(
                     detail="局部特征匹配需要安装 OpenCV。请运行: pip install opencv-python numpy"
                 )
             
-            # 获取目录中的所有图片
-            image_paths = image_processor.scan_directory(directory)
-            
-            # 也包含已索引的图片
-            indexed_images = db_manager.get_images_in_directory(directory)
-            all_paths = list(set(image_paths + [img[0] for img in indexed_images]))
-            
-            # 使用特征匹配搜索
-            results = image_processor.search_with_feature_match(
-                temp_path,
-                all_paths,
-                min_match_count=10,
-                threshold=similarity_threshold * 0.5  # 特征匹配阈值更宽松
+        if use_feature_match:
+            return await feature_search_executor.run(
+                run_timed, debug, run_search, file, run_feature_match_search,
+                directory, similarity_threshold, top_k, time_budget, limit, offset
             )
-            
-            return {
-                "results": results,
-                "total": len(results),
-                "method": "feature_match"
-            }
         else:
-            # 使用传统的感知哈希匹配
-            upload_hash = image_processor.calculate_hash(temp_path)
-            
-            # 搜索相似图片
-            similar_images = db_manager.find_similar_images(
-                upload_hash, 
-                directory, 
-                similarity_threshold
+            # 需要特征确认时占用特征匹配的并发名额
+            executor = feature_search_executor if confirm_top is not None else phash_search_executor
+            return await executor.run(
+                run_timed, debug, run_search, file, run_phash_search,
+                directory, similarity_threshold, cascade, confirm_top, top_k, limit, offset
             )
-            
-            results = []
-            for image_path, stored_hash, similarity in similar_images:
-                if os.path.exists(image_path):
-                    results.append({
-                        "path": image_path,
-                        "similarity": similarity,
-                        "exists": True
-                    })
-            
-            return {
-                "results": results,
-                "total": len(results),
-                "query_hash": str(upload_hash),
-                "method": "phash"
-            }
         
-    except HTTPException:
+    except (HTTPException, ServiceBusyError):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"搜索失败: {str(e)}")
+
+def run_stream_search(emit, cancel_event: threading.Event, file: UploadFile, directory: str,
+                      similarity_threshold: float, use_feature_match: bool,
+                      time_budget: Optional[float], limit: int, offset: int):
+    """
+    流式搜索的工作函数，在线程池中执行，通过 emit 逐个发送事件：
+    start（候选数量）、match（一个结果）、progress（已处理数量）、done（汇总）
+    cancel_event 被设置（客户端断开）后不再处理新的图片
+    感知哈希搜索按 limit/offset 分页，done 事件带 matched 和 next_offset；
+    特征匹配的 done 事件中 partial 表示因超出时间限制而停止，cancelled 表示被取消；
+    查询图片提取不到特征点时只发送一个 error 事件
+    """
+    temp_path = save_upload(file)
+    try:
+        if not use_feature_match:
+            result = run_phash_search(temp_path, directory, similarity_threshold,
+                                      limit=limit, offset=offset)
+            emit({"type": "start", "method": "phash", "candidates": result["search_stats"].get("total", 0)})
+            for match in result["results"]:
+                emit({"type": "match", "result": match})
+            emit({"type": "done", "total": result["total"], "query_hash": result["query_hash"],
+                  "matched": result["matched"], "offset": offset, "next_offset": result["next_offset"],
+                  "partial": False})
+            return
+        
+        all_paths = feature_match_targets(directory)
+        target_paths, query_features, shortlist_stats = shortlist_feature_targets(temp_path, all_paths)
+        if query_features is None:
+            query_features = image_processor.compute_features(temp_path)
+        if query_features[1] is None:
+            emit({"type": "error", "detail": "查询图片中没有可用于局部特征匹配的特征点"})
+            return
+        emit({"type": "start", "method": "feature_match", "candidates": len(all_paths),
+              "shortlist": shortlist_stats})
+        
+        if time_budget is None:
+            time_budget = config.FEATURE_MATCH_TIME_BUDGET
+        deadline = time.monotonic() + time_budget if time_budget else None
+        processed = 0
+        found = 0
+        for index, count, results in image_processor.iter_feature_matches(
+            temp_path,
+            target_paths,
+            min_match_count=10,
+            threshold=similarity_threshold * 0.5,  # 与非流式的特征匹配搜索相同
+            db_manager=db_manager,
+            workers=config.FEATURE_MATCH_WORKERS,
+            deadline=deadline,
+            cancel_event=cancel_event,
+            query_features=query_features
+        ):
+            processed += count
+            for match in results:
+                emit({"type": "match", "result": match})
+            found += len(results)
+            emit({"type": "progress", "processed": processed, "total": len(target_paths), "found": found})
+        
+        cancelled = cancel_event.is_set()
+        # 与非流式搜索相同：只有确实到达时间限制才算部分结果
+        partial = (not cancelled and deadline is not None and processed < len(target_paths)
+                   and time.monotonic() >= deadline)
+        emit({"type": "done", "total": found, "processed": processed,
+              "partial": partial, "cancelled": cancelled})
     finally:
         # 清理临时文件
         if os.path.exists(temp_path):
             os.unlink(temp_path)
 
-@app.post("/api/index")
-async def index_directory(request: IndexRequest):
-    """索引指定目录中的图片"""
+def format_stream_event(event: dict, stream_format: str) -> str:
+    """把事件编码为一行 NDJSON 或一条 SSE 消息"""
+    data = json.dumps(event, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {event['type']}\ndata: {data}\n\n"
+    return data + "\n"
+
+@app.post("/api/search/stream")
+async def stream_search_similar_images(
+    request: Request,
+    file: UploadFile = File(...),
+    directory: str = Form(...),
+    similarity_threshold: float = Form(0.8),
+    use_feature_match: bool = Form(False),
+    time_budget: Optional[float] = Form(None),
+    limit: Optional[int] = Form(None),
+    offset: int = Form(0),
+    format: str = Form("ndjson")
+):
+    """
+    流式搜索相似图片：边处理边返回结果和进度，format 为 ndjson（每行一个 JSON 事件）
+    或 sse（server-sent events）。客户端断开后立即停止处理剩余图片。
+    特征匹配的结果按发现顺序发送，不做 top_k 截断，由客户端排序；
+    感知哈希搜索与 /api/search 相同按 limit/offset 分页。
+    """
+    if not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="文件必须是图片格式")
+    limit = resolve_page(limit, offset)
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail=f"不支持的格式: {format}")
+    if use_feature_match:
+        from image_processor import CV2_AVAILABLE
+        if not CV2_AVAILABLE:
+            raise HTTPException(
+                status_code=400, 
+                detail="局部特征匹配需要安装 OpenCV。请运行: pip install opencv-python numpy"
+            )
+    
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancel_event = threading.Event()
+    
+    def emit(event: dict):
+        loop.call_soon_threadsafe(queue.put_nowait, event)
+    
+    # 在开始响应之前提交，名额已满时仍能返回 503
+    executor = feature_search_executor if use_feature_match else phash_search_executor
+    task = executor.submit(
+        run_stream_search, emit, cancel_event, file, directory,
+        similarity_threshold, use_feature_match, time_budget, limit, offset
+    )
+    # 工作函数的事件都在完成回调之前进入队列，None 表示结束
+    task.add_done_callback(lambda _: queue.put_nowait(None))
+    
+    async def events():
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    # 长时间没有事件时检查客户端是否已断开
+                    if await request.is_disconnected():
+                        return
+                    continue
+                if event is None:
+                    break
+                yield format_stream_event(event, format)
+            
+            if not task.cancelled() and task.exception() is not None:
+                yield format_stream_event({"type": "error", "detail": f"搜索失败: {str(task.exception())}"},
+                                          format)
+        finally:
+            # 正常结束、客户端断开或响应被取消时都通知工作线程停止
+            cancel_event.set()
+    
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def run_batch_search(files: List[UploadFile], hashes: List[str], directory: str,
+                     similarity_threshold: float, top_k: Optional[int],
+                     limit: Optional[int] = None) -> dict:
+    """
+    批量搜索：并行计算上传图片的哈希，再一次扫描索引比较全部查询，在线程池中执行
+    每个查询最多返回 limit 个结果
+    """
+    queries = []
+    temp_paths = []
     try:
-        total_indexed = 0
-        for directory in request.directories:
-            if not os.path.exists(directory):
+        uploads = []
+        for file in files:
+            query = {"query": file.filename, "source": "file"}
+            queries.append(query)
+            if not (file.content_type or "").startswith('image/'):
+                query["error"] = "文件必须是图片格式"
                 continue
-                
-            indexed_count = image_processor.index_directory(directory, db_manager)
-            total_indexed += indexed_count
+            temp_paths.append(save_upload(file))
+            uploads.append(query)
+        
+        hash_results = image_processor.calculate_hashes(temp_paths, config.BATCH_HASH_WORKERS)
+        for query, (hash_value, error) in zip(uploads, hash_results):
+            if error is not None:
+                query["error"] = error
+            else:
+                query["query_hash"] = hash_value
+    finally:
+        # 清理临时文件
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+    
+    for hash_value in hashes:
+        hash_value = hash_value.strip().lower()
+        query = {"query": hash_value, "source": "hash"}
+        # 长度不同的哈希不会与索引中的任何记录比较，与格式错误一样报告
+        if re.fullmatch(r'[0-9a-f]{%d}' % ImageProcessor.HASH_HEX_LENGTH, hash_value):
+            query["query_hash"] = hash_value
+        else:
+            query["error"] = "无效的哈希值"
+        queries.append(query)
+    
+    searchable = [query for query in queries if "query_hash" in query]
+    search_stats = {}
+    matches = db_manager.find_similar_images_batch(
+        [query["query_hash"] for query in searchable],
+        directory,
+        similarity_threshold,
+        top_k=page_window(top_k, limit, 0),
+        stats=search_stats
+    )
+    
+    # 同一张图片可能出现在多个查询的结果中，只检查一次是否存在
+    exists = {}
+    for query, similar_images in zip(searchable, matches):
+        results = []
+        for image_path, stored_hash, similarity in similar_images:
+            if image_path not in exists:
+                exists[image_path] = os.path.exists(image_path)
+            if exists[image_path]:
+                results.append({
+                    "path": image_path,
+                    "similarity": similarity,
+                    "exists": True
+                })
+        query["results"] = results
+        query["total"] = len(results)
+    for query in queries:
+        query.setdefault("results", [])
+        query.setdefault("total", 0)
+    
+    return {
+        "queries": queries,
+        "total_queries": len(queries),
+        "limit": limit,
+        "method": "phash",
+        "search_stats": search_stats
+    }
+
+@app.post("/api/search/batch")
+async def batch_search_similar_images(
+    files: Optional[List[UploadFile]] = File(None),
+    hashes: Optional[List[str]] = Form(None),
+    directory: str = Form(""),
+    similarity_threshold: float = Form(0.8),
+    top_k: Optional[int] = Form(None),
+    limit: Optional[int] = Form(None),
+    debug: bool = Form(False)
+):
+    """
+    批量搜索相似图片：上传多张图片（files）和/或预先计算的感知哈希（hashes），
+    按查询顺序返回每个查询的结果，每个查询最多 limit（默认 SEARCH_PAGE_SIZE）个
+    """
+    files = files or []
+    hashes = hashes or []
+    query_count = len(files) + len(hashes)
+    if query_count == 0:
+        raise HTTPException(status_code=400, detail="至少需要一张图片或一个哈希值")
+    if query_count > config.BATCH_SEARCH_MAX_QUERIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"每次最多查询 {config.BATCH_SEARCH_MAX_QUERIES} 个，当前 {query_count} 个"
+        )
+    limit = resolve_page(limit, 0)
+    
+    try:
+        return await phash_search_executor.run(
+            run_timed, debug, run_batch_search, files, hashes,
+            directory, similarity_threshold, top_k, limit
+        )
+    except ServiceBusyError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"批量搜索失败: {str(e)}")
+
+def index_signatures(request: IndexRequest) -> bool:
+    """索引请求是否需要计算级联搜索的签名"""
+    return config.COMPUTE_SIGNATURES if request.signatures is None else request.signatures
+
+def request_scan_options(request) -> dict:
+    """索引或监控请求（IndexRequest/WatchRequest）中覆盖默认扫描选项的部分"""
+    if request.follow_symlinks is not None and request.follow_symlinks not in SYMLINK_POLICIES:
+        raise HTTPException(status_code=400, detail=f"未知的符号链接策略: {request.follow_symlinks}")
+    if request.max_depth is not None and request.max_depth < 0:
+        raise HTTPException(status_code=400, detail="max_depth 不能小于 0")
+    return {
+        'exclude': request.exclude,
+        'symlinks': request.follow_symlinks,
+        'max_depth': request.max_depth
+    }
+
+def run_index(request: IndexRequest, scan_options: dict) -> dict:
+    """同步索引目录，在线程池中执行"""
+    totals = {'indexed': 0, 'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'failed': 0}
+    for directory in request.directories:
+        if not os.path.exists(directory):
+            continue
             
-            # 保存最后索引的目录
-            try:
-                settings = {"last_directory": directory}
-                with open("settings.json", "w", encoding="utf-8") as f:
-                    json.dump(settings, f, ensure_ascii=False, indent=2)
-            except:
-                pass
+        stats = image_processor.index_directory(
+            directory, db_manager,
+            incremental=request.incremental,
+            workers=request.workers,
+            batch_size=request.batch_size,
+            extract_features=request.extract_features,
+            signatures=index_signatures(request),
+            scan_options=scan_options
+        )
+        for key in totals:
+            totals[key] += stats[key]
         
-        return {
-            "message": f"成功索引 {total_indexed} 张图片",
-            "indexed_count": total_indexed
-        }
+        save_last_directory(directory)
+    db_manager.export_snapshot()
+    visual_index.update()
+    
+    message = f"成功索引 {totals['indexed']} 张图片"
+    if request.incremental:
+        message += (f"（新增 {totals['added']}，更新 {totals['updated']}，"
+                    f"未变化 {totals['unchanged']}，移除 {totals['removed']}）")
+    
+    return {
+        "message": message,
+        "indexed_count": totals['indexed'],
+        "added_count": totals['added'],
+        "updated_count": totals['updated'],
+        "unchanged_count": totals['unchanged'],
+        "removed_count": totals['removed'],
+        "failed_count": totals['failed']
+    }
+
+@app.post("/api/index")
+async def index_directory(request: IndexRequest):
+    """索引指定目录中的图片（同步返回结果；大目录建议使用 /api/index/jobs）"""
+    try:
+        return await maintenance_executor.run(run_timed, request.debug, run_index, request,
+                                              request_scan_options(request))
+    except (HTTPException, ServiceBusyError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"索引失败: {str(e)}")
 
+@app.post("/api/index/jobs")
+def create_index_job(request: IndexRequest):
+    """
+    创建后台索引任务，立即返回任务ID
+    任务接口会读写数据库，定义为普通函数由 FastAPI 在线程池中执行，不阻塞事件循环
+    """
+    directories = [d for d in request.directories if os.path.exists(d)]
+    if not directories:
+        raise HTTPException(status_code=400, detail="没有可索引的目录")
+    
+    job = index_jobs.submit(
+        directories,
+        workers=request.workers,
+        batch_size=request.batch_size,
+        extract_features=request.extract_features,
+        signatures=index_signatures(request),
+        scan_options=request_scan_options(request)
+    )
+    save_last_directory(directories[-1])
+    return job
+
+@app.get("/api/index/jobs")
+def list_index_jobs():
+    """列出所有后台索引任务"""
+    return {"jobs": index_jobs.list()}
+
+@app.get("/api/index/jobs/{job_id}")
+async def get_index_job(job_id: str):
+    """获取后台索引任务的进度"""
+    job = index_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="索引任务不存在")
+    return job
+
+@app.post("/api/index/jobs/{job_id}/cancel")
+def cancel_index_job(job_id: str):
+    """取消后台索引任务，已提交的结果会保留"""
+    job = index_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="索引任务不存在")
+    return job
+
+@app.post("/api/index/jobs/{job_id}/resume")
+def resume_index_job(job_id: str):
+    """继续被取消、中断或失败的索引任务"""
+    job = index_jobs.resume(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="索引任务不存在")
+    return job
+
+def run_visual_index_build(request: VisualIndexRequest) -> dict:
+    stats = visual_index.build(request.vocabulary_size, request.sample_size)
+    return {
+        "message": f"视觉词袋索引已建立，{stats['images']} 张图片，{stats['vocabulary_size']} 个视觉词",
+        **stats
+    }
+
+@app.post("/api/visual-index/build")
+async def build_visual_index(request: VisualIndexRequest = VisualIndexRequest()):
+    """
+    从已缓存的 ORB 描述符（索引时 extract_features=true）训练视觉词汇表并建立词袋索引；
+    之后局部特征匹配只验证词袋得分最高的候选，索引任务完成后新图片的词袋自动补充
+    """
+    if request.vocabulary_size is not None and request.vocabulary_size < 2:
+        raise HTTPException(status_code=400, detail="vocabulary_size 必须大于 1")
+    if request.sample_size is not None and request.sample_size < 1:
+        raise HTTPException(status_code=400, detail="sample_size 必须大于 0")
+    try:
+        return await maintenance_executor.run(run_timed, request.debug, run_visual_index_build, request)
+    except (HTTPException, ServiceBusyError):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"建立视觉词袋索引失败: {str(e)}")
+
+@app.post("/api/dedupe")
+async def create_dedupe_job(request: DedupeRequest):
+    """创建后台去重任务，在已索引的哈希中查找重复图片组"""
+    try:
+        return dedupe_jobs.submit(request.directory, request.similarity_threshold, request.exact)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/dedupe")
+async def list_dedupe_jobs():
+    """列出去重任务"""
+    return {"jobs": dedupe_jobs.list()}
+
+@app.get("/api/dedupe/{job_id}")
+async def get_dedupe_job(job_id: str):
+    """获取去重任务的进度和结果摘要"""
+    job = dedupe_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="去重任务不存在")
+    return job
+
+@app.post("/api/dedupe/{job_id}/cancel")
+async def cancel_dedupe_job(job_id: str):
+    """取消去重任务"""
+    job = dedupe_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="去重任务不存在")
+    return job
+
+@app.get("/api/dedupe/{job_id}/export")
+def export_dedupe_groups(job_id: str, format: str = "json"):
+    """导出重复组，format 为 json 或 csv"""
+    job = dedupe_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="去重任务不存在")
+    groups = dedupe_jobs.get_groups(job_id)
+    if groups is None:
+        raise HTTPException(status_code=409, detail="去重任务尚未完成")
+    
+    if format == "csv":
+        return Response(
+            content=export_groups_csv(groups),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="duplicates-{job_id}.csv"'}
+        )
+    if format != "json":
+        raise HTTPException(status_code=400, detail="导出格式必须是 json 或 csv")
+    return {
+        "job_id": job_id,
+        "similarity_threshold": job['similarity_threshold'],
+        "summary": job['summary'],
+        "groups": [{"id": group_id, "size": len(group), "files": group}
+                   for group_id, group in enumerate(groups, 1)]
+    }
+
+@app.get("/api/watch")
+async def list_watched_directories():
+    """列出正在监控的目录及监控统计"""
+    return watcher.get_stats()
+
+@app.post("/api/watch")
+def watch_directory(request: WatchRequest):
+    """
+    开始监控目录，文件变化会自动同步到索引
+    添加/移除 watchdog 监控会访问文件系统，定义为普通函数由 FastAPI 在线程池中执行
+    """
+    if not watcher.watch(request.directory, request_scan_options(request)):
+        raise HTTPException(status_code=400, detail="目录不存在")
+    return watcher.get_stats()
+
+@app.delete("/api/watch")
+def unwatch_directory(directory: str):
+    """停止监控目录"""
+    if not watcher.unwatch(directory):
+        raise HTTPException(status_code=404, detail="目录未被监控")
+    return watcher.get_stats()
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus 指标"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/api/status")
-async def get_status():
+def get_status():
     """获取系统状态"""
     total_images = db_manager.get_total_images()
     # 读取上次索引的目录
@@ -176,22 +1011,62 @@ async def get_status():
     return {
         "total_indexed_images": total_images,
         "status": "running",
-        "last_directory": last_directory
+        "last_directory": last_directory,
+        "index_stats": db_manager.get_index_stats(),
+        "thumbnail_cache": thumbnail_cache.get_stats(),
+        "result_cache": dict(result_cache.get_stats(), index_generation=db_manager.generation),
+        "visual_index": visual_index.get_stats(),
+        "watcher": watcher.get_stats(),
+        "executors": {
+            executor.name: executor.get_stats()
+            for executor in executors
+        }
     }
 
+def clear_all_and_export():
+    db_manager.clear_all()
+    db_manager.export_snapshot()
+    # 词汇表保留，词袋已随索引一起删除
+    visual_index.load()
+
 @app.delete("/api/clear-index")
 async def clear_index():
     """清空索引"""
     try:
-        db_manager.clear_all()
+        await maintenance_executor.run(clear_all_and_export)
+        # 索引版本号已经变化，缓存的结果不会再被使用，这里直接释放内存
+        result_cache.clear()
         return {"message": "索引已清空"}
+    except ServiceBusyError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"清空索引失败: {str(e)}")
 
+def is_not_modified(request: Request, etag: str, stat: os.stat_result) -> bool:
+    """根据 If-None-Match / If-Modified-Since 判断客户端缓存是否仍然有效"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP 日期精确到秒
+        return int(stat.st_mtime) <= since
+    return False
+
 @app.get("/api/image/{image_path:path}")
-async def get_image(image_path: str):
-    """获取图片文件"""
-    from fastapi.responses import FileResponse
+def get_image(image_path: str, request: Request, size: Optional[int] = None, format: str = "jpeg"):
+    """
+    获取图片文件
+
+    size: 返回最长边不超过该值的缩略图（缓存在磁盘上），不传时返回原图
+    format: 缩略图格式，jpeg 或 webp
+    """
     import urllib.parse
     
     # URL解码
@@ -204,7 +1079,32 @@ async def get_image(image_path: str):
     if not image_processor.is_image_file(decoded_path):
         raise HTTPException(status_code=400, detail="不是有效的图片文件")
     
-    return FileResponse(decoded_path)
+    if size is not None and not 16 <= size <= config.THUMBNAIL_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"缩略图尺寸必须在 16 到 {config.THUMBNAIL_MAX_SIZE} 之间")
+    if format not in thumbnail_cache.FORMATS:
+        raise HTTPException(status_code=400, detail="缩略图格式必须是 jpeg 或 webp")
+    
+    # 校验值只取决于源文件和请求的缩略图参数，命中时不需要读取或生成图片
+    stat = os.stat(decoded_path)
+    variant = f"-{size}-{format}" if size is not None else ""
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{variant}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": "no-cache"
+    }
+    
+    if is_not_modified(request, etag, stat):
+        return Response(status_code=304, headers=headers)
+    
+    if size is None:
+        return FileResponse(decoded_path, headers=headers)
+    
+    try:
+        thumbnail_path = thumbnail_cache.get(decoded_path, size, format, stat=stat)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return FileResponse(thumbnail_path, media_type=thumbnail_cache.media_type(format), headers=headers)
 
 if __name__ == "__main__":
     import uvicorn
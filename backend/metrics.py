@@ -0,0 +1,352 @@
+"""
+运行指标
+
+提供 Prometheus 文本格式的计数器、仪表和直方图（不依赖 prometheus_client），
+以及按处理阶段计时的 stage() 上下文管理器：
+
+    with metrics.stage('decode'):
+        img.load()
+
+每个阶段的耗时记入 imagetwin_stage_duration_seconds 直方图；在 collect_timings()
+范围内执行时，同时记入当前请求的耗时明细（用于调试）。
+指标被关闭且没有收集明细时，stage() 直接返回一个共享的空上下文，几乎没有开销。
+"""
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from typing import Callable, List, Optional, Tuple
+
+_enabled = True
+_registry = []
+# 当前请求（或工作线程任务）的耗时收集器
+_collector = contextvars.ContextVar('imagetwin_timings', default=None)
+_NULL = nullcontext()
+
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def set_enabled(enabled: bool):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def is_active() -> bool:
+    """是否需要计时：指标已开启或当前正在收集耗时明细"""
+    return _enabled or _collector.get() is not None
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """带标签的指标：labels(...) 返回对应标签值的子指标，没有标签时直接操作自身"""
+
+    TYPE = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        _registry.append(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self) -> List[Tuple[str, Tuple[str, ...], str, float]]:
+        """返回 (后缀, 标签值, 额外标签, 数值) 列表"""
+        samples = []
+        for values, child in sorted(self._children.items()):
+            samples.extend((suffix, values, extra, value) for suffix, extra, value in child.samples())
+        return samples
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for suffix, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} "
+                         f"{_format_value(value)}")
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        if not _enabled:
+            return
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [('_total', '', self.value)]
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    TYPE = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        if not _enabled:
+            return
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self):
+        return [('', '', self.value)]
+
+
+class Gauge(_Metric):
+    """
+    可增可减的仪表
+
+    set_function 设置后在导出时调用函数取值；有标签的仪表的函数返回 {标签值元组: 数值}
+    """
+
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Optional[Callable]):
+        self._function = function
+
+    def _samples(self):
+        if self._function is None:
+            return super()._samples()
+        try:
+            value = self._function()
+        except Exception as e:
+            print(f"读取指标 {self.name} 失败: {str(e)}")
+            return []
+        if not self.labelnames:
+            return [('', (), '', value)]
+        return [('', tuple(str(v) for v in values), '', item) for values, item in sorted(value.items())]
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        if not _enabled:
+            return
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('_bucket', f'le="{_format_value(float(bound))}"', cumulative))
+        samples.append(('_sum', '', total))
+        samples.append(('_count', '', cumulative))
+        return samples
+
+
+class Histogram(_Metric):
+    """分桶直方图（桶的上界包含在内）"""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+
+def render() -> str:
+    """导出全部指标（Prometheus 文本格式）"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram(
+    'imagetwin_stage_duration_seconds',
+    '各处理阶段的耗时（decode/hash/db_query/compare/db_write/orb_extract/orb_match/upload）',
+    ('stage',)
+)
+INDEX_FILES = Counter(
+    'imagetwin_index_files',
+    '索引处理的文件数（result: indexed/failed/skipped）',
+    ('result',)
+)
+INDEX_SIZE = Gauge('imagetwin_index_size', '已索引的图片数量')
+HTTP_IN_FLIGHT = Gauge('imagetwin_http_requests_in_flight', '正在处理的 HTTP 请求数')
+HTTP_REQUEST_SECONDS = Histogram(
+    'imagetwin_http_request_duration_seconds',
+    'HTTP 请求耗时',
+    ('method', 'route', 'status'),
+    buckets=REQUEST_BUCKETS
+)
+EXECUTOR_IN_FLIGHT = Gauge(
+    'imagetwin_executor_in_flight',
+    '有界执行器中正在执行和排队的任务数',
+    ('executor',)
+)
+EXECUTOR_REJECTED = Counter(
+    'imagetwin_executor_rejected',
+    '有界执行器因名额已满拒绝的任务数',
+    ('executor',)
+)
+
+
+class TimingCollector:
+    """收集一次请求中各阶段的耗时样本"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+        self.started = time.perf_counter()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.samples.append((stage, seconds))
+
+    def summary(self) -> dict:
+        """
+        各阶段的次数和累计耗时（秒）；并行执行时阶段累计耗时之和可能超过 total_seconds
+        """
+        stages = {}
+        with self._lock:
+            samples = list(self.samples)
+        for stage, seconds in samples:
+            entry = stages.setdefault(stage, {'count': 0, 'seconds': 0.0})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+        return {
+            'total_seconds': time.perf_counter() - self.started,
+            'stages': stages
+        }
+
+
+class _StageTimer:
+    __slots__ = ('name', 'collector', 'started')
+
+    def __init__(self, name: str, collector: Optional[TimingCollector]):
+        self.name = name
+        self.collector = collector
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        if _enabled:
+            STAGE_SECONDS.labels(self.name).observe(elapsed)
+        if self.collector is not None:
+            self.collector.add(self.name, elapsed)
+        return False
+
+
+def stage(name: str):
+    """对一个处理阶段计时"""
+    collector = _collector.get()
+    if not _enabled and collector is None:
+        return _NULL
+    return _StageTimer(name, collector)
+
+
+@contextmanager
+def collect_timings():
+    """在此范围内（包括通过 contextvars 传递上下文的线程）记录各阶段耗时明细"""
+    collector = TimingCollector()
+    token = _collector.set(collector)
+    try:
+        yield collector
+    finally:
+        _collector.reset(token)
+
+
+def record_samples(samples: List[Tuple[str, float]]):
+    """记录在其他进程中收集的阶段耗时样本"""
+    collector = _collector.get()
+    for name, seconds in samples:
+        if _enabled:
+            STAGE_SECONDS.labels(name).observe(seconds)
+        if collector is not None:
+            collector.add(name, seconds)
+
+
+def count_files(result: str, amount: int = 1):
+    """记录索引处理的文件数"""
+    if _enabled and amount:
+        INDEX_FILES.labels(result).inc(amount)
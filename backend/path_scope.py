@@ -0,0 +1,37 @@
+"""
+目录范围工具
+
+数据库和内存索引都按规范化的父目录（parent_dir）划分范围：
+查询目录 D 时匹配 parent_dir == D 或 D/ <= parent_dir < D0（'0' 是分隔符 '/' 的下一个字符），
+两者都能走索引（或二分查找），并且不会匹配到 /data/photos2 这样的兄弟目录。
+"""
+import os
+from typing import Optional, Tuple
+
+
+def normalize_directory(directory: str) -> str:
+    """规范化目录路径：去掉多余的分隔符和末尾分隔符，Windows 上统一大小写和分隔符"""
+    return os.path.normcase(os.path.normpath(directory))
+
+
+def parent_directory(file_path: str) -> str:
+    """文件所在目录的规范化路径，存入 parent_dir 列"""
+    return normalize_directory(os.path.dirname(os.path.normpath(file_path)))
+
+
+def directory_range(directory: str) -> Optional[Tuple[str, str, str]]:
+    """
+    目录范围对应的查询条件
+
+    返回: (目录本身, 子目录下界, 子目录上界)，
+          匹配 parent_dir == 目录本身 或 下界 <= parent_dir < 上界；
+          directory 为空时返回 None，表示不限制目录
+    """
+    if not directory:
+        return None
+
+    directory = normalize_directory(directory)
+    # 根目录（/ 或 C:\）规范化后仍以分隔符结尾
+    prefix = directory if directory.endswith(os.sep) else directory + os.sep
+    upper = prefix[:-1] + chr(ord(os.sep) + 1)
+    return directory, prefix, upper
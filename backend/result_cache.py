@@ -0,0 +1,110 @@
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+def file_digest(path: str) -> str:
+    """计算文件内容的 SHA-256，用作上传图片的缓存键"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def estimate_size(value: Any) -> int:
+    """粗略估计缓存值占用的内存（字节），用于按内存上限淘汰"""
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    """
+    内存中的搜索结果缓存（LRU + TTL）
+
+    条目按最近使用顺序保存，总大小超过 max_bytes 时淘汰最久未使用的条目，
+    超过 ttl 秒的条目在读取时视为未命中。写入时可以记录索引的版本号（generation），
+    读取时版本号不一致的条目视为过期并删除，索引变化后旧结果不会再被返回。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 600.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (value, size, generation, expires_at)
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        self._evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: Hashable, generation: Optional[int] = None) -> Optional[Any]:
+        """返回缓存的值；不存在、已超时或索引版本不一致时返回 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            value, size, entry_generation, expires_at = entry
+            if entry_generation != generation or (expires_at is not None and time.monotonic() >= expires_at):
+                self._remove(key)
+                self._stale += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, generation: Optional[int] = None,
+            size: Optional[int] = None):
+        """写入缓存；单个条目超过上限时不缓存"""
+        if not self.enabled:
+            return
+        if size is None:
+            size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, generation, expires_at)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evicted += 1
+
+    def _remove(self, key: Hashable):
+        _, size, _, _ = self._entries.pop(key)
+        self._total_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'total_bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'stale': self._stale,
+                'evicted': self._evicted
+            }
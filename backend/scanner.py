@@ -0,0 +1,151 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# 符号链接策略:
+#   skip    忽略所有符号链接
+#   files   跟随指向文件的链接，不进入链接的目录（与 Path.rglob 的行为相同）
+#   follow  同时进入链接的目录，按 (设备, inode) 去重，避免循环
+SYMLINK_POLICIES = ('skip', 'files', 'follow')
+
+
+class DirectoryScanner:
+    """
+    基于 os.scandir 的流式目录扫描器
+
+    逐个产出匹配的文件的 os.DirEntry，不预先构建完整的文件列表，调用方可以边扫描边处理。
+    workers > 1 时由线程池并行列出子目录（网络挂载盘上 readdir/stat 的延迟可以重叠），
+    结果仍按广度优先、目录提交的顺序产出，多次扫描同一目录的顺序一致。
+    prefetch_stat=True 时在列目录的线程中预先调用 entry.stat()，
+    DirEntry 会缓存结果，调用方再取大小和修改时间时不再访问文件系统。
+    """
+
+    def __init__(self, extensions: Optional[Iterable[str]] = None, exclude: Iterable[str] = (),
+                 symlinks: str = 'files', max_depth: Optional[int] = None, workers: int = 1,
+                 prefetch_stat: bool = False):
+        """
+        extensions: 只产出这些扩展名（小写，含点）的文件，None 表示不过滤
+        exclude: fnmatch 模式，与文件/目录名或相对于扫描根目录的路径（用 / 分隔）匹配的条目被跳过
+        symlinks: 符号链接策略，见 SYMLINK_POLICIES
+        max_depth: 最多进入几层子目录，0 表示只扫描根目录，None 表示不限制
+        workers: 并行列目录的线程数
+        """
+        if symlinks not in SYMLINK_POLICIES:
+            raise Exception(f"未知的符号链接策略: {symlinks}")
+        self.extensions = {ext.lower() for ext in extensions} if extensions is not None else None
+        self.exclude = tuple(exclude)
+        self.symlinks = symlinks
+        self.max_depth = max_depth
+        self.workers = max(1, workers)
+        self.prefetch_stat = prefetch_stat
+
+    def _excluded(self, name: str, relative_path: str) -> bool:
+        return any(fnmatch(name, pattern) or fnmatch(relative_path, pattern) for pattern in self.exclude)
+
+    def excludes(self, relative_path: str, is_directory: bool = False) -> bool:
+        """
+        扫描时是否会跳过该路径（相对于扫描根目录，用 / 分隔）：
+        路径本身或任一上级目录匹配 exclude，或所在的子目录深度超过 max_depth
+        """
+        parts = relative_path.split('/')
+        # 文件位于第 len(parts) - 1 层子目录；目录中的文件位于第 len(parts) 层
+        depth = len(parts) if is_directory else len(parts) - 1
+        if self.max_depth is not None and depth > self.max_depth:
+            return True
+        return bool(self.exclude) and any(
+            self._excluded(name, '/'.join(parts[:i + 1])) for i, name in enumerate(parts)
+        )
+
+    def _list_directory(self, path: str, relative_path: str,
+                        depth: int) -> Tuple[List[os.DirEntry], List[tuple]]:
+        """列出一个目录，返回 (匹配的文件, 待扫描的子目录 (路径, 相对路径, 深度, 目录标识))"""
+        files = []
+        subdirs = []
+        follow_dirs = self.symlinks == 'follow'
+        follow_files = self.symlinks != 'skip'
+        descend = self.max_depth is None or depth < self.max_depth
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    child_relative = f"{relative_path}/{entry.name}" if relative_path else entry.name
+                    if self.exclude and self._excluded(entry.name, child_relative):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=follow_dirs):
+                            if descend:
+                                stat = entry.stat() if follow_dirs else None
+                                key = (stat.st_dev, stat.st_ino) if stat is not None else None
+                                subdirs.append((entry.path, child_relative, depth + 1, key))
+                            continue
+                        if not entry.is_file(follow_symlinks=follow_files):
+                            continue
+                        if self.extensions is not None and \
+                                os.path.splitext(entry.name)[1].lower() not in self.extensions:
+                            continue
+                        if self.prefetch_stat:
+                            entry.stat(follow_symlinks=follow_files)
+                    except OSError:
+                        # 失效的链接或扫描期间被删除的文件
+                        continue
+                    files.append(entry)
+        except OSError as e:
+            print(f"扫描目录失败 {path}: {str(e)}")
+        return files, subdirs
+
+    def iter_entries(self, directory: str,
+                     cancel_event: Optional[threading.Event] = None) -> Iterator[os.DirEntry]:
+        """逐个产出目录（含子目录）中匹配的文件；cancel_event 被设置后停止"""
+        root = str(Path(directory))
+        if not os.path.isdir(root):
+            return
+
+        visited = set()
+        if self.symlinks == 'follow':
+            stat = os.stat(root)
+            visited.add((stat.st_dev, stat.st_ino))
+        pending = deque([(root, '', 0)])
+
+        def expand(subdirs: List[tuple]):
+            for path, relative_path, depth, key in subdirs:
+                if key is not None:
+                    if key in visited:
+                        continue
+                    visited.add(key)
+                pending.append((path, relative_path, depth))
+
+        if self.workers == 1:
+            while pending:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                files, subdirs = self._list_directory(*pending.popleft())
+                expand(subdirs)
+                yield from files
+            return
+
+        # 提交的目录按先进先出的顺序取结果；在途的目录数有上限，避免一次列出整棵目录树
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scan')
+        in_flight = deque()
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.workers * 2:
+                    in_flight.append(executor.submit(self._list_directory, *pending.popleft()))
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                files, subdirs = in_flight.popleft().result()
+                expand(subdirs)
+                yield from files
+        finally:
+            # 调用方提前停止迭代时，不再列出尚未开始的目录
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def iter_files(self, directory: str,
+                   cancel_event: Optional[threading.Event] = None) -> Iterator[str]:
+        """逐个产出匹配的文件路径"""
+        for entry in self.iter_entries(directory, cancel_event):
+            yield entry.path
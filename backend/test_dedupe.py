@@ -0,0 +1,56 @@
+"""
+去重任务管理测试
+
+可以直接运行（python test_dedupe.py），也可以用 pytest 运行
+"""
+import threading
+import time
+
+import numpy as np
+
+from dedupe import DedupeJobManager
+
+
+class BlockingDatabase:
+    """get_hash_matrix 阻塞到 release 被设置，使后续提交的任务停留在排队状态"""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def get_hash_matrix(self, directory: str = ""):
+        self.release.wait(10)
+        return [], np.zeros((0, 4), dtype=np.uint64)
+
+
+def test_cancelled_queued_jobs_are_pruned():
+    """排队中被取消的任务记录结束时间，超过 MAX_JOBS 后会被清理"""
+    db = BlockingDatabase()
+    manager = DedupeJobManager(db)
+    try:
+        running = manager.submit('', 0.9)
+        queued = [manager.submit('', 0.9) for _ in range(DedupeJobManager.MAX_JOBS + 5)]
+        for job in queued:
+            cancelled = manager.cancel(job['id'])
+            assert cancelled['status'] == 'cancelled'
+            assert cancelled['finished_at'] is not None
+
+        db.release.set()
+        deadline = time.time() + 10
+        while manager.get(running['id'])['finished_at'] is None and time.time() < deadline:
+            time.sleep(0.01)
+        assert manager.get(running['id'])['status'] == 'completed'
+
+        latest = manager.submit('', 0.9)
+        job_ids = {job['id'] for job in manager.list()}
+        # 最早被取消的任务已被清理，最近的任务仍然保留
+        assert len(job_ids) <= DedupeJobManager.MAX_JOBS + 1
+        assert queued[0]['id'] not in job_ids
+        assert latest['id'] in job_ids and queued[-1]['id'] in job_ids
+    finally:
+        db.release.set()
+        manager.shutdown()
+
+
+if __name__ == "__main__":
+    test_cancelled_queued_jobs_are_pruned()
+    print("排队中被取消的任务会被清理")
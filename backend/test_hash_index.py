@@ -0,0 +1,142 @@
+"""
+多索引哈希 (MIH) 与线性扫描的一致性测试
+
+可以直接运行（python test_hash_index.py），也可以用 pytest 运行
+"""
+import os
+import random
+import tempfile
+
+import numpy as np
+
+from hash_index import HashIndex, MultiIndexHash, hex_to_words
+from index_snapshot import open_snapshot, write_snapshot
+from path_scope import parent_directory
+
+HASH_BITS = 256
+WORD_COUNT = HASH_BITS // 64
+# 覆盖半径 0、各种分段数下的枚举上限附近，以及超过上限（退回线性扫描）的半径
+RADII = (0, 1, 7, 15, 16, 31, 32, 47, 48, 63, 64, 80, 127)
+
+
+def random_hashes(rng: random.Random, count: int) -> list:
+    """围绕少量中心生成哈希，使各个半径内都有命中"""
+    centers = [rng.getrandbits(HASH_BITS) for _ in range(8)]
+    hashes = []
+    for _ in range(count):
+        value = rng.choice(centers)
+        for bit in rng.sample(range(HASH_BITS), rng.randrange(0, 70)):
+            value ^= 1 << bit
+        hashes.append(value)
+    return hashes
+
+
+def to_hex(value: int) -> str:
+    return f"{value:0{HASH_BITS // 4}x}"
+
+
+def linear_scan(hashes: list, query: int, max_distance: int) -> list:
+    """逐个计算汉明距离的参考实现"""
+    return [row for row, value in enumerate(hashes) if bin(value ^ query).count('1') <= max_distance]
+
+
+def test_candidates_match_linear_scan():
+    """candidates() 经过距离验证后与线性扫描的结果完全一致；半径超过枚举上限时返回 None"""
+    rng = random.Random(20240501)
+    hashes = random_hashes(rng, 2000)
+    words = np.stack([hex_to_words(to_hex(value), WORD_COUNT) for value in hashes])
+    queries = [rng.choice(hashes) for _ in range(10)] + [rng.getrandbits(HASH_BITS) for _ in range(3)]
+
+    for band_count in (8, 16, 32):
+        mih = MultiIndexHash(WORD_COUNT, band_count)
+        mih.build(words)
+        for max_distance in RADII:
+            capped = mih.probe_radius(max_distance) is None
+            for query in queries:
+                query_words = hex_to_words(to_hex(query), WORD_COUNT)
+                candidates = mih.candidates(query_words, max_distance)
+                if capped:
+                    assert candidates is None, (band_count, max_distance)
+                    continue
+                verified = [row for row in candidates.tolist()
+                            if bin(hashes[row] ^ query).count('1') <= max_distance]
+                assert verified == linear_scan(hashes, query, max_distance), (band_count, max_distance)
+
+
+def test_mih_search_matches_linear_backend():
+    """mih 与 linear 两种索引的 search 结果一致，包括超过枚举上限、建索引后新增和删除的行"""
+    rng = random.Random(7)
+    hashes = random_hashes(rng, 3000)
+    paths = [f"/photos/{row % 7}/{row}.jpg" for row in range(len(hashes))]
+    linear = HashIndex(backend='linear')
+    mih = HashIndex(backend='mih')
+    for index in (linear, mih):
+        index.add_many((path, to_hex(value)) for path, value in zip(paths[:2500], hashes[:2500]))
+    queries = [to_hex(rng.choice(hashes)) for _ in range(8)]
+
+    # 第一次查询建立 MIH，之后追加的行由 mih 后端线性补充
+    mih.search(queries[0], 0)
+    for index in (linear, mih):
+        index.add_many((path, to_hex(value)) for path, value in zip(paths[2500:], hashes[2500:]))
+        index.remove(paths[::11])
+
+    for max_distance in RADII:
+        for query in queries:
+            for directory in (None, "/photos/3"):
+                stats = {}
+                expected = linear.search(query, max_distance, directory)
+                assert mih.search(query, max_distance, directory, stats=stats) == expected, \
+                    (max_distance, directory)
+                assert stats['matched'] == len(expected)
+
+
+def test_snapshot_index_matches_loaded_index():
+    """从快照加载的索引在修改前后的搜索结果都与逐行加载的索引一致，修改之前不解码路径表"""
+    rng = random.Random(11)
+    hashes = [to_hex(value) for value in random_hashes(rng, 3000)]
+    paths = [f"/photos/{row % 7}/{row % 3}/{row}.jpg" for row in range(len(hashes))]
+    directories = {}
+    dir_ids = np.array([directories.setdefault(parent_directory(path), len(directories))
+                        for path in paths], dtype=np.uint32)
+    words = np.stack([hex_to_words(value, WORD_COUNT) for value in hashes])
+    queries = [rng.choice(hashes) for _ in range(5)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_path = os.path.join(directory, 'index.snapshot')
+        write_snapshot(snapshot_path, len(hashes[0]), (len(paths), len(paths)), paths, words,
+                       np.zeros((len(paths), 3), dtype=np.uint64), np.zeros(len(paths), dtype=bool),
+                       np.full(len(paths), np.nan), dir_ids, list(directories))
+        snapshot = open_snapshot(snapshot_path)
+        for backend in ('linear', 'mih'):
+            loaded = HashIndex(backend=backend)
+            loaded.load(zip(paths, hashes))
+            mapped = HashIndex(backend=backend)
+            mapped.load_snapshot(snapshot)
+
+            def check():
+                assert len(mapped) == len(loaded)
+                for max_distance in (0, 16, 48):
+                    for query in queries:
+                        for scope in (None, "/photos/3", "/photos/3/1"):
+                            assert mapped.search(query, max_distance, scope) == \
+                                loaded.search(query, max_distance, scope), (backend, max_distance, scope)
+                    assert mapped.search_batch(queries, max_distance) == loaded.search_batch(queries, max_distance)
+                assert mapped.snapshot("/photos/5")[0] == loaded.snapshot("/photos/5")[0]
+
+            check()
+            assert mapped._rows is None
+            # 第一次修改时才建立路径映射；删除足够多的行会触发压缩
+            for index in (loaded, mapped):
+                index.add_many([("/photos/new/a.jpg", hashes[0]), (paths[5], hashes[1])])
+                index.remove(paths[::2])
+            assert mapped._rows is not None
+            check()
+
+
+if __name__ == "__main__":
+    test_candidates_match_linear_scan()
+    print("candidates 与线性扫描一致")
+    test_mih_search_matches_linear_backend()
+    print("mih 与 linear 索引的搜索结果一致")
+    test_snapshot_index_matches_loaded_index()
+    print("快照加载的索引与逐行加载的索引一致")
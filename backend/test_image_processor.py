@@ -0,0 +1,49 @@
+"""
+图片处理测试
+
+可以直接运行（python test_image_processor.py），也可以用 pytest 运行
+"""
+import os
+import random
+import tempfile
+
+from PIL import Image
+
+from image_processor import ImageProcessor
+
+
+def make_image(path: str, size, seed: int, mode: str = 'RGB'):
+    """生成随机像素的测试图片；细节丰富，灰度转换方式的微小差异也会改变哈希"""
+    data = random.Random(seed).randbytes(size[0] * size[1] * 3)
+    img = Image.frombytes('RGB', size, data)
+    if mode != 'RGB':
+        img = img.convert(mode)
+    if path.endswith('.jpg'):
+        img.save(path, quality=85)
+    else:
+        img.save(path)
+
+
+def test_signature_hash_matches_calculate_hash():
+    """analyze_image(signatures=True) 得到的感知哈希与 calculate_hash 完全一致"""
+    processor = ImageProcessor()
+    with tempfile.TemporaryDirectory() as directory:
+        # 较大的 JPEG 会按 HASH_DRAFT_SIZE 缩小解码
+        cases = [(f'photo{seed}_{width}.jpg', (width, height), 'RGB')
+                 for seed in range(3) for width, height in ((300, 200), (640, 480), (1600, 1200))]
+        cases += [('gray.jpg', (1200, 900), 'L'), ('large.png', (800, 600), 'RGB'),
+                  ('alpha.png', (400, 300), 'RGBA')]
+        for seed, (name, size, mode) in enumerate(cases):
+            path = os.path.join(directory, name)
+            make_image(path, size, seed, mode)
+
+            info, hash_value = processor.analyze_image(path, signatures=True)
+            assert hash_value == processor.calculate_hash(path), name
+            assert processor.analyze_image(path)[1] == hash_value, name
+            assert set(info['signatures']) == {'dhash', 'ahash', 'colorhash'}
+            assert (info['width'], info['height']) == size
+
+
+if __name__ == "__main__":
+    test_signature_hash_matches_calculate_hash()
+    print("计算签名时的感知哈希与 calculate_hash 一致")
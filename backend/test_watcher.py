@@ -0,0 +1,51 @@
+"""
+目录监控测试
+
+可以直接运行（python test_watcher.py），也可以用 pytest 运行
+"""
+import os
+import tempfile
+
+from image_processor import ImageProcessor
+from watcher import DirectoryWatcher
+
+
+def test_events_follow_scan_options():
+    """
+    扫描时会跳过的文件和目录（exclude、max_depth）产生的事件不进入待处理队列；
+    请求中的 exclude 替换处理器的默认值，嵌套的监控目录按最内层的选项过滤
+    """
+    with tempfile.TemporaryDirectory() as root:
+        root = os.path.realpath(root)
+        watcher = DirectoryWatcher(ImageProcessor(scan_exclude=['@eaDir']), db_manager=None)
+        assert watcher.watch(root, {'exclude': ['.cache', 'raw/*.png'], 'max_depth': 2})
+
+        def pending_after(record, *parts):
+            before = watcher.get_stats()['pending']
+            record(os.path.join(root, *parts))
+            return watcher.get_stats()['pending'] - before
+
+        assert pending_after(watcher.record_file, 'a.jpg') == 1
+        assert pending_after(watcher.record_file, 'raw', 'b.jpg') == 1
+        assert pending_after(watcher.record_file, 'x', 'y', 'c.jpg') == 1
+        # 按名称、按相对路径、按上级目录排除
+        assert pending_after(watcher.record_file, '.cache', 'a.jpg') == 0
+        assert pending_after(watcher.record_file, 'raw', 'b.png') == 0
+        assert pending_after(watcher.record_file, 'x', '.cache', 'y', 'c.jpg') == 0
+        assert pending_after(watcher.record_file, '@eaDir', 'a.jpg') == 1
+        # 超过 max_depth 的文件和目录
+        assert pending_after(watcher.record_file, 'x', 'y', 'z', 'd.jpg') == 0
+        assert pending_after(watcher.record_directory, 'x', 'y') == 1
+        assert pending_after(watcher.record_directory, 'x', 'y', 'z') == 0
+        assert pending_after(watcher.record_directory, 'x', '.cache') == 0
+
+        # 没有指定扫描选项的目录使用处理器的默认选项
+        os.mkdir(os.path.join(root, 'plain'))
+        assert watcher.watch(os.path.join(root, 'plain'))
+        assert pending_after(watcher.record_file, 'plain', '@eaDir', 'a.jpg') == 0
+        assert pending_after(watcher.record_file, 'plain', '.cache', 'a.jpg') == 1
+
+
+if __name__ == "__main__":
+    test_events_follow_scan_options()
+    print("监控事件按扫描选项过滤")
@@ -0,0 +1,165 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+
+class ThumbnailCache:
+    """
+    磁盘缩略图缓存
+
+    缩略图按 (源文件路径, 修改时间, 大小, 尺寸, 格式) 生成一次后保存在 cache_dir 中，
+    源文件变化后自然失效。缓存总大小超过 max_bytes 时按最近使用时间淘汰旧文件。
+    """
+
+    # 支持的输出格式: 扩展名 -> (PIL 格式, MIME 类型)
+    FORMATS = {
+        'jpeg': ('JPEG', 'image/jpeg'),
+        'webp': ('WEBP', 'image/webp')
+    }
+    # 淘汰时清理到上限的这个比例以下，避免每次写入都触发淘汰
+    EVICT_TARGET_RATIO = 0.9
+    # 最近这么多秒内使用过的缩略图不淘汰：get 返回的路径之后才由 FileResponse 打开，
+    # 期间被删除会导致响应失败
+    EVICT_GRACE_SECONDS = 60.0
+
+    def __init__(self, cache_dir: str = "thumbnail_cache", max_bytes: int = 512 * 1024 * 1024,
+                 quality: int = 85):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        self._hits = 0
+        self._misses = 0
+        self._evicted = 0
+        # 剩余的缩略图都在保留期内时，到这个时间（time.time()）之前不再重复扫描淘汰
+        self._next_evict = 0.0
+
+    def media_type(self, fmt: str) -> str:
+        return self.FORMATS[fmt][1]
+
+    def get(self, image_path: str, size: int, fmt: str = 'jpeg',
+            stat: Optional[os.stat_result] = None) -> str:
+        """返回缩略图文件路径，不存在时生成"""
+        if fmt not in self.FORMATS:
+            raise Exception(f"不支持的缩略图格式: {fmt}")
+        if stat is None:
+            stat = os.stat(image_path)
+
+        cache_path = self._cache_path(image_path, stat, size, fmt)
+        if os.path.exists(cache_path):
+            # 更新访问时间，淘汰时按最近使用排序
+            try:
+                os.utime(cache_path)
+                with self._lock:
+                    self._hits += 1
+                return cache_path
+            except OSError:
+                pass
+
+        file_size = self._render(image_path, cache_path, size, fmt)
+        with self._lock:
+            self._misses += 1
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_total()
+            else:
+                self._total_bytes += file_size
+            over_limit = self._total_bytes > self.max_bytes and time.time() >= self._next_evict
+        if over_limit:
+            self.evict()
+        return cache_path
+
+    def _cache_path(self, image_path: str, stat: os.stat_result, size: int, fmt: str) -> str:
+        key = f"{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{stat.st_size}|{size}"
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.{fmt}")
+
+    def _render(self, image_path: str, cache_path: str, size: int, fmt: str) -> int:
+        """生成缩略图并原子地写入缓存，返回文件大小"""
+        pil_format = self.FORMATS[fmt][0]
+        try:
+            with Image.open(image_path) as img:
+                # JPEG 直接按比例缩小解码
+                img.draft('RGB', (size, size))
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+                if img.mode in ('RGBA', 'LA', 'P'):
+                    img = img.convert('RGBA')
+                    if pil_format == 'JPEG':
+                        background = Image.new('RGB', img.size, (255, 255, 255))
+                        background.paste(img, mask=img.split()[-1])
+                        img = background
+                elif img.mode != 'RGB':
+                    img = img.convert('RGB')
+
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    img.save(tmp_path, pil_format, quality=self.quality)
+                    os.replace(tmp_path, cache_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+                return os.path.getsize(cache_path)
+        except Exception as e:
+            raise Exception(f"生成缩略图失败 {image_path}: {str(e)}")
+
+    def _iter_entries(self):
+        """遍历缓存文件，产出 (路径, 大小, 最近使用时间)"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        for bucket in os.scandir(self.cache_dir):
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def _scan_total(self) -> int:
+        return sum(size for _, size, _ in self._iter_entries())
+
+    def evict(self):
+        """
+        按最近使用时间删除旧缩略图，直到总大小低于上限
+        EVICT_GRACE_SECONDS 内使用过的缩略图保留，此时总大小可能暂时超过上限
+        """
+        with self._lock:
+            entries = sorted(self._iter_entries(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * self.EVICT_TARGET_RATIO
+            cutoff = time.time() - self.EVICT_GRACE_SECONDS
+            for path, size, last_used in entries:
+                if total <= target:
+                    break
+                if last_used > cutoff:
+                    self._next_evict = last_used + self.EVICT_GRACE_SECONDS
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                self._evicted += 1
+            self._total_bytes = total
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_total()
+            return {
+                'total_bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evicted': self._evicted
+            }
@@ -0,0 +1,302 @@
+"""
+视觉词袋检索
+
+局部特征匹配需要对每个候选图片做一次 knnMatch，候选很多时即使有描述符缓存也很慢。
+这里先用视觉词袋做一次近似的全局检索，只把得分最高的少量候选交给特征匹配做比率测试验证：
+
+  1. 从描述符缓存中抽样，用二值 k-majority 聚类训练两层的词汇树，叶子为 K 个 256 位的视觉词
+  2. 每张图片的 ORB 描述符沿词汇树量化为视觉词，得到词袋（词 -> 出现次数）
+  3. 全部词袋按 TF-IDF 加权并归一化，建立倒排表（词 -> 图片及权重）
+  4. 查询时只遍历查询中出现的词的倒排表，按余弦相似度累加得分
+
+词汇表和词袋保存在数据库中；倒排表常驻内存，update() 为新缓存的描述符补充词袋后整体重建。
+"""
+import math
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from hash_index import NUMPY_AVAILABLE
+from image_processor import opencv_available
+
+if NUMPY_AVAILABLE:
+    import numpy as np
+
+
+def _nearest(descriptors: "np.ndarray", centers: "np.ndarray") -> "np.ndarray":
+    """每个描述符汉明距离最近的中心序号"""
+    import cv2
+    
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+    matches = matcher.match(np.ascontiguousarray(descriptors), np.ascontiguousarray(centers))
+    labels = np.empty(len(descriptors), dtype=np.int64)
+    for match in matches:
+        labels[match.queryIdx] = match.trainIdx
+    return labels
+
+
+def _kmajority(descriptors: "np.ndarray", size: int, iterations: int,
+               rng: "np.random.Generator") -> "np.ndarray":
+    """
+    二值 k-majority 聚类：每轮把描述符分配给最近的中心，新中心的每一位取簇内多数值；
+    空簇用随机描述符重新初始化。返回 min(size, 描述符数量) 个中心
+    """
+    size = min(size, len(descriptors))
+    centers = descriptors[rng.choice(len(descriptors), size, replace=False)].copy()
+    bits = np.unpackbits(descriptors, axis=1)
+
+    for _ in range(iterations):
+        labels = _nearest(descriptors, centers)
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=size)
+        present = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts[present])[:-1]))
+        sums = np.add.reduceat(bits[order].astype(np.uint32), starts, axis=0)
+        centers[present] = np.packbits(sums * 2 > counts[present, None], axis=1)
+
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centers[empty] = descriptors[rng.choice(len(descriptors), len(empty), replace=False)]
+    return centers
+
+
+def branch_count(vocabulary: "np.ndarray") -> int:
+    """词汇树每层的分支数 b：词汇表依次保存 b 个第一层中心和 b * b 个视觉词"""
+    branches = math.isqrt(len(vocabulary))
+    while branches * branches + branches > len(vocabulary):
+        branches -= 1
+    return branches
+
+
+def word_count(vocabulary: "np.ndarray") -> int:
+    return branch_count(vocabulary) ** 2
+
+
+def train_vocabulary(descriptors: "np.ndarray", size: int, iterations: int = 10,
+                     seed: int = 0) -> "np.ndarray":
+    """
+    训练两层的词汇树：先把描述符聚为 b = sqrt(size) 类，再把每一类各自聚为 b 个视觉词。
+    量化时每个描述符只需与 2b 个中心比较，而不是全部 b * b 个视觉词
+
+    返回: (b + b * b, 32) 的 uint8 数组
+    """
+    rng = np.random.default_rng(seed)
+    branches = max(2, math.isqrt(size))
+    top = _kmajority(descriptors, branches, iterations, rng)
+    if len(top) < branches:
+        # 描述符太少，重复的中心不会被选中
+        top = np.resize(top, (branches, top.shape[1]))
+    labels = _nearest(descriptors, top)
+
+    leaves = np.empty((branches, branches, descriptors.shape[1]), dtype=np.uint8)
+    for branch in range(branches):
+        members = descriptors[labels == branch]
+        if len(members) == 0:
+            leaves[branch] = top[branch]
+            continue
+        leaves[branch] = np.resize(_kmajority(members, branches, iterations, rng), leaves[branch].shape)
+    return np.concatenate([top, leaves.reshape(-1, descriptors.shape[1])])
+
+
+def assign_words(descriptors: "np.ndarray", vocabulary: "np.ndarray") -> "np.ndarray":
+    """每个描述符在词汇树中对应的视觉词序号"""
+    if len(descriptors) == 0:
+        return np.zeros(0, dtype=np.int64)
+    branches = branch_count(vocabulary)
+    top, leaves = vocabulary[:branches], vocabulary[branches:]
+    labels = _nearest(descriptors, top)
+    words = np.empty(len(descriptors), dtype=np.int64)
+    order = np.argsort(labels, kind='stable')
+    present, starts = np.unique(labels[order], return_index=True)
+    for branch, members in zip(present.tolist(), np.split(order, starts[1:])):
+        first = branch * branches
+        words[members] = first + _nearest(descriptors[members], leaves[first:first + branches])
+    return words
+
+
+def bag_of_words(descriptors: "np.ndarray", vocabulary: "np.ndarray") -> Tuple["np.ndarray", "np.ndarray"]:
+    """把描述符量化为词袋，返回 (升序的词序号 uint32, 出现次数 uint16)"""
+    word_ids, counts = np.unique(assign_words(descriptors, vocabulary), return_counts=True)
+    return word_ids.astype(np.uint32), np.minimum(counts, 65535).astype(np.uint16)
+
+
+class VisualWordIndex:
+    """视觉词袋倒排索引，用于为局部特征匹配筛选候选"""
+
+    # 每次从缓存读取描述符、写回词袋的图片数
+    UPDATE_BATCH_SIZE = 256
+
+    def __init__(self, db_manager, vocabulary_size: int = 4096, sample_size: int = 200000,
+                 iterations: int = 10):
+        self.db_manager = db_manager
+        self.vocabulary_size = vocabulary_size
+        self.sample_size = sample_size
+        self.iterations = iterations
+        self._lock = threading.Lock()
+        # 互斥 build/update，查询不受影响（倒排表整体替换）
+        self._update_lock = threading.Lock()
+        self._vocabulary = None
+        self._paths: List[str] = []
+        self._ids = {}
+        # 倒排表：词 w 的图片序号和权重位于 _postings_*[_offsets[w]:_offsets[w + 1]]
+        self._offsets = None
+        self._postings_images = None
+        self._postings_weights = None
+        self._idf = None
+        self._queries = 0
+        self._built_at = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self._vocabulary is not None and bool(self._paths) and opencv_available()
+
+    def load(self):
+        """从数据库读取词汇表和词袋，重建倒排表"""
+        vocabulary = self.db_manager.get_vocabulary()
+        if vocabulary is None or not opencv_available():
+            return
+        self._rebuild(vocabulary)
+
+    def build(self, vocabulary_size: Optional[int] = None, sample_size: Optional[int] = None) -> dict:
+        """从描述符缓存抽样训练新的词汇表，再为全部缓存的描述符计算词袋"""
+        if not NUMPY_AVAILABLE or not opencv_available():
+            raise Exception("OpenCV 未安装，无法建立视觉词袋索引")
+        with self._update_lock:
+            started = time.monotonic()
+            sample = self.db_manager.sample_feature_descriptors(sample_size or self.sample_size)
+            if len(sample) == 0:
+                raise Exception("没有缓存的特征描述符，请先以 extract_features=true 索引目录")
+            vocabulary = train_vocabulary(sample, vocabulary_size or self.vocabulary_size, self.iterations)
+            self.db_manager.save_vocabulary(vocabulary)
+            trained = time.monotonic() - started
+            stats = self._update(vocabulary)
+            stats.update({'vocabulary_size': word_count(vocabulary), 'sample_size': len(sample),
+                          'train_seconds': trained})
+            return stats
+
+    def update(self) -> dict:
+        """为新缓存或已变化的描述符补充词袋并重建倒排表；没有词汇表时不做任何事"""
+        with self._update_lock:
+            vocabulary = self._vocabulary
+            if vocabulary is None:
+                vocabulary = self.db_manager.get_vocabulary()
+            if vocabulary is None or not opencv_available():
+                return {'added': 0}
+            return self._update(vocabulary)
+
+    def _update(self, vocabulary: "np.ndarray") -> dict:
+        pending = self.db_manager.get_features_without_words()
+        for i in range(0, len(pending), self.UPDATE_BATCH_SIZE):
+            features = self.db_manager.get_image_features(pending[i:i + self.UPDATE_BATCH_SIZE])
+            records = []
+            for file_path, (modified_time, _, descriptors) in features.items():
+                if descriptors is None:
+                    continue
+                word_ids, counts = bag_of_words(descriptors, vocabulary)
+                records.append((file_path, modified_time, word_ids, counts))
+            self.db_manager.add_image_words(records)
+        self._rebuild(vocabulary)
+        return {'added': len(pending), 'images': len(self._paths)}
+
+    def _rebuild(self, vocabulary: "np.ndarray"):
+        """读取全部词袋，按 TF-IDF 加权后建立倒排表"""
+        paths = []
+        word_chunks = []
+        count_chunks = []
+        for file_path, word_ids, counts in self.db_manager.iter_image_words():
+            if len(word_ids) == 0:
+                continue
+            paths.append(file_path)
+            word_chunks.append(word_ids)
+            count_chunks.append(counts)
+
+        size = word_count(vocabulary)
+        if paths:
+            lengths = np.fromiter((len(words) for words in word_chunks), dtype=np.int64, count=len(paths))
+            images = np.repeat(np.arange(len(paths), dtype=np.int32), lengths)
+            words = np.concatenate(word_chunks).astype(np.int64)
+            tf = np.concatenate(count_chunks).astype(np.float32)
+            document_frequency = np.bincount(words, minlength=size)
+            idf = np.log(len(paths) / np.maximum(document_frequency, 1)).astype(np.float32)
+            weights = tf * idf[words]
+            # 每张图片的词袋向量归一化为单位长度，得分即余弦相似度
+            norms = np.sqrt(np.bincount(images, weights=weights * weights, minlength=len(paths)))
+            weights /= np.maximum(norms, 1e-12)[images].astype(np.float32)
+            order = np.argsort(words, kind='stable')
+            offsets = np.zeros(size + 1, dtype=np.int64)
+            np.cumsum(document_frequency, out=offsets[1:])
+            postings_images, postings_weights = images[order], weights[order]
+        else:
+            idf = np.zeros(size, dtype=np.float32)
+            offsets = np.zeros(size + 1, dtype=np.int64)
+            postings_images = np.zeros(0, dtype=np.int32)
+            postings_weights = np.zeros(0, dtype=np.float32)
+
+        with self._lock:
+            self._vocabulary = vocabulary
+            self._paths = paths
+            self._ids = {path: i for i, path in enumerate(paths)}
+            self._idf = idf
+            self._offsets = offsets
+            self._postings_images = postings_images
+            self._postings_weights = postings_weights
+            self._built_at = time.time()
+
+    def shortlist(self, query_descriptors: "np.ndarray", image_paths: List[str], limit: int,
+                  stats: Optional[dict] = None) -> List[str]:
+        """
+        从 image_paths 中选出与查询词袋余弦相似度最高的 limit 张已建词袋的图片（按得分降序），
+        没有词袋的图片无法评分，全部附加在后面，仍由特征匹配逐一验证
+        """
+        with self._lock:
+            vocabulary, paths, ids, idf = self._vocabulary, self._paths, self._ids, self._idf
+            offsets, postings_images, postings_weights = \
+                self._offsets, self._postings_images, self._postings_weights
+            self._queries += 1
+
+        word_ids, counts = bag_of_words(query_descriptors, vocabulary)
+        word_ids = word_ids.astype(np.int64)
+        query_weights = counts.astype(np.float32) * idf[word_ids]
+        query_weights /= max(float(np.sqrt((query_weights * query_weights).sum())), 1e-12)
+
+        # 只遍历查询中出现的词的倒排表
+        starts, ends = offsets[word_ids], offsets[word_ids + 1]
+        lengths = ends - starts
+        positions = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths) + \
+            np.arange(lengths.sum())
+        scores = np.bincount(postings_images[positions],
+                             weights=postings_weights[positions] * np.repeat(query_weights, lengths),
+                             minlength=len(paths))
+
+        indexed = []
+        unindexed = []
+        for path in image_paths:
+            image_id = ids.get(path)
+            if image_id is None:
+                unindexed.append(path)
+            else:
+                indexed.append(image_id)
+        indexed = np.array(indexed, dtype=np.int64)
+        if len(indexed) > limit:
+            candidate_scores = scores[indexed]
+            top = np.argpartition(-candidate_scores, limit - 1)[:limit]
+            indexed = indexed[top[np.argsort(-candidate_scores[top], kind='stable')]]
+        else:
+            indexed = indexed[np.argsort(-scores[indexed], kind='stable')]
+
+        if stats is not None:
+            stats.update({'indexed': len(image_paths) - len(unindexed),
+                          'shortlisted': len(indexed), 'unindexed': len(unindexed),
+                          'postings_visited': int(lengths.sum())})
+        return [paths[i] for i in indexed.tolist()] + unindexed
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'ready': self.is_ready,
+                'vocabulary_size': word_count(self._vocabulary) if self._vocabulary is not None else 0,
+                'images': len(self._paths),
+                'postings': len(self._postings_images) if self._postings_images is not None else 0,
+                'queries': self._queries,
+                'built_at': self._built_at
+            }
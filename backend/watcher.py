@@ -0,0 +1,339 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import metrics
+from image_processor import image_record
+
+# 尝试导入 watchdog，用于基于 inotify 等系统通知的目录监控
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    WATCHDOG_AVAILABLE = False
+    FileSystemEventHandler = object
+
+
+class _EventHandler(FileSystemEventHandler):
+    """把 watchdog 事件转交给 DirectoryWatcher"""
+
+    def __init__(self, watcher: "DirectoryWatcher"):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.event_type not in ('created', 'modified', 'deleted', 'moved'):
+            return
+        if event.is_directory:
+            # 目录的 modified 事件在其中任何文件变化时都会产生，文件事件已单独处理
+            if event.event_type == 'modified':
+                return
+            self.watcher.record_directory(event.src_path)
+            if event.event_type == 'moved':
+                self.watcher.record_directory(event.dest_path)
+        else:
+            self.watcher.record_file(event.src_path)
+            if event.event_type == 'moved':
+                self.watcher.record_file(event.dest_path)
+
+
+class DirectoryWatcher:
+    """
+    监控已索引目录，增量维护索引
+
+    文件的创建、修改、移动和删除事件先按路径合并，路径在 debounce 秒内没有新事件后
+    再分批写入数据库（同时更新内存哈希索引），避免正在写入的文件被反复计算。
+    整个目录被移入或移出时，对该目录执行一次增量索引。
+    每个监控目录使用自己的扫描选项（exclude/max_depth 等），扫描时会跳过的路径产生的事件直接忽略，
+    不会被索引。
+    写入索引后，在 debounce 秒内没有新的变化（或距第一次未导出的变化已超过 snapshot_interval 秒）
+    时导出索引快照，供其他进程映射。
+    安装了 watchdog 时使用系统文件通知（Linux 上为 inotify），否则定期轮询比较
+    文件的大小和修改时间。
+    """
+
+    # 工作线程检查待处理事件的间隔（秒）
+    TICK_INTERVAL = 0.2
+
+    def __init__(self, image_processor, db_manager, debounce: float = 2.0,
+                 batch_size: int = 200, poll_interval: float = 30.0,
+                 force_polling: bool = False, signatures: bool = False,
+                 snapshot_interval: float = 30.0):
+        self.image_processor = image_processor
+        self.db_manager = db_manager
+        self.debounce = debounce
+        self.batch_size = max(1, batch_size)
+        self.poll_interval = poll_interval
+        self.use_polling = force_polling or not WATCHDOG_AVAILABLE
+        # 是否同时计算级联搜索使用的签名
+        self.signatures = signatures
+        self.snapshot_interval = snapshot_interval
+
+        self._lock = threading.Lock()
+        self._directories = {}  # 目录 -> watchdog 监控句柄（轮询模式下为 None）
+        self._scan_options = {}  # 目录 -> 覆盖默认扫描选项的 scan_options
+        self._scanners = {}      # 目录 -> 按 scan_options 创建的扫描器，用于过滤事件
+        self._snapshots = {}    # 轮询模式: 目录 -> {路径: (大小, 修改时间)}，None 表示尚未建立
+        self._pending_files = {}        # 路径 -> 最后一次事件的时间
+        self._pending_directories = {}  # 目录 -> 最后一次事件的时间
+        self._observer = None
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._last_poll = 0.0
+        # 尚未导出到快照的变化：(第一次变化的时间, 最后一次变化的时间)，没有时为 None
+        self._unexported = None
+        self._stats = {
+            'events': 0,
+            'indexed': 0,
+            'removed': 0,
+            'failed': 0,
+            'rescans': 0
+        }
+
+    def start(self):
+        """启动工作线程（以及 watchdog 观察者）"""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        if not self.use_polling:
+            self._observer = Observer()
+            self._observer.start()
+            with self._lock:
+                for directory in self._directories:
+                    self._directories[directory] = self._schedule(directory)
+        self._thread = threading.Thread(target=self._worker, name="index-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止监控；尚未处理的事件在退出前写入数据库"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        self._apply_pending(flush=True)
+
+    def watch(self, directory: str, scan_options: Optional[dict] = None) -> bool:
+        """
+        开始监控目录，目录不存在时返回 False
+        scan_options: 与索引时相同的 exclude/symlinks/max_depth；目录已在监控时更新为新的选项
+        """
+        directory = os.path.abspath(directory)
+        if not os.path.isdir(directory):
+            return False
+        scanner = self.image_processor.make_scanner(scan_options)
+        with self._lock:
+            self._scan_options[directory] = scan_options
+            self._scanners[directory] = scanner
+            if directory in self._directories:
+                return True
+            self._directories[directory] = None
+            self._snapshots[directory] = None
+            if self._observer is not None:
+                self._directories[directory] = self._schedule(directory)
+        print(f"开始监控目录: {directory}")
+        return True
+
+    def unwatch(self, directory: str) -> bool:
+        """停止监控目录，目录未被监控时返回 False"""
+        directory = os.path.abspath(directory)
+        with self._lock:
+            if directory not in self._directories:
+                return False
+            handle = self._directories.pop(directory)
+            self._snapshots.pop(directory, None)
+            self._scan_options.pop(directory, None)
+            self._scanners.pop(directory, None)
+        if handle is not None and self._observer is not None:
+            self._observer.unschedule(handle)
+        return True
+
+    def list(self) -> List[str]:
+        with self._lock:
+            return sorted(self._directories)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending_files) + len(self._pending_directories)
+            stats['directories'] = sorted(self._directories)
+        stats['mode'] = 'polling' if self.use_polling else 'watchdog'
+        return stats
+
+    def record_file(self, file_path: str):
+        """记录文件事件，等待合并后处理；扫描时会跳过的文件不记录"""
+        if not self.image_processor.is_image_file(file_path):
+            return
+        with self._lock:
+            if self._excluded(file_path, is_directory=False):
+                return
+            self._pending_files[file_path] = time.monotonic()
+            self._stats['events'] += 1
+
+    def record_directory(self, directory: str):
+        """记录目录事件（整个目录移入、移出或删除），等待合并后重新增量索引；扫描时会跳过的目录不记录"""
+        with self._lock:
+            if self._excluded(directory, is_directory=True):
+                return
+            self._pending_directories[directory] = time.monotonic()
+            self._stats['events'] += 1
+
+    def _root_of(self, path: str) -> Optional[str]:
+        """包含 path 的监控目录（嵌套时取最内层），不在任何监控目录中时返回 None（调用方需持有锁）"""
+        roots = [directory for directory in self._directories
+                 if path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)]
+        return max(roots, key=len) if roots else None
+
+    def _excluded(self, path: str, is_directory: bool) -> bool:
+        """按所在监控目录的扫描选项判断是否跳过该路径（调用方需持有锁）"""
+        root = self._root_of(path)
+        if root is None or path == root:
+            return False
+        relative_path = os.path.relpath(path, root).replace(os.sep, '/')
+        return self._scanners[root].excludes(relative_path, is_directory)
+
+    def _schedule(self, directory: str):
+        return self._observer.schedule(_EventHandler(self), directory, recursive=True)
+
+    def _worker(self):
+        while not self._stop_event.wait(self.TICK_INTERVAL):
+            try:
+                if self.use_polling and time.monotonic() - self._last_poll >= self.poll_interval:
+                    self._last_poll = time.monotonic()
+                    self._poll()
+                self._apply_pending()
+            except Exception as e:
+                print(f"目录监控处理失败: {str(e)}")
+
+    def _poll(self):
+        """轮询模式：比较目录快照，找出变化的文件"""
+        for directory in self.list():
+            snapshot = {}
+            with self._lock:
+                scan_options = self._scan_options.get(directory)
+            for entry in self.image_processor.iter_image_entries(directory, scan_options, self._stop_event):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            if self._stop_event.is_set():
+                return
+
+            with self._lock:
+                if directory not in self._snapshots:
+                    # 轮询期间目录已被取消监控
+                    continue
+                previous = self._snapshots[directory]
+                self._snapshots[directory] = snapshot
+            if previous is None:
+                # 第一次轮询只建立基准快照
+                continue
+
+            for file_path, state in snapshot.items():
+                if previous.get(file_path) != state:
+                    self.record_file(file_path)
+            for file_path in previous:
+                if file_path not in snapshot:
+                    self.record_file(file_path)
+
+    def _take_ready(self, pending: Dict[str, float], flush: bool) -> List[str]:
+        """取出已超过 debounce 时间没有新事件的路径"""
+        now = time.monotonic()
+        ready = [path for path, last_event in pending.items()
+                 if flush or now - last_event >= self.debounce]
+        for path in ready:
+            del pending[path]
+        return sorted(ready)
+
+    def _apply_pending(self, flush: bool = False):
+        with self._lock:
+            files = self._take_ready(self._pending_files, flush)
+            directories = self._take_ready(self._pending_directories, flush)
+
+        for i in range(0, len(files), self.batch_size):
+            self._apply_files(files[i:i + self.batch_size])
+
+        for directory in directories:
+            # 目录已不存在时，增量索引会删除其中所有文件的记录
+            stats = self.image_processor.index_directory(directory, self.db_manager, incremental=True,
+                                                         signatures=self.signatures,
+                                                         scan_options=self._rescan_options(directory))
+            with self._lock:
+                self._stats['rescans'] += 1
+                self._stats['indexed'] += stats['indexed']
+                self._stats['removed'] += stats['removed']
+                self._stats['failed'] += stats['failed']
+            if stats['indexed'] or stats['removed']:
+                self._mark_unexported()
+
+        self._export_snapshot(flush)
+
+    def _rescan_options(self, directory: str) -> Optional[dict]:
+        """
+        重新扫描监控目录中某个子目录时的扫描选项：沿用监控目录的选项，max_depth 扣除子目录自身的深度
+        （以子目录为扫描根目录，exclude 中的相对路径模式按子目录计算）
+        """
+        with self._lock:
+            root = self._root_of(directory)
+            if root is None:
+                return None
+            scan_options = self._scan_options.get(root)
+            max_depth = self._scanners[root].max_depth
+        if max_depth is None or directory == root:
+            return scan_options
+        depth = len(os.path.relpath(directory, root).split(os.sep))
+        return dict(scan_options or {}, max_depth=max(0, max_depth - depth))
+
+    def _mark_unexported(self):
+        now = time.monotonic()
+        self._unexported = (self._unexported[0] if self._unexported else now, now)
+
+    def _export_snapshot(self, flush: bool = False):
+        """合并导出快照：最后一次变化后 debounce 秒，或第一次变化后 snapshot_interval 秒"""
+        if self._unexported is None:
+            return
+        now = time.monotonic()
+        first_change, last_change = self._unexported
+        if not (flush or now - last_change >= self.debounce
+                or now - first_change >= self.snapshot_interval):
+            return
+        self._unexported = None
+        try:
+            self.db_manager.export_snapshot()
+        except Exception as e:
+            print(f"导出索引快照失败: {str(e)}")
+
+    def _apply_files(self, file_paths: List[str]):
+        """把一批文件的当前状态写入索引：存在的重新计算哈希，不存在的删除"""
+        existing = [path for path in file_paths if os.path.isfile(path)]
+        missing = [path for path in file_paths if not os.path.isfile(path)]
+
+        records = []
+        failed = 0
+        results = self.image_processor._hash_files(existing, signatures=self.signatures)
+        for image_path, info, hash_value, _, error in results:
+            if error is not None:
+                # 文件可能仍在写入，写入完成时的事件会再次触发处理
+                print(f"索引图片失败 {image_path}: {error}")
+                failed += 1
+                continue
+            records.append(image_record(image_path, info, hash_value))
+
+        self.db_manager.add_image_hashes(records)
+        removed = self.db_manager.remove_images(missing)
+        metrics.count_files('indexed', len(records))
+        metrics.count_files('failed', failed)
+
+        with self._lock:
+            self._stats['indexed'] += len(records)
+            self._stats['removed'] += removed
+            self._stats['failed'] += failed
+        if records or removed:
+            self._mark_unexported()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+数据库写入吞吐量基准测试
+
+对比两种写入方式：
+  before: 旧实现，每条记录新建连接、单独提交（默认 rollback journal）
+  after:  DatabaseManager.add_image_hashes，持久连接 + WAL + executemany 单事务批量写入
+
+用法: python benchmarks/bench_db_insert.py [--count 5000] [--batch-size 500]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+
+from database import DatabaseManager  # noqa: E402
+
+
+def make_records(count: int, seed: int = 0):
+    """生成确定性的模拟记录"""
+    rnd = random.Random(seed)
+    return [
+        (f"/data/photos/{i // 1000:04d}/img_{i:07d}.jpg",
+         '%064x' % rnd.getrandbits(256),
+         rnd.randrange(100_000, 8_000_000),
+         1_700_000_000.0 + i,
+         4032,
+         3024)
+        for i in range(count)
+    ]
+
+
+def bench_before(db_path: str, records) -> float:
+    """旧实现：每条记录一次连接、一次提交"""
+    db_manager = DatabaseManager(db_path, use_memory_index=False)
+    db_manager.init_db()
+    db_manager.close()
+    # init_db 会把数据库切换到 WAL，这里恢复为旧实现使用的默认日志模式
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+
+    start = time.perf_counter()
+    for record in records:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO image_hashes
+            (file_path, hash_value, file_size, modified_time, width, height)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', record)
+        conn.commit()
+        conn.close()
+    return time.perf_counter() - start
+
+
+def bench_after(db_path: str, records, batch_size: int) -> float:
+    """新实现：持久连接 + WAL + 批量事务"""
+    db_manager = DatabaseManager(db_path, use_memory_index=False)
+    db_manager.init_db()
+
+    start = time.perf_counter()
+    for i in range(0, len(records), batch_size):
+        db_manager.add_image_hashes(records[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+
+    db_manager.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="数据库写入吞吐量基准测试")
+    parser.add_argument('--count', type=int, default=5000, help="写入的记录数")
+    parser.add_argument('--batch-size', type=int, default=500, help="批量写入时每个事务的记录数")
+    args = parser.parse_args()
+
+    records = make_records(args.count)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        before = bench_before(os.path.join(tmp_dir, 'before.db'), records)
+        after = bench_after(os.path.join(tmp_dir, 'after.db'), records, args.batch_size)
+
+    print(f"记录数: {args.count}，批量大小: {args.batch_size}")
+    print(f"before (逐条连接+提交): {before:8.3f}s  {args.count / before:10.0f} 条/秒")
+    print(f"after  (WAL+批量事务):  {after:8.3f}s  {args.count / after:10.0f} 条/秒")
+    print(f"提升: {before / after:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+索引与搜索基准测试
+
+在确定性的合成语料（见 synthetic_corpus.py）上测量:
+  index          ImageProcessor.index_directory 的索引吞吐量（张/秒）
+  accuracy       以每组原图为查询时感知哈希搜索的召回率/精确率（按变体类型细分）
+  phash_search   不同索引规模、不同内存索引类型下 find_similar_images 的延迟分位数
+                 （语料之外用随机哈希补足到指定规模）
+  feature_match  局部特征匹配搜索的延迟和召回率/精确率（需要 OpenCV）
+
+结果写入 JSON 文件；传入 --compare 时与上一次的结果逐项对比。
+
+用法: python benchmarks/bench_suite.py [--base-count 200] [--sizes 1000,10000,100000]
+                                       [--output bench-results.json] [--compare old.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'backend'))
+
+from database import DatabaseManager  # noqa: E402
+from image_processor import ImageProcessor, CV2_AVAILABLE  # noqa: E402
+from synthetic_corpus import generate_corpus  # noqa: E402
+
+
+def _int_list(value: str) -> list:
+    return [int(v) for v in value.split(',') if v]
+
+
+def _float_list(value: str) -> list:
+    return [float(v) for v in value.split(',') if v]
+
+
+def latency_summary(samples: list) -> dict:
+    """延迟样本（秒）的分位数统计，单位毫秒"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        # 最近秩法
+        index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+        return ordered[index] * 1000
+
+    total = sum(ordered)
+    return {
+        'count': len(ordered),
+        'mean_ms': total / len(ordered) * 1000,
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p99_ms': percentile(99),
+        'max_ms': ordered[-1] * 1000,
+        'qps': len(ordered) / total if total > 0 else None
+    }
+
+
+def accuracy_summary(corpus: dict, retrieved: dict) -> dict:
+    """
+    retrieved: 查询原图路径 -> 返回的图片路径集合（不含查询自身）
+    同组的其他图片为相关结果
+    """
+    by_path = {image['path']: image for image in corpus['images']}
+    relevant = {}
+    for image in corpus['images']:
+        relevant.setdefault(image['group'], []).append(image)
+
+    true_positives = 0
+    retrieved_total = 0
+    relevant_total = 0
+    per_variant = {}
+    for query_path, paths in retrieved.items():
+        group = by_path[query_path]['group']
+        expected = [image for image in relevant[group] if image['path'] != query_path]
+        found = {path for path in paths if path in by_path and by_path[path]['group'] == group}
+        true_positives += len(found)
+        retrieved_total += len(paths)
+        relevant_total += len(expected)
+        for image in expected:
+            counts = per_variant.setdefault(image['variant'], [0, 0])
+            counts[0] += image['path'] in found
+            counts[1] += 1
+
+    return {
+        'queries': len(retrieved),
+        'precision': true_positives / retrieved_total if retrieved_total else 1.0,
+        'recall': true_positives / relevant_total if relevant_total else 1.0,
+        'recall_by_variant': {variant: found / total for variant, (found, total) in sorted(per_variant.items())}
+    }
+
+
+def bench_index(image_processor: ImageProcessor, corpus: dict, db_path: str,
+                workers: int, extract_features: bool) -> dict:
+    db_manager = DatabaseManager(db_path)
+    db_manager.init_db()
+    start = time.perf_counter()
+    stats = image_processor.index_directory(corpus['directory'], db_manager, workers=workers,
+                                            extract_features=extract_features)
+    elapsed = time.perf_counter() - start
+    db_manager.close()
+    return {
+        'workers': workers,
+        'extract_features': extract_features,
+        'indexed': stats['indexed'],
+        'failed': stats['failed'],
+        'elapsed_s': elapsed,
+        'images_per_s': stats['indexed'] / elapsed if elapsed > 0 else None
+    }
+
+
+def bench_accuracy(db_manager: DatabaseManager, corpus: dict, hashes: dict, thresholds: list) -> dict:
+    queries = [image['path'] for image in corpus['images'] if image['variant'] == 'base']
+    results = {}
+    for threshold in thresholds:
+        retrieved = {}
+        for query_path in queries:
+            matches = db_manager.find_similar_images(hashes[query_path], corpus['directory'], threshold)
+            retrieved[query_path] = {path for path, _, _ in matches if path != query_path}
+        results[str(threshold)] = accuracy_summary(corpus, retrieved)
+    return results
+
+
+def _filler_records(start: int, stop: int, rnd: random.Random, hex_length: int) -> list:
+    """与语料无关的随机哈希记录，用于把索引补足到指定规模"""
+    return [(f"/bench/filler/{i // 1000:05d}/img_{i:08d}.jpg",
+             '%0*x' % (hex_length, rnd.getrandbits(hex_length * 4)),
+             1_000_000, 1_700_000_000.0 + i, 1024, 768)
+            for i in range(start, stop)]
+
+
+def bench_phash_search(db_path: str, hashes: dict, sizes: list, backends: list,
+                       query_count: int, threshold: float, seed: int) -> dict:
+    """
+    在同一个数据库中逐步补充随机记录，每达到一个规模时按各内存索引类型重新加载并测量查询延迟
+    查询为语料中全部图片的哈希（循环使用到 query_count 次）
+    """
+    query_hashes = list(hashes.values())
+    queries = [query_hashes[i % len(query_hashes)] for i in range(query_count)]
+    hex_length = len(query_hashes[0])
+    rnd = random.Random(seed)
+
+    writer = DatabaseManager(db_path, use_memory_index=False)
+    writer.init_db()
+    current = len(hashes)
+    results = {backend: {} for backend in backends}
+    for size in sorted(sizes):
+        if size > current:
+            for start in range(current, size, 50_000):
+                writer.add_image_hashes(_filler_records(start, min(size, start + 50_000), rnd, hex_length))
+            current = size
+
+        for backend in backends:
+            db_manager = DatabaseManager(db_path, index_backend=backend)
+            load_start = time.perf_counter()
+            db_manager.init_db()
+            load_elapsed = time.perf_counter() - load_start
+
+            samples = []
+            candidates = 0
+            for query_hash in queries:
+                stats = {}
+                start = time.perf_counter()
+                db_manager.find_similar_images(query_hash, "", threshold, stats=stats)
+                samples.append(time.perf_counter() - start)
+                candidates += stats.get('candidates', 0)
+
+            summary = latency_summary(samples)
+            summary['index_size'] = current
+            summary['load_s'] = load_elapsed
+            summary['mean_candidates'] = candidates / len(queries) if queries else 0
+            results[backend][str(size)] = summary
+            db_manager.close()
+    writer.close()
+    return results
+
+
+def bench_feature_match(image_processor: ImageProcessor, db_manager: DatabaseManager,
+                        corpus: dict, query_count: int, threshold: float, workers: int) -> dict:
+    if not CV2_AVAILABLE:
+        return {'skipped': 'OpenCV 未安装'}
+
+    targets = [image['path'] for image in corpus['images']]
+    queries = [image['path'] for image in corpus['images'] if image['variant'] == 'base'][:query_count]
+    samples = []
+    retrieved = {}
+    for query_path in queries:
+        start = time.perf_counter()
+        matches = image_processor.search_with_feature_match(
+            query_path, targets, min_match_count=10, threshold=threshold * 0.5,  # 与搜索接口相同
+            db_manager=db_manager, workers=workers
+        )
+        samples.append(time.perf_counter() - start)
+        retrieved[query_path] = {match['path'] for match in matches if match['path'] != query_path}
+
+    summary = latency_summary(samples)
+    summary['targets'] = len(targets)
+    summary['accuracy'] = accuracy_summary(corpus, retrieved)
+    return summary
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _flatten(value, prefix: str = '') -> dict:
+    """把嵌套结果展开为 {'a.b.c': 数值}，用于对比"""
+    if isinstance(value, dict):
+        flat = {}
+        for key, item in value.items():
+            flat.update(_flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+        return flat
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+def compare_results(previous: dict, current: dict):
+    """打印两次结果中都存在且发生变化的数值指标"""
+    old = _flatten({k: v for k, v in previous.items() if k != 'meta'})
+    new = _flatten({k: v for k, v in current.items() if k != 'meta'})
+    print(f"\n与 {previous['meta'].get('commit') or '上次结果'} 对比:")
+    for key in sorted(old.keys() & new.keys()):
+        if old[key] == new[key]:
+            continue
+        ratio = f"{new[key] / old[key]:7.2f}x" if old[key] else "        "
+        print(f"  {key:60s} {old[key]:12.4f} -> {new[key]:12.4f} {ratio}")
+
+
+def print_summary(results: dict):
+    index = results['index']
+    print(f"索引: {index['indexed']} 张，{index['elapsed_s']:.2f}s，{index['images_per_s']:.1f} 张/秒"
+          f"（{index['workers']} 个进程）")
+    for threshold, accuracy in results['accuracy'].items():
+        variants = ', '.join(f"{v}={r:.2f}" for v, r in accuracy['recall_by_variant'].items())
+        print(f"pHash 阈值 {threshold}: 精确率 {accuracy['precision']:.3f}，召回率 {accuracy['recall']:.3f}"
+              f"（{variants}）")
+    for backend, sizes in results['phash_search'].items():
+        for size, summary in sizes.items():
+            print(f"pHash 搜索 {backend:6s} {int(size):>9d} 条: p50 {summary['p50_ms']:8.3f}ms  "
+                  f"p90 {summary['p90_ms']:8.3f}ms  p99 {summary['p99_ms']:8.3f}ms")
+    feature = results['feature_match']
+    if 'skipped' in feature:
+        print(f"特征匹配: 跳过（{feature['skipped']}）")
+    else:
+        print(f"特征匹配 ({feature['targets']} 张): p50 {feature['p50_ms']:.1f}ms  "
+              f"p90 {feature['p90_ms']:.1f}ms，精确率 {feature['accuracy']['precision']:.3f}，"
+              f"召回率 {feature['accuracy']['recall']:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="索引与搜索基准测试")
+    parser.add_argument('--base-count', type=int, default=200, help="合成语料的原图（组）数量")
+    parser.add_argument('--seed', type=int, default=0, help="随机种子")
+    parser.add_argument('--corpus-dir', default=None,
+                        help="语料目录，已存在相同参数的语料时复用（默认使用临时目录）")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="索引进程数和特征匹配线程数")
+    parser.add_argument('--thresholds', type=_float_list, default=[0.8, 0.9], help="召回率/精确率的相似度阈值")
+    parser.add_argument('--sizes', type=_int_list, default=[1000, 10000, 100000], help="测量搜索延迟的索引规模")
+    parser.add_argument('--backends', default='linear,mih', help="内存索引类型，逗号分隔")
+    parser.add_argument('--queries', type=int, default=200, help="每个规模的查询次数")
+    parser.add_argument('--search-threshold', type=float, default=0.8, help="延迟测试使用的相似度阈值")
+    parser.add_argument('--feature-queries', type=int, default=10, help="特征匹配的查询次数，0 表示跳过")
+    parser.add_argument('--output', default='bench-results.json', help="结果 JSON 文件")
+    parser.add_argument('--compare', default=None, help="与之前的结果 JSON 对比")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_dir = args.corpus_dir or os.path.join(tmp_dir, 'corpus')
+        start = time.perf_counter()
+        corpus = generate_corpus(corpus_dir, args.base_count, args.seed)
+        print(f"语料: {len(corpus['images'])} 张图片（{time.perf_counter() - start:.1f}s）")
+
+        image_processor = ImageProcessor()
+        db_path = os.path.join(tmp_dir, 'corpus.db')
+        results = {
+            'meta': {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'commit': _git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'opencv': CV2_AVAILABLE,
+                'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+            },
+            'corpus': {'images': len(corpus['images']), **corpus['params']},
+            'index': bench_index(image_processor, corpus, db_path, args.workers,
+                                 extract_features=CV2_AVAILABLE and args.feature_queries > 0)
+        }
+
+        db_manager = DatabaseManager(db_path)
+        db_manager.init_db()
+        hashes = dict(db_manager.get_images_in_directory(corpus['directory']))
+        results['accuracy'] = bench_accuracy(db_manager, corpus, hashes, args.thresholds)
+        if args.feature_queries > 0:
+            results['feature_match'] = bench_feature_match(image_processor, db_manager, corpus,
+                                                           args.feature_queries, args.search_threshold,
+                                                           args.workers)
+        else:
+            results['feature_match'] = {'skipped': '--feature-queries 为 0'}
+        db_manager.close()
+
+        backends = [backend for backend in args.backends.split(',') if backend]
+        results['phash_search'] = bench_phash_search(db_path, hashes, args.sizes, backends,
+                                                     args.queries, args.search_threshold, args.seed)
+
+    print_summary(results)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已写入 {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare_results(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+确定性的合成图片语料
+
+每组包含一张原图和若干变体，同一组内的图片互为"应当找到"的相似图片，
+不同组之间互为干扰项。相同的 seed 和参数总是生成相同的图片，不需要联网下载。
+
+变体类型:
+  resized       缩小到一半并另存为 PNG
+  recompressed  以低质量重新压缩为 JPEG
+  cropped       四周各裁掉 8%
+  screenshot    缩小后嵌入模拟的应用窗口截图中
+
+用法: python benchmarks/synthetic_corpus.py OUTPUT_DIR [--base-count 200] [--seed 0]
+"""
+import argparse
+import json
+import os
+import random
+from typing import List
+
+from PIL import Image, ImageDraw
+
+# 语料格式或生成算法变化时递增，旧的语料目录会被重新生成
+CORPUS_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+VARIANTS = ('resized', 'recompressed', 'cropped', 'screenshot')
+BASE_SIZES = ((640, 480), (800, 600), (600, 800), (720, 720))
+
+
+def _random_color(rnd: random.Random) -> tuple:
+    return tuple(rnd.randrange(256) for _ in range(3))
+
+
+def make_base_image(rnd: random.Random) -> Image.Image:
+    """渐变背景上随机绘制的几何图形，保证不同组之间的哈希差异足够大"""
+    width, height = rnd.choice(BASE_SIZES)
+    start, end = _random_color(rnd), _random_color(rnd)
+    vertical = rnd.random() < 0.5
+
+    # 先画 256 级的渐变条再拉伸，比逐像素赋值快得多
+    gradient = Image.new('RGB', (256, 1) if not vertical else (1, 256))
+    for i in range(256):
+        color = tuple(int(s + (e - s) * i / 255) for s, e in zip(start, end))
+        gradient.putpixel((i, 0) if not vertical else (0, i), color)
+    img = gradient.resize((width, height), Image.Resampling.BILINEAR)
+
+    draw = ImageDraw.Draw(img)
+    for _ in range(rnd.randint(8, 16)):
+        x0, y0 = rnd.randrange(width), rnd.randrange(height)
+        x1 = min(width, x0 + rnd.randint(width // 10, width // 2))
+        y1 = min(height, y0 + rnd.randint(height // 10, height // 2))
+        shape = rnd.choice(('rectangle', 'ellipse', 'polygon', 'line'))
+        color = _random_color(rnd)
+        if shape == 'rectangle':
+            draw.rectangle((x0, y0, x1, y1), fill=color, outline=_random_color(rnd), width=3)
+        elif shape == 'ellipse':
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+        elif shape == 'polygon':
+            points = [(rnd.randint(x0, x1), rnd.randint(y0, y1)) for _ in range(rnd.randint(3, 6))]
+            draw.polygon(points, fill=color)
+        else:
+            draw.line((x0, y0, x1, y1), fill=color, width=rnd.randint(2, 8))
+    # 细小的随机斑点提供局部纹理，纯色图形的角点过于相似，特征匹配难以区分
+    for _ in range(width * height // 800):
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        radius = rnd.randint(1, 4)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=_random_color(rnd))
+    return img
+
+
+def make_screenshot(img: Image.Image, rnd: random.Random) -> Image.Image:
+    """把图片嵌入模拟的应用窗口：标题栏、侧边栏和几行"文字" """
+    width, height = 1280, 800
+    screen = Image.new('RGB', (width, height), (236, 236, 236))
+    draw = ImageDraw.Draw(screen)
+    draw.rectangle((0, 0, width, 40), fill=(45, 45, 48))
+    draw.rectangle((0, 40, 220, height), fill=(250, 250, 250))
+    for row in range(12):
+        y = 70 + row * 36
+        draw.rectangle((20, y, 20 + rnd.randint(80, 180), y + 12), fill=(190, 190, 190))
+
+    content = img.copy()
+    content.thumbnail((900, 640), Image.Resampling.LANCZOS)
+    x = 220 + (width - 220 - content.width) // 2
+    y = 40 + (height - 40 - content.height) // 2
+    screen.paste(content, (x, y))
+    for row in range(3):
+        draw.rectangle((x, y + content.height + 12 + row * 16,
+                        x + rnd.randint(200, content.width), y + content.height + 20 + row * 16),
+                       fill=(120, 120, 120))
+    return screen
+
+
+def _save_variant(img: Image.Image, variant: str, rnd: random.Random, path_stem: str) -> str:
+    if variant == 'resized':
+        path = f"{path_stem}_resized.png"
+        img.resize((img.width // 2, img.height // 2), Image.Resampling.LANCZOS).save(path)
+    elif variant == 'recompressed':
+        path = f"{path_stem}_recompressed.jpg"
+        img.save(path, 'JPEG', quality=rnd.randint(25, 45))
+    elif variant == 'cropped':
+        path = f"{path_stem}_cropped.jpg"
+        dx, dy = int(img.width * 0.08), int(img.height * 0.08)
+        img.crop((dx, dy, img.width - dx, img.height - dy)).save(path, 'JPEG', quality=90)
+    elif variant == 'screenshot':
+        path = f"{path_stem}_screenshot.png"
+        make_screenshot(img, rnd).save(path)
+    else:
+        raise Exception(f"未知的变体类型: {variant}")
+    return path
+
+
+def _load_manifest(output_dir: str) -> dict:
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def generate_corpus(output_dir: str, base_count: int = 200, seed: int = 0,
+                    variants: tuple = VARIANTS) -> dict:
+    """
+    生成语料并写入 manifest.json；目录中已有相同参数生成的语料时直接复用
+
+    返回: manifest 字典，images 为 {path, group, variant} 列表（path 为绝对路径）
+    """
+    output_dir = os.path.abspath(output_dir)
+    params = {'version': CORPUS_VERSION, 'base_count': base_count, 'seed': seed,
+              'variants': list(variants)}
+    manifest = _load_manifest(output_dir)
+    if manifest.get('params') == params and all(
+            os.path.exists(os.path.join(output_dir, image['path'])) for image in manifest['images']):
+        return _with_absolute_paths(manifest, output_dir)
+
+    os.makedirs(output_dir, exist_ok=True)
+    images = []
+    for group in range(base_count):
+        # 每组使用独立的随机数序列，修改 base_count 不影响已有组的内容
+        rnd = random.Random(seed * 1_000_003 + group)
+        img = make_base_image(rnd)
+        group_dir = os.path.join(output_dir, f"{group // 100:03d}")
+        os.makedirs(group_dir, exist_ok=True)
+        path_stem = os.path.join(group_dir, f"g{group:05d}")
+
+        base_path = f"{path_stem}_base.jpg"
+        img.save(base_path, 'JPEG', quality=92)
+        images.append({'path': base_path, 'group': group, 'variant': 'base'})
+        for variant in variants:
+            path = _save_variant(img, variant, rnd, path_stem)
+            images.append({'path': path, 'group': group, 'variant': variant})
+
+    manifest = {
+        'params': params,
+        'images': [dict(image, path=os.path.relpath(image['path'], output_dir)) for image in images]
+    }
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    return _with_absolute_paths(manifest, output_dir)
+
+
+def _with_absolute_paths(manifest: dict, output_dir: str) -> dict:
+    images: List[dict] = [dict(image, path=os.path.join(output_dir, image['path']))
+                          for image in manifest['images']]
+    return {'params': manifest['params'], 'directory': output_dir, 'images': images}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成确定性的合成图片语料")
+    parser.add_argument('output_dir', help="语料输出目录")
+    parser.add_argument('--base-count', type=int, default=200, help="原图（组）数量")
+    parser.add_argument('--seed', type=int, default=0, help="随机种子")
+    args = parser.parse_args()
+
+    corpus = generate_corpus(args.output_dir, args.base_count, args.seed)
+    print(f"语料目录: {corpus['directory']}，共 {len(corpus['images'])} 张图片")
+
+
+if __name__ == '__main__':
+    main()